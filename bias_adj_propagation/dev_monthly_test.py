@@ -1,6 +1,7 @@
 from io import StringIO
-import math
+import os
 import statistics
+import sys
 
 import geoglows
 import numpy as np
@@ -12,6 +13,9 @@ from scipy import stats
 import hydrostats as hs
 import hydrostats.data as hd
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'era5'))
+from extreme_value import solve_gumbel_flow
+
 
 def collect_data(start_id, start_ideam_id, downstream_id, downstream_ideam_id):
     # Upstream simulated flow
@@ -85,16 +89,6 @@ def get_scalar_bias_fdc(first_series, seconds_series):
     return scalars_df
 
 
-def solve_gumbel_flow(std, xbar, rp):
-    """
-    Solves the Gumbel Type I pdf = exp(-exp(-b))
-    where b is the covariate
-    """
-    # xbar = statistics.mean(year_max_flow_list)
-    # std = statistics.stdev(year_max_flow_list, xbar=xbar)
-    return -math.log(-math.log(1 - (1 / rp))) * std * .7797 + xbar - (.45 * std)
-
-
 def propagate_correction(sim_data: pd.DataFrame, obs_data: pd.DataFrame, sim_data_to_correct,
                          drop_outliers: bool = False, outlier_threshold: int or float = 2.5,
                          filter_scalar_fdc: bool = False, filter_scalar_fdc_range: tuple = (0, 80),
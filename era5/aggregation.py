@@ -0,0 +1,233 @@
+"""
+aggregation.py
+
+Author: Riley Hales
+License: BSD 3 Clause
+
+Vectorized temporal aggregation of blocks of river flows. A block is a (time, rivid) array as read from a Qout netcdf.
+The time steps are grouped into calendar periods from their time coordinate, so hourly, 3 hourly and partial records
+are handled alike. time_periods finds the time steps in each calendar period with one searchsorted of the period
+edges on the epoch seconds of the start of each step's interval and aggregate_time_periods reduces those groups
+through a (runs, steps, rivid) view of the block. RAPID stamps each step with the end of its interval, e.g. 01:00 to
+24:00 for the hours of a day, so the interval starts come from the time_bnds of the file or else from the time step
+before.
+"""
+import netCDF4
+import numpy as np
+
+PERIODS = ('daily', 'weekly', 'monthly', 'annual')
+# seconds in each unit of a cf time variable
+TIME_UNITS = {'seconds': 1, 'second': 1, 'minutes': 60, 'minute': 60, 'hours': 3600, 'hour': 3600, 'days': 86400,
+              'day': 86400}
+
+
+def time_periods(times, period='daily', partial='keep', bounds=None):
+    """
+    Groups sorted time steps into the calendar periods their intervals begin in. Weekly periods are 7 day windows
+    counted from the day the first interval begins. A period is partial when its intervals leave a time step or more
+    of it uncovered at the start or end, e.g. the leading and trailing days of a record which doesn't start at midnight.
+
+    Args:
+        times: sorted numpy datetime64 array, e.g. from read_times
+        period: one of PERIODS
+        partial: 'keep' or 'drop' the partial periods
+        bounds: (time, 2) datetime64 array of the start and end of the interval of each time step, e.g. from
+            read_time_bounds. By default each step is the end of an interval which begins at the step before it.
+
+    Returns:
+        tuple: the datetime64[D] first day of each period, the index of its first time step, the index after its last
+            time step and the number of time steps in it
+    """
+    if period not in PERIODS:
+        raise ValueError(f'unrecognized period "{period}", choose from {PERIODS}')
+    if partial not in ('keep', 'drop'):
+        raise ValueError(f'unrecognized partial option "{partial}", choose from keep, drop')
+    times = times.astype('datetime64[s]')
+    step = np.median(np.diff(times)) if len(times) > 1 else np.timedelta64(0, 's')
+    if bounds is None:
+        begins = np.concatenate(([times[0] - step], times[:-1])) if len(times) > 1 else times
+        finishes = times
+    else:
+        bounds = np.asarray(bounds).astype('datetime64[s]')
+        begins, finishes = bounds[:, 0], bounds[:, 1]
+    if period == 'weekly':
+        first = begins[0].astype('datetime64[D]')
+        edges = first + np.arange(0, (begins[-1].astype('datetime64[D]') - first).astype(int) + 8, 7)
+    else:
+        unit = {'daily': 'D', 'monthly': 'M', 'annual': 'Y'}[period]
+        edges = np.arange(begins[0].astype(f'datetime64[{unit}]'), begins[-1].astype(f'datetime64[{unit}]') + 2)
+    edges = edges.astype('datetime64[s]')
+
+    # the first interval beginning at or after each edge, periods without any time steps are skipped
+    positions = np.searchsorted(begins.astype(np.int64), edges.astype(np.int64), side='left')
+    starts, ends = positions[:-1], positions[1:]
+    present = ends > starts
+    period_starts, period_ends, starts, ends = edges[:-1][present], edges[1:][present], starts[present], ends[present]
+
+    if partial == 'drop':
+        complete = (begins[starts] - period_starts < step) & (period_ends - finishes[ends - 1] < step)
+        period_starts, starts, ends = period_starts[complete], starts[complete], ends[complete]
+    return period_starts.astype('datetime64[D]'), starts, ends, ends - starts
+
+
+def aggregate_time_periods(arr, starts, ends):
+    """
+    Computes the min, mean and max flow of the groups of time steps starts[i]:ends[i] of a (time, rivid) array, e.g.
+    from time_periods. The groups must be sorted and not overlap but don't have to be next to each other.
+
+    Returns:
+        tuple: three (periods, rivid) arrays of the min, mean and max
+    """
+    # every group edge, so the time steps between groups are reduced separately and left out
+    offset = starts[0]
+    edges = np.union1d(starts, ends[:-1]) - offset
+    block = arr[offset:ends[-1]]
+    # reduceat is slow over many rows so first reduce runs of steps that every edge is a multiple of, e.g. the 24
+    # hours of a day, through a (runs, steps, rivid) view of the block
+    run = int(np.gcd.reduce(np.append(edges, len(block))))
+    runs = block.reshape(len(block) // run, run, block.shape[1])
+    mins, totals, maxes = runs.min(axis=1), runs.sum(axis=1, dtype=np.float64), runs.max(axis=1)
+    edges //= run
+    if len(edges) < len(mins):
+        mins = np.minimum.reduceat(mins, edges, axis=0)
+        totals = np.add.reduceat(totals, edges, axis=0)
+        maxes = np.maximum.reduceat(maxes, edges, axis=0)
+    groups = np.searchsorted(edges, (starts - offset) // run)
+    return mins[groups], (totals[groups] / (ends - starts)[:, np.newaxis]).astype(arr.dtype), maxes[groups]
+
+
+def read_times(time_var, values=None):
+    """
+    Converts a netcdf time variable to a numpy datetime64[s] array using its units and calendar attributes. Files
+    without units are assumed to be in seconds since 1970-01-01 like the RAPID Qout files. values, e.g. the time_bnds,
+    are converted in place of the values of time_var when given.
+    """
+    units = getattr(time_var, 'units', 'seconds since 1970-01-01 00:00:00')
+    calendar = getattr(time_var, 'calendar', 'standard')
+    values = np.asarray(time_var[:] if values is None else values)
+    # the gregorian calendars are plain offsets from the reference date so only the reference date needs converting,
+    # num2date on every one of the 350,640 hours takes seconds
+    step = TIME_UNITS.get(units.split(' since ')[0].strip().lower())
+    if step is not None and calendar.lower() in ('standard', 'gregorian', 'proleptic_gregorian'):
+        origin = netCDF4.num2date(0, units, calendar, only_use_cftime_datetimes=False, only_use_python_datetimes=True)
+        offsets = np.round(values.astype(np.float64) * step).astype('timedelta64[s]')
+        return np.datetime64(origin.replace(tzinfo=None), 's') + offsets
+    dates = netCDF4.num2date(values, units, calendar, only_use_cftime_datetimes=False,
+                             only_use_python_datetimes=True)
+    dates = np.array([date.replace(tzinfo=None) for date in np.ravel(dates)], dtype='datetime64[s]')
+    return dates.reshape(values.shape)
+
+
+def read_time_bounds(source_nc):
+    """
+    Returns the (time, 2) datetime64[s] start and end of the interval of each time step from the bounds variable of
+    the time variable of a netcdf, e.g. the time_bnds of a RAPID Qout, or None when it has none
+    """
+    time_var = source_nc.variables['time']
+    name = getattr(time_var, 'bounds', 'time_bnds')
+    if name not in source_nc.variables:
+        return None
+    return read_times(time_var, source_nc.variables[name][:])
+
+
+def year_boundaries(times, complete_only=True):
+    """
+    Finds where each calendar year begins in a sorted array of datetime64 times.
+
+    Args:
+        times: sorted numpy datetime64 array, e.g. from read_times
+        complete_only: drop years the record doesn't cover from start to end, e.g. a lone timestep on Jan 1 after the
+            last full year. A year is complete when its first and last time steps are within one time step of the year
+            boundaries.
+
+    Returns:
+        tuple: the array of years, the index of the first time step of each year and the index after the last time
+            step of each year
+    """
+    years = times.astype('datetime64[Y]')
+    starts = np.flatnonzero(np.concatenate(([True], years[1:] != years[:-1])))
+    ends = np.append(starts[1:], len(times))
+    year_values = years[starts]
+    if complete_only and len(times) > 1:
+        step = np.median(np.diff(times))
+        first_ok = times[starts] - year_values.astype('datetime64[s]') <= step
+        last_ok = (year_values + 1).astype('datetime64[s]') - times[ends - 1] <= step
+        keep = first_ok & last_ok
+        year_values, starts, ends = year_values[keep], starts[keep], ends[keep]
+    return year_values.astype(int) + 1970, starts, ends
+
+
+def day_of_year(times, leap_day='drop'):
+    """
+    Computes the integer day of the year (1 based) of each datetime64 time.
+
+    Args:
+        times: numpy datetime64 array, e.g. from read_times
+        leap_day: how leap years are handled
+            'drop': the ordinal day of the year like strftime('%j'), days are numbered 1-366 and the 366th day
+                (Dec 31 of leap years) is marked 0 so it is left out of a 365 day climatology
+            'noleap': days are numbered on a 365 day calendar so each day number is the same date every year. Feb 29 is
+                counted with Feb 28 and the rest of a leap year moves back one day
+            'keep': the ordinal day of the year 1-366
+
+    Returns:
+        np.array: int day of the year of each time, 0 for times that are left out
+    """
+    days = times.astype('datetime64[D]')
+    ordinal = (days - days.astype('datetime64[Y]')).astype(int) + 1
+    if leap_day == 'keep':
+        return ordinal
+    if leap_day == 'drop':
+        return np.where(ordinal == 366, 0, ordinal)
+    if leap_day == 'noleap':
+        years = days.astype('datetime64[Y]').astype(int) + 1970
+        is_leap = (years % 4 == 0) & ((years % 100 != 0) | (years % 400 == 0))
+        return np.where(is_leap & (ordinal >= 60), ordinal - 1, ordinal)
+    raise ValueError(f'unrecognized leap_day option "{leap_day}", choose from drop, noleap, keep')
+
+
+def month_of_year(times):
+    """
+    Computes the integer month (1-12) of each datetime64 time
+    """
+    return times.astype('datetime64[M]').astype(int) % 12 + 1
+
+
+def segments(keys, number_groups):
+    """
+    Prepares a sort based grouped reduction of integer keys numbered 1 to number_groups, keys of 0 are left out. The
+    result is reused for every block with the same time steps, see reduce_segments.
+
+    Returns:
+        tuple: the time step order which sorts the keys, the index of the first sorted step of each group present,
+            the number of steps in each group present and the (0 based) group number of each group present
+    """
+    valid = np.flatnonzero((keys > 0) & (keys <= number_groups))
+    order = valid[np.argsort(keys[valid], kind='stable')]
+    groups, boundaries, counts = np.unique(keys[order], return_index=True, return_counts=True)
+    return order, boundaries, counts, groups - 1
+
+
+def reduce_segments(arr, segment_info, number_groups):
+    """
+    Computes the min, mean and max of each group of time steps of a (time, rivid) array in a single sort of the block.
+    Groups without any time steps are nan.
+
+    Args:
+        arr: (time, rivid) flows
+        segment_info: the result of segments for the time steps of arr
+        number_groups: the number of groups in the output
+
+    Returns:
+        tuple: three (number_groups, rivid) arrays of the min, mean and max
+    """
+    order, boundaries, counts, groups = segment_info
+    grouped = arr[order]
+    results = []
+    for reduction in (np.minimum.reduceat(grouped, boundaries, axis=0),
+                      np.add.reduceat(grouped, boundaries, axis=0, dtype=np.float64) / counts[:, np.newaxis],
+                      np.maximum.reduceat(grouped, boundaries, axis=0)):
+        result = np.full((number_groups, arr.shape[1]), np.nan, dtype=arr.dtype)
+        result[groups] = reduction
+        results.append(result)
+    return tuple(results)
@@ -0,0 +1,164 @@
+"""
+annual_maxima.py
+
+Author: Riley Hales
+License: BSD 3 Clause
+
+Creates the annual maxima product: a small (rivid, year) netcdf of the largest flow of each river in each complete
+year of a Qout file and the time it happened. Fitting return periods only needs these ~40 values per river, so the
+extreme value tools read this file instead of the multi GB hourly Qout. It can be made by this script or as a side
+output of optimized_aggregate.aggregate_by_day.
+"""
+import datetime
+import functools
+import logging
+import os
+import sys
+
+import netCDF4
+import numpy as np
+
+from aggregation import read_times, year_boundaries
+from block_io import river_blocks, rivers_per_block, read_river_block, process_blocks, process_blocks_parallel
+from qout_reader import river_major_path
+
+ANNUAL_MAXIMA_FILE = 'annual_maxima.nc'
+
+
+def annual_maxima_block(arr, starts, ends):
+    """
+    Finds the maximum flow of each year in a (time, rivid) array and the index of the time step it happened on.
+
+    Args:
+        arr: (time, rivid) flows
+        starts: index of the first time step of each year, e.g. from aggregation.year_boundaries
+        ends: index after the last time step of each year
+
+    Returns:
+        tuple: (years, rivid) maximum flows and (years, rivid) time step indices of the maxima
+    """
+    maxima = np.empty((len(starts), arr.shape[1]), dtype=arr.dtype)
+    positions = np.empty((len(starts), arr.shape[1]), dtype=np.int64)
+    for i, (start, end) in enumerate(zip(starts, ends)):
+        year_positions = arr[start:end].argmax(axis=0)
+        positions[i] = year_positions + start
+        maxima[i] = np.take_along_axis(arr[start:end], year_positions[np.newaxis, :], axis=0)[0]
+    return maxima, positions
+
+
+def create_annual_maxima_netcdf(path, source_nc, years):
+    """
+    Creates an empty annual maxima netcdf for the rivers of source_nc and the given years and returns it open for
+    writing. The year dimension is unlimited so new years can be appended.
+    """
+    new_nc = netCDF4.Dataset(path, mode='w')
+    new_nc.createDimension('rivid', size=source_nc.dimensions['rivid'].size)
+    new_nc.createDimension('year', size=None)
+    new_nc.createVariable('rivid', datatype=source_nc.variables['rivid'].dtype, dimensions=('rivid',))
+    new_nc.variables['rivid'][:] = source_nc.variables['rivid'][:]
+    for coordinate in ('lat', 'lon'):
+        if coordinate in source_nc.variables:
+            new_nc.createVariable(coordinate, datatype='f4', dimensions=('rivid',))
+            new_nc.variables[coordinate][:] = source_nc.variables[coordinate][:]
+    new_nc.createVariable('year', datatype='i4', dimensions=('year',))
+    new_nc.variables['year'][:] = years
+    new_nc.createVariable('annual_max', datatype='f4', dimensions=('rivid', 'year'))
+    new_nc.createVariable('annual_max_time', datatype='f8', dimensions=('rivid', 'year'))
+
+    # the times of the maxima are stored in the units of the source time variable
+    source_time = source_nc.variables['time']
+    new_nc.variables['annual_max_time'].setncattr(
+        'units', getattr(source_time, 'units', 'seconds since 1970-01-01 00:00:00'))
+    new_nc.variables['annual_max_time'].setncattr('calendar', getattr(source_time, 'calendar', 'standard'))
+    new_nc.setncattr('source', os.path.basename(source_nc.filepath()))
+    return new_nc
+
+
+def write_annual_maxima(new_nc, maxima, positions, time_values, start, end):
+    """
+    Writes the (years, rivid) maxima and time step indices of rivers start:end from annual_maxima_block. time_values
+    are the values of the source time variable which the indices point to.
+    """
+    new_nc.variables['annual_max'][start:end, :] = np.transpose(maxima)
+    new_nc.variables['annual_max_time'][start:end, :] = np.transpose(time_values[positions])
+
+
+def stamp_annual_maxima(maxima_nc, path_Qout):
+    """
+    Records the name, size and modification time of the Qout an annual maxima netcdf was made from, see
+    matches_source. Call it once every river has been written so a partly written file never matches.
+    """
+    stat = os.stat(path_Qout)
+    maxima_nc.setncattr('source', os.path.basename(path_Qout))
+    maxima_nc.setncattr('source_size', np.int64(stat.st_size))
+    maxima_nc.setncattr('source_mtime_ns', np.int64(stat.st_mtime_ns))
+
+
+def matches_source(path_annual_maxima, path_Qout):
+    """
+    Returns True when the annual maxima netcdf was finished from the current version of path_Qout
+    """
+    stat = os.stat(path_Qout)
+    with netCDF4.Dataset(path_annual_maxima, 'r') as maxima_nc:
+        attributes = {name: maxima_nc.getncattr(name) for name in maxima_nc.ncattrs()}
+    return (attributes.get('source') == os.path.basename(path_Qout)
+            and int(attributes.get('source_size', -1)) == stat.st_size
+            and int(attributes.get('source_mtime_ns', -1)) == stat.st_mtime_ns)
+
+
+def gen_annual_maxima(path_Qout, write_frequency=None, workers=1, max_memory='4GB'):
+    # sort out the file paths
+    if not os.path.isfile(path_Qout):
+        raise FileNotFoundError('Qout file not found at this path')
+    newfilepath = os.path.join(os.path.dirname(path_Qout), ANNUAL_MAXIMA_FILE)
+
+    # read the source netcdf and find the complete years in it
+    path_read = river_major_path(path_Qout)
+    source_nc = netCDF4.Dataset(filename=path_read, mode='r')
+    source_var = source_nc.variables['Qout']
+    time_values = np.asarray(source_nc.variables['time'][:])
+    years, starts, ends = year_boundaries(read_times(source_nc.variables['time']))
+    if len(years) == 0:
+        raise RuntimeError('no complete years found in the Qout file')
+    logging.info(f'finding annual maxima for {len(years)} years from {years[0]} to {years[-1]}')
+
+    new_nc = create_annual_maxima_netcdf(newfilepath, source_nc, years)
+
+    def read_block(start, end):
+        return read_river_block(source_var, start, end, ends[-1])
+
+    def write_block(results, start, end):
+        write_annual_maxima(new_nc, *results, time_values, start, end)
+        new_nc.sync()
+
+    if write_frequency is None:
+        write_frequency = rivers_per_block(max_memory, source_var, int(ends[-1]), working_copies=0, workers=workers,
+                                           output_values=2 * len(years))
+    blocks = river_blocks(source_nc.dimensions['rivid'].size, write_frequency)
+    compute_block = functools.partial(_maxima_block, starts=starts, ends=ends)
+    if workers > 1:
+        process_blocks_parallel(path_read, blocks, compute_block, write_block, workers, number_times=int(ends[-1]))
+    else:
+        process_blocks(blocks, read_block, compute_block, write_block)
+
+    stamp_annual_maxima(new_nc, path_Qout)
+    new_nc.close()
+    source_nc.close()
+    logging.info('FINISHED ' + datetime.datetime.utcnow().strftime("%D at %R"))
+    return newfilepath
+
+
+def _maxima_block(arr, start, end, starts, ends):
+    return annual_maxima_block(arr, starts, ends)
+
+
+if __name__ == '__main__':
+    """
+    sys.argv[0] this script e.g. annual_maxima.py
+    sys.argv[1] path to Qout file
+    sys.argv[2] path to log file
+    sys.argv[3] (optional) number of worker processes. default 1
+    """
+    logging.basicConfig(filename=sys.argv[2], filemode='w', level=logging.INFO, format='%(message)s')
+    logging.info('Annual maxima started on ' + datetime.datetime.utcnow().strftime("%D at %R"))
+    gen_annual_maxima(sys.argv[1], workers=int(sys.argv[3]) if len(sys.argv) > 3 else 1)
@@ -0,0 +1,315 @@
+"""
+block_io.py
+
+Author: Riley Hales
+License: BSD 3 Clause
+
+Shared block reader/writer for tools that reduce a Qout netcdf one block of rivers at a time. While block N is being
+computed, block N+1 is read on a background thread and the results of block N-1 are written on another thread.
+netCDF4/HDF5 is not thread safe so every library call is serialized by NETCDF_LOCK; the overlap comes from numpy
+releasing the GIL during the reductions.
+
+process_blocks_parallel spreads the blocks over a pool of worker processes instead. Each worker opens the source Qout
+read only, reduces whole blocks and hands the results back through shared memory to the calling process which is the
+only one that writes to the output netcdf.
+"""
+import datetime
+import logging
+import multiprocessing
+import re
+import resource
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from qout_reader import QoutReader, TIME_MAJOR
+
+NETCDF_LOCK = threading.RLock()
+MEMORY_UNITS = {'': 1, 'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30, 'T': 2 ** 40}
+
+
+def parse_memory(max_memory):
+    """
+    Converts a memory size given as a number of bytes or a string like '512MB', '4G' or '1.5 GiB' to bytes
+    """
+    if isinstance(max_memory, (int, float)):
+        return int(max_memory)
+    match = re.fullmatch(r'\s*([\d.]+)\s*([KMGT]?)(?:i?B)?\s*', str(max_memory), flags=re.IGNORECASE)
+    if match is None:
+        raise ValueError(f'unrecognized memory size "{max_memory}"')
+    return int(float(match.group(1)) * MEMORY_UNITS[match.group(2).upper()])
+
+
+def rivers_per_block(max_memory, flow_var, number_times=None, output_values=0, working_copies=1, workers=1):
+    """
+    Picks how many rivers to read at once so the blocks being read, computed and written stay within max_memory.
+
+    Args:
+        max_memory: memory budget in bytes or a string like '4GB', see parse_memory
+        flow_var: the source Qout variable, its dtype and chunk layout are used
+        number_times: number of time steps read for each river, defaults to the whole time dimension
+        output_values: number of values computed for each river, summed over all output variables
+        working_copies: number of (time, rivid) sized arrays the computation holds besides the block itself
+        workers: number of processes sharing the budget
+
+    Returns:
+        int: rivers per block, rounded down to whole on-disk chunks along rivid when there is room for at least one
+    """
+    reader = QoutReader(flow_var)
+    if number_times is None:
+        number_times = reader.number_times
+    num_rivers = reader.number_rivers
+    # one block is being computed while the next is read and the previous one's results wait to be written
+    bytes_per_river = flow_var.dtype.itemsize * number_times * (2 + working_copies) + 8 * output_values * 2
+    rivers = max(parse_memory(max_memory) // workers // bytes_per_river, 1)
+
+    if rivers >= reader.river_chunk:
+        rivers -= rivers % reader.river_chunk
+    rivers = int(min(rivers, num_rivers))
+    # hold the chunks of a whole block in the cache so the chunks a block shares with the next aren't decoded twice
+    reader.fit_chunk_cache(rivers, number_times, max_bytes=max(parse_memory(max_memory) // workers // 8, 2 ** 20))
+    logging.info(f'  {rivers} rivers per block: {bytes_per_river / 2 ** 20:.1f} MiB per river within '
+                 f'{parse_memory(max_memory) / 2 ** 30:.2f} GiB over {workers} process(es)')
+    return rivers
+
+
+def reset_peak_rss():
+    """
+    Resets the peak resident set size of this process where the kernel allows it (linux /proc/self/clear_refs)
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss():
+    """
+    Returns the peak resident set size of this process in bytes since the last reset_peak_rss
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def river_blocks(num_rivers, rivers_per_block):
+    """
+    Splits range(num_rivers) into (start, end) pairs of at most rivers_per_block rivers, end is exclusive
+    """
+    return [(start, min(start + rivers_per_block, num_rivers)) for start in range(0, num_rivers, rivers_per_block)]
+
+
+def read_river_block(flow_var, start, end, number_times=None, first_time=0):
+    """
+    Reads the flows of rivers start:end from a Qout variable as a (time, rivid) array whatever the dimension order
+    on disk. Any 2D variable with a rivid dimension works, e.g. the (rivid, year) annual maxima. number_times limits
+    the read to the time steps before number_times and first_time skips the ones before it.
+    """
+    return QoutReader(flow_var).read(slice(start, end), slice(first_time, number_times), TIME_MAJOR)
+
+
+def process_blocks(blocks, read_block, compute_block, write_block):
+    """
+    Runs read -> compute -> write for each (start, end) pair in blocks with the next read and the previous write
+    running in the background.
+
+    Args:
+        blocks: list of (start, end) river index pairs, e.g. from river_blocks
+        read_block: function(start, end) returning the source array for the block
+        compute_block: function(arr, start, end) returning the results for the block
+        write_block: function(results, start, end) storing the results
+    """
+    number_blocks = len(blocks)
+    if number_blocks == 0:
+        return
+    totals = {'read': 0., 'compute': 0., 'write': 0.}
+
+    def timed_read(start, end):
+        t0 = time.perf_counter()
+        with NETCDF_LOCK:
+            arr = read_block(start, end)
+        return arr, time.perf_counter() - t0
+
+    def timed_write(block_num, results, start, end, read_time, compute_time, block_peak):
+        t0 = time.perf_counter()
+        with NETCDF_LOCK:
+            write_block(results, start, end)
+        write_time = time.perf_counter() - t0
+        totals['read'] += read_time
+        totals['compute'] += compute_time
+        totals['write'] += write_time
+        logging.info(f'  block {block_num + 1}/{number_blocks} (rivers {start}:{end}) read {read_time:.2f}s '
+                     f'compute {compute_time:.2f}s write {write_time:.2f}s peak rss {block_peak / 2 ** 20:.0f} MiB -- '
+                     f'{datetime.datetime.utcnow().strftime("%c")}')
+
+    with ThreadPoolExecutor(max_workers=1) as reader, ThreadPoolExecutor(max_workers=1) as writer:
+        reset_peak_rss()
+        next_read = reader.submit(timed_read, *blocks[0])
+        pending_write = None
+        for block_num, (start, end) in enumerate(blocks):
+            arr, read_time = next_read.result()
+            if block_num + 1 < number_blocks:
+                next_read = reader.submit(timed_read, *blocks[block_num + 1])
+
+            t0 = time.perf_counter()
+            results = compute_block(arr, start, end)
+            compute_time = time.perf_counter() - t0
+            del arr
+            block_peak = peak_rss()
+            reset_peak_rss()
+
+            # at most one write is queued so finished results don't pile up in memory
+            if pending_write is not None:
+                pending_write.result()
+            pending_write = writer.submit(
+                timed_write, block_num, results, start, end, read_time, compute_time, block_peak)
+        pending_write.result()
+
+    limiting = max(totals, key=totals.get)
+    logging.info(f'  totals: read {totals["read"]:.2f}s compute {totals["compute"]:.2f}s '
+                 f'write {totals["write"]:.2f}s, limited by {limiting}')
+    return
+
+
+_worker_source = None
+
+
+def _open_worker_source(open_source, path_Qout, flow_var):
+    global _worker_source
+    _worker_source = open_source(path_Qout, flow_var)
+
+
+def _reduce_in_worker(compute_block, number_times, first_time, start, end):
+    reset_peak_rss()
+    t0 = time.perf_counter()
+    arr = _worker_source.read(slice(start, end), slice(first_time, number_times), TIME_MAJOR)
+    read_time = time.perf_counter() - t0
+    results = compute_block(arr, start, end)
+    compute_time = time.perf_counter() - t0 - read_time
+    del arr
+
+    # copy each result array into a shared memory segment, the writer process owns and unlinks them
+    descriptors = []
+    try:
+        for result in results:
+            result = np.ascontiguousarray(result)
+            shm = shared_memory.SharedMemory(create=True, size=max(result.nbytes, 1))
+            descriptors.append((shm.name, result.shape, result.dtype.str))
+            np.ndarray(result.shape, dtype=result.dtype, buffer=shm.buf)[...] = result
+            shm.close()
+            resource_tracker.unregister(shm._name, 'shared_memory')
+    except BaseException:
+        _unlink_shared_results(descriptors)
+        raise
+    return descriptors, read_time, compute_time, peak_rss()
+
+
+def _unlink_shared_results(descriptors):
+    # removes the segments of results which will never be written
+    for name, _, _ in descriptors:
+        try:
+            shm = shared_memory.SharedMemory(name=name)
+        except FileNotFoundError:
+            continue
+        shm.close()
+        shm.unlink()
+
+
+def _discard_in_flight(in_flight):
+    # cancels the blocks not yet started and unlinks the results of the others once they finish, the workers gave up
+    # tracking their segments so nothing else would remove them from /dev/shm
+    for future in in_flight.values():
+        future.cancel()
+    for future in in_flight.values():
+        if future.cancelled():
+            continue
+        try:
+            descriptors = future.result()[0]
+        except BaseException:
+            continue
+        _unlink_shared_results(descriptors)
+    in_flight.clear()
+
+
+def _collect_shared_results(descriptors):
+    results = []
+    segments = []
+    for name, shape, dtype in descriptors:
+        shm = shared_memory.SharedMemory(name=name)
+        segments.append(shm)
+        results.append(np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+    return results, segments
+
+
+def process_blocks_parallel(path_Qout, blocks, compute_block, write_block, workers, flow_var='Qout',
+                            number_times=None, first_time=0, open_source=QoutReader):
+    """
+    Reduces the blocks in a pool of worker processes and writes the results from this process, in block order so the
+    output is the same as process_blocks would make.
+
+    Args:
+        path_Qout: path to the source Qout netcdf, opened read only by each worker
+        blocks: list of (start, end) river index pairs, e.g. from river_blocks
+        compute_block: picklable function(arr, start, end) returning a tuple of arrays, the same one process_blocks
+            would be given
+        write_block: function(results, start, end) storing the results, only called in this process
+        workers: number of worker processes
+        flow_var: name of the flow variable in the source netcdf
+        number_times: only read the time steps before number_times
+        first_time: skip the time steps before first_time
+        open_source: picklable function(path_Qout, flow_var) each worker opens the source with, returning an object
+            with the read method of QoutReader, e.g. qout_cache.QoutCache
+    """
+    number_blocks = len(blocks)
+    totals = {'read': 0., 'compute': 0., 'write': 0.}
+    # spawn rather than fork so the workers don't inherit the HDF5 state of the open output file
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_open_worker_source,
+                             initargs=(open_source, path_Qout, flow_var)) as pool:
+        # keep a couple of blocks queued per worker so they stay busy without holding every result in memory
+        in_flight = {}
+        next_submit = 0
+        try:
+            for block_num, (start, end) in enumerate(blocks):
+                while next_submit < number_blocks and next_submit < block_num + 2 * workers:
+                    in_flight[next_submit] = pool.submit(
+                        _reduce_in_worker, compute_block, number_times, first_time, *blocks[next_submit])
+                    next_submit += 1
+                descriptors, read_time, compute_time, block_peak = in_flight.pop(block_num).result()
+
+                t0 = time.perf_counter()
+                results, segments = None, []
+                try:
+                    results, segments = _collect_shared_results(descriptors)
+                    write_block(results, start, end)
+                finally:
+                    del results
+                    for shm in segments:
+                        shm.close()
+                    # also covers segments left unopened when collecting them failed part way
+                    _unlink_shared_results(descriptors)
+                write_time = time.perf_counter() - t0
+
+                totals['read'] += read_time
+                totals['compute'] += compute_time
+                totals['write'] += write_time
+                logging.info(f'  block {block_num + 1}/{number_blocks} (rivers {start}:{end}) read {read_time:.2f}s '
+                             f'compute {compute_time:.2f}s write {write_time:.2f}s worker peak rss '
+                             f'{block_peak / 2 ** 20:.0f} MiB -- {datetime.datetime.utcnow().strftime("%c")}')
+        except BaseException:
+            # a failed block or write leaves the results still in flight uncollected
+            _discard_in_flight(in_flight)
+            raise
+
+    logging.info(f'  totals over {workers} workers: read {totals["read"]:.2f}s compute {totals["compute"]:.2f}s '
+                 f'write {totals["write"]:.2f}s')
+    return
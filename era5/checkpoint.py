@@ -0,0 +1,100 @@
+"""
+checkpoint.py
+
+Author: Riley Hales
+License: BSD 3 Clause
+
+Checkpoint manifests for tools that write a netcdf one block of rivers at a time. The manifest is a json file saved
+next to the output which lists the blocks that have been written and synced. A tool that dies part way through can
+reopen its partial output in append mode and process only the missing blocks. The size and modification time of the
+source file are recorded too so a changed input forces a clean rebuild.
+"""
+import json
+import logging
+import os
+
+
+class BlockCheckpoint:
+    def __init__(self, output_path, source_path, settings=None):
+        """
+        Args:
+            output_path: path to the netcdf being written
+            source_path: path to the file the output is computed from
+            settings: dictionary of json serializable options which change the output, e.g. the aggregation period.
+                A manifest saved with different settings is not resumed.
+        """
+        self.output_path = output_path
+        self.source_path = source_path
+        self.path = output_path + '.checkpoint.json'
+        self.settings = settings or {}
+        self.blocks = []
+        self.completed = set()
+
+    def _source_signature(self):
+        stat = os.stat(self.source_path)
+        return {'source': os.path.abspath(self.source_path), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+    def resume(self):
+        """
+        Loads the manifest if the partial output can be resumed. Returns the list of (start, end) blocks the output
+        was started with, or None if there is no usable manifest and the output should be rebuilt from scratch.
+        """
+        if not os.path.isfile(self.path) or not os.path.isfile(self.output_path):
+            return None
+        try:
+            with open(self.path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            logging.info(f'  unreadable checkpoint manifest {self.path}, rebuilding')
+            return None
+        if manifest.get('signature') != self._source_signature():
+            logging.info('  source file changed since the checkpoint was written, rebuilding')
+            return None
+        if manifest.get('settings') != self.settings:
+            logging.info('  settings changed since the checkpoint was written, rebuilding')
+            return None
+        self.blocks = [tuple(block) for block in manifest['blocks']]
+        self.completed = {tuple(block) for block in manifest['completed']}
+        logging.info(f'  resuming from checkpoint: {len(self.completed)}/{len(self.blocks)} blocks already written')
+        return self.blocks
+
+    def start(self, blocks):
+        """
+        Begins a new manifest for an output which will be written in the given (start, end) blocks
+        """
+        self.blocks = [tuple(block) for block in blocks]
+        self.completed = set()
+        self._save()
+
+    def remaining(self):
+        """
+        Returns the blocks which have not been written yet, in order
+        """
+        return [block for block in self.blocks if block not in self.completed]
+
+    def mark_complete(self, start, end):
+        """
+        Records that a block has been written. Call it only after the output has been synced to disk.
+        """
+        self.completed.add((start, end))
+        self._save()
+
+    def finish(self):
+        """
+        Removes the manifest once the whole output has been written
+        """
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+    def _save(self):
+        manifest = {
+            'signature': self._source_signature(),
+            'settings': self.settings,
+            'blocks': [list(block) for block in self.blocks],
+            'completed': sorted(list(block) for block in self.completed),
+        }
+        # write then rename so a crash mid write never leaves a truncated manifest
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self.path)
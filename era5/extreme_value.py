@@ -0,0 +1,204 @@
+"""
+extreme_value.py
+
+Author: Riley Hales
+License: BSD 3 Clause
+
+Vectorized extreme value distribution fits for return period flows. Every function takes a (years, rivid) array of
+annual maximum flows and a sequence of return periods and returns a (return periods, rivid) array of flows, so all the
+distributions can be fit from the same annual maxima of a block of rivers without reading the flows again.
+"""
+import math
+import statistics
+
+import numpy as np
+
+_lgamma = np.vectorize(math.lgamma, otypes=[np.float64])
+# beyond this skew the Wilson-Hilferty frequency factor of the median falls below -2 / skew, the lower bound of a
+# standardized Pearson III, so the fitted quantiles are meaningless
+LP3_MAX_SKEW = 6
+
+
+def solve_gumbel_flow(std, xbar, rp):
+    """
+    Solves the Gumbel Type I pdf = exp(-exp(-b))
+    where b is the covariate. Works on scalars or numpy arrays which broadcast together.
+    """
+    # xbar = statistics.mean(year_max_flow_list)
+    # std = statistics.stdev(year_max_flow_list, xbar=xbar)
+    return -np.log(-np.log(1 - (1 / rp))) * std * .7797 + xbar - (.45 * std)
+
+
+def _non_exceedance(return_periods):
+    return 1 - 1 / np.asarray(return_periods, dtype=np.float64)[:, np.newaxis]
+
+
+def sample_lmoments(annual_max):
+    """
+    Computes the first L-moment (mean), second L-moment (scale) and L-skewness of each river from the unbiased
+    probability weighted moments of the sorted (years, rivid) annual maxima.
+    """
+    x = np.sort(annual_max.astype(np.float64), axis=0)
+    n = x.shape[0]
+    j = np.arange(n, dtype=np.float64)[:, np.newaxis]
+    b0 = x.mean(axis=0)
+    b1 = (j * x).sum(axis=0) / (n * (n - 1))
+    b2 = (j * (j - 1) * x).sum(axis=0) / (n * (n - 1) * (n - 2))
+    l1 = b0
+    l2 = 2 * b1 - b0
+    l3 = 6 * b2 - 6 * b1 + b0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t3 = np.where(l2 > 0, l3 / l2, 0)
+    return l1, l2, t3
+
+
+def gumbel_flows(annual_max, return_periods):
+    """
+    Gumbel distribution fit with the method of moments, the original GEOGloWS return periods
+    """
+    annual_max = annual_max.astype(np.float64)
+    xbar = annual_max.mean(axis=0)
+    std = annual_max.std(axis=0, ddof=1)
+    return solve_gumbel_flow(std, xbar, np.asarray(return_periods, dtype=np.float64)[:, np.newaxis])
+
+
+def gumbel_lmoment_flows(annual_max, return_periods):
+    """
+    Gumbel distribution fit with L-moments
+    """
+    l1, l2, _ = sample_lmoments(annual_max)
+    alpha = l2 / math.log(2)
+    xi = l1 - np.euler_gamma * alpha
+    return xi - alpha * np.log(-np.log(_non_exceedance(return_periods)))
+
+
+def gev_flows(annual_max, return_periods):
+    """
+    Generalized extreme value distribution fit with L-moments using Hosking's (1985) approximation of the shape
+    parameter. Rivers whose shape is indistinguishable from 0 use the Gumbel limit.
+    """
+    l1, l2, t3 = sample_lmoments(annual_max)
+    c = 2 / (3 + t3) - math.log(2) / math.log(3)
+    k = 7.8590 * c + 2.9554 * c ** 2
+    gumbel_limit = np.abs(k) < 1e-6
+    k = np.where(gumbel_limit, 1, k)
+    gamma_1k = np.exp(_lgamma(1 + k))
+    alpha = l2 * k / ((1 - 2 ** -k) * gamma_1k)
+    xi = l1 + alpha * (gamma_1k - 1) / k
+    y = -np.log(_non_exceedance(return_periods))
+    flows = xi + alpha / k * (1 - y ** k)
+
+    alpha_gumbel = l2 / math.log(2)
+    gumbel = l1 - np.euler_gamma * alpha_gumbel - alpha_gumbel * np.log(y)
+    return np.where(gumbel_limit, gumbel, flows)
+
+
+def log_pearson3_flows(annual_max, return_periods):
+    """
+    Log-Pearson Type III distribution fit with the L-moments of log10 of the annual maxima. The skew comes from
+    Hosking's rational approximation of the Pearson III shape from the L-skewness and the quantiles from the
+    Wilson-Hilferty frequency factor. Rivers with an annual maximum <= 0 have no fit and get nan, as do rivers whose
+    L-skewness is at or too near +-1, e.g. a record of tied years and one flood, for the skew to be within LP3_MAX_SKEW.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        logs = np.log10(annual_max.astype(np.float64))
+    valid = np.isfinite(logs).all(axis=0)
+    logs = np.where(valid, logs, 0)
+    l1, l2, t3 = sample_lmoments(logs)
+
+    abs_t3 = np.abs(t3)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = 3 * np.pi * t3 ** 2
+        alpha_small = (1 + 0.2906 * z) / (z + 0.1882 * z ** 2 + 0.0442 * z ** 3)
+        z = 1 - abs_t3
+        alpha_large = (0.36067 * z - 0.59567 * z ** 2 + 0.25361 * z ** 3) / \
+                      (1 - 2.78861 * z + 2.56096 * z ** 2 - 0.77045 * z ** 3)
+    normal_limit = abs_t3 < 1e-6
+    alpha = np.where(normal_limit, 1, np.where(abs_t3 < 1 / 3, alpha_small, alpha_large))
+    # alpha tends to 0 as |t3| tends to 1, the rivers whose skew is too large are left out of the gamma functions
+    valid &= np.isfinite(alpha) & (alpha > 4 / LP3_MAX_SKEW ** 2)
+    alpha = np.where(valid, alpha, 1)
+    skew = np.where(normal_limit, 0, 2 / np.sqrt(alpha) * np.sign(t3))
+    # sqrt(alpha) * gamma(alpha) / gamma(alpha + 1/2) tends to 1 as alpha grows which is the normal limit
+    sigma = l2 * np.sqrt(np.pi) * np.where(
+        normal_limit, 1, np.sqrt(alpha) * np.exp(_lgamma(alpha) - _lgamma(alpha + 0.5)))
+
+    z = np.array([statistics.NormalDist().inv_cdf(p) for p in _non_exceedance(return_periods)[:, 0]])[:, np.newaxis]
+    safe_skew = np.where(normal_limit, 1, skew)
+    frequency_factor = np.where(
+        normal_limit, z, 2 / safe_skew * ((1 + safe_skew * z / 6 - safe_skew ** 2 / 36) ** 3 - 1))
+    return np.where(valid, 10 ** (l1 + sigma * frequency_factor), np.nan)
+
+
+# variable name prefix in the return period netcdf and fitting function for each distribution
+DISTRIBUTIONS = {
+    'gumbel': ('return_period', gumbel_flows),
+    'gumbel_lmoments': ('gumbel_lmoments_return_period', gumbel_lmoment_flows),
+    'gev': ('gev_return_period', gev_flows),
+    'lp3': ('lp3_return_period', log_pearson3_flows),
+}
+
+
+def fit_distributions(annual_max, return_periods, distributions=('gumbel',)):
+    """
+    Fits each named distribution to the same (years, rivid) annual maxima. Returns a dictionary of netcdf variable
+    name to the (rivid,) array of flows for every distribution and return period.
+    """
+    results = {}
+    for name in distributions:
+        prefix, fit = DISTRIBUTIONS[name]
+        for rp, flows in zip(return_periods, fit(annual_max, return_periods)):
+            results[f'{prefix}_{rp}'] = flows
+    return results
+
+
+def bootstrap_distributions(annual_max, return_periods, distributions=('gumbel',), resamples=1000, confidence=0.9,
+                            seed=0, first_river=0, rivers_per_batch=64):
+    """
+    Bootstrap confidence intervals of the return period flows. The years of each river are resampled with replacement
+    and every distribution is refit to every resample at once by treating the (years, resamples * rivid) resampled
+    maxima as more rivers.
+
+    Args:
+        annual_max: (years, rivid) annual maximum flows
+        return_periods: sequence of return periods
+        distributions: names of the distributions in DISTRIBUTIONS to fit
+        resamples: number of bootstrap resamples
+        confidence: width of the interval, e.g. 0.9 for the 5th to 95th percentile
+        seed: integer seed of the run. Each river draws from its own generator seeded by (seed, river index) so the
+            result does not depend on how the rivers are split into blocks or processes.
+        first_river: index of the first river of annual_max in the whole file
+        rivers_per_batch: number of rivers resampled together, bounds memory to about
+            years * resamples * rivers_per_batch values
+
+    Returns:
+        dict: netcdf variable name to (rivid,) array for the lower and upper bound of each distribution and return
+            period, e.g. return_period_100_lower and return_period_100_upper
+    """
+    number_years, number_rivers = annual_max.shape
+    annual_max = annual_max.astype(np.float64)
+    percentiles = (50 * (1 - confidence), 50 * (1 + confidence))
+    results = {}
+    for name in distributions:
+        prefix = DISTRIBUTIONS[name][0]
+        for rp in return_periods:
+            results[f'{prefix}_{rp}_lower'] = np.empty(number_rivers)
+            results[f'{prefix}_{rp}_upper'] = np.empty(number_rivers)
+
+    for batch_start in range(0, number_rivers, rivers_per_batch):
+        batch_end = min(batch_start + rivers_per_batch, number_rivers)
+        # (resamples, years, rivers) indices of the resampled years of each river
+        picks = np.stack([
+            np.random.default_rng([seed, first_river + river]).integers(0, number_years, (resamples, number_years))
+            for river in range(batch_start, batch_end)
+        ], axis=-1)
+        resampled = annual_max[picks, np.arange(batch_start, batch_end)]
+        resampled = resampled.transpose(1, 0, 2).reshape(number_years, -1)
+        for name in distributions:
+            prefix, fit = DISTRIBUTIONS[name]
+            flows = fit(resampled, return_periods).reshape(len(return_periods), resamples, batch_end - batch_start)
+            lower, upper = np.nanpercentile(flows, percentiles, axis=1)
+            for i, rp in enumerate(return_periods):
+                results[f'{prefix}_{rp}_lower'][batch_start:batch_end] = lower[i]
+                results[f'{prefix}_{rp}_upper'][batch_start:batch_end] = upper[i]
+    return results
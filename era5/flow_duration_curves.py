@@ -0,0 +1,176 @@
+"""
+flow_duration_curves.py
+
+Author: Riley Hales
+License: BSD 3 Clause
+
+Creates a regional flow duration curve store: a (rivid, exceedance_probability) netcdf with the flow duration curve of
+every river in an ERA5 historical Qout, the same 500 step curve as compute_flow_duration_curve in
+bias_adj_propagation. The curves are computed for a whole block of rivers at once with a 2D percentile along time.
+FlowDurationCurves looks up the curve of a river from the store without downloading and sorting its whole series.
+"""
+import datetime
+import functools
+import logging
+import os
+import sys
+
+import netCDF4
+import numpy as np
+import pandas as pd
+
+from block_io import river_blocks, rivers_per_block, read_river_block, process_blocks, process_blocks_parallel
+from qout_reader import river_major_path
+
+FDC_FILE = 'flow_duration_curves.nc'
+PROB_STEPS = 500
+
+
+def exceedance_probabilities(prob_steps=PROB_STEPS):
+    """
+    Returns the prob_steps + 1 exceedance probabilities (percent) of a flow duration curve, from 100 down to 0 like the
+    exceedence curve of compute_flow_duration_curve
+    """
+    return np.round(np.arange(prob_steps, -1, -1) * 100 / prob_steps, 5)
+
+
+def flow_duration_block(arr, prob_steps=PROB_STEPS):
+    """
+    Computes the flow duration curve of every river of a (time, rivid) array.
+
+    Returns:
+        np.array: (rivid, exceedance_probability) flows, the flow of each river exceeded at each probability of
+            exceedance_probabilities
+    """
+    non_exceedance = 100 - exceedance_probabilities(prob_steps)
+    # nanpercentile falls back to one river at a time along the axis, only pay for that when there are gaps
+    if np.isnan(arr).any():
+        flows = np.nanpercentile(arr, non_exceedance, axis=0)
+    else:
+        flows = np.percentile(arr, non_exceedance, axis=0)
+    return np.transpose(flows).astype(arr.dtype)
+
+
+def create_fdc_netcdf(path, source_nc, prob_steps=PROB_STEPS):
+    """
+    Creates the flow duration curve store for the rivers of source_nc and returns it open for writing
+    """
+    new_nc = netCDF4.Dataset(path, mode='w')
+    new_nc.createDimension('rivid', size=source_nc.dimensions['rivid'].size)
+    new_nc.createDimension('exceedance_probability', size=prob_steps + 1)
+    new_nc.createVariable('rivid', datatype=source_nc.variables['rivid'].dtype, dimensions=('rivid',))
+    new_nc.variables['rivid'][:] = source_nc.variables['rivid'][:]
+    new_nc.createVariable('exceedance_probability', datatype='f8', dimensions=('exceedance_probability',))
+    new_nc.variables['exceedance_probability'][:] = exceedance_probabilities(prob_steps)
+    new_nc.variables['exceedance_probability'].setncattr('units', 'percent')
+    # one chunk per river so a lookup reads a single contiguous curve
+    new_nc.createVariable('flow', datatype='f4', dimensions=('rivid', 'exceedance_probability'),
+                          chunksizes=(1, prob_steps + 1))
+    new_nc.variables['flow'].setncattr('units', 'm3 s-1')
+    new_nc.setncattr('source', os.path.basename(source_nc.filepath()))
+    return new_nc
+
+
+def gen_flow_duration_curves(path_Qout, prob_steps=PROB_STEPS, write_frequency=None, workers=1, max_memory='4GB'):
+    """
+    Computes the flow duration curve of every river in a Qout and writes the store next to it
+    """
+    if not os.path.isfile(path_Qout):
+        raise FileNotFoundError('Qout file not found at this path')
+    newfilepath = os.path.join(os.path.dirname(path_Qout), FDC_FILE)
+
+    path_read = river_major_path(path_Qout)
+    source_nc = netCDF4.Dataset(filename=path_read, mode='r')
+    source_var = source_nc.variables['Qout']
+    new_nc = create_fdc_netcdf(newfilepath, source_nc, prob_steps)
+
+    def read_block(start, end):
+        return read_river_block(source_var, start, end)
+
+    def write_block(results, start, end):
+        new_nc.variables['flow'][start:end, :] = results[0]
+        new_nc.sync()
+
+    if write_frequency is None:
+        # the percentile partitions a copy of the block
+        write_frequency = rivers_per_block(max_memory, source_var, working_copies=1, workers=workers,
+                                           output_values=prob_steps + 1)
+    blocks = river_blocks(source_nc.dimensions['rivid'].size, write_frequency)
+    compute_block = functools.partial(_fdc_block, prob_steps=prob_steps)
+    if workers > 1:
+        process_blocks_parallel(path_read, blocks, compute_block, write_block, workers)
+    else:
+        process_blocks(blocks, read_block, compute_block, write_block)
+
+    new_nc.close()
+    source_nc.close()
+    logging.info('FINISHED ' + datetime.datetime.utcnow().strftime("%D at %R"))
+    return newfilepath
+
+
+def _fdc_block(arr, start, end, prob_steps):
+    return flow_duration_block(arr, prob_steps),
+
+
+class FlowDurationCurves:
+    def __init__(self, path, in_memory=False):
+        """
+        Opens a flow duration curve store for repeated lookups. The rivids are sorted once so finding a river is a
+        binary search and reading its curve is a single chunk.
+
+        Args:
+            path: path to a store made by gen_flow_duration_curves
+            in_memory: read every curve into memory when opened, 2 KB per river, so each lookup is an array index
+                rather than a netcdf read
+        """
+        self.dataset = netCDF4.Dataset(path, mode='r')
+        self.curves = np.asarray(self.dataset.variables['flow'][:]) if in_memory else None
+        rivids = np.asarray(self.dataset.variables['rivid'][:]).astype(np.int64)
+        self.order = np.argsort(rivids, kind='stable')
+        self.sorted_rivids = rivids[self.order]
+        self.exceedance = np.asarray(self.dataset.variables['exceedance_probability'][:])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def index(self, rivid):
+        """
+        Returns the position of rivid in the store, raises KeyError if it isn't in the store
+        """
+        position = np.searchsorted(self.sorted_rivids, rivid)
+        if position == len(self.sorted_rivids) or self.sorted_rivids[position] != rivid:
+            raise KeyError(f'rivid {rivid} is not in the flow duration curve store')
+        return int(self.order[position])
+
+    def flows(self, rivid):
+        """
+        Returns the flows of the curve of rivid in the order of the exceedance probabilities, 100 down to 0
+        """
+        if self.curves is not None:
+            return self.curves[self.index(rivid)]
+        return np.asarray(self.dataset.variables['flow'][self.index(rivid), :])
+
+    def curve(self, rivid):
+        """
+        Returns the curve of rivid as a DataFrame like compute_flow_duration_curve(exceedence=True)
+        """
+        return pd.DataFrame(np.transpose([self.exceedance, self.flows(rivid)]),
+                            columns=['Exceedence Probability', 'Flow'])
+
+    def close(self):
+        self.dataset.close()
+
+
+if __name__ == '__main__':
+    """
+    sys.argv[0] this script e.g. flow_duration_curves.py
+    sys.argv[1] path to Qout file
+    sys.argv[2] path to log file
+    sys.argv[3] (optional) number of worker processes. default 1
+    """
+    logging.basicConfig(filename=sys.argv[2], filemode='w', level=logging.INFO, format='%(message)s')
+    logging.info('Flow duration curves started on ' + datetime.datetime.utcnow().strftime("%D at %R"))
+    gen_flow_duration_curves(sys.argv[1], workers=int(sys.argv[3]) if len(sys.argv) > 3 else 1)
@@ -0,0 +1,142 @@
+"""
+flow_quantiles.py
+
+Author: Riley Hales
+License: BSD 3 Clause
+
+Creates the day of year flow quantile product: a (rivid, day_of_year, quantile) netcdf of the climatological
+percentiles of the flows of each river on each day of the year, e.g. for anomaly and low flow warnings. The time steps
+of each block are sorted into days of the year once, the same as gen_seasonal_averages, then the percentiles of every
+river on a day come from one partition based selection of that day's (time steps, rivid) slice, so the memory needed
+is a single sorted copy of the block.
+"""
+import datetime
+import functools
+import logging
+import os
+import sys
+
+import netCDF4
+import numpy as np
+
+from block_io import river_blocks, rivers_per_block, read_river_block, process_blocks, process_blocks_parallel
+from gen_seasonal_averages import seasonal_segments
+from qout_reader import river_major_path
+
+PERCENTILES = (5, 10, 25, 50, 75, 90, 95)
+QUANTILES_FILE = 'day_of_year_quantiles.nc4'
+
+
+def day_of_year_quantiles(arr, day_segments, percentiles=PERCENTILES, number_days=365):
+    """
+    Computes percentiles of the flows of each river on each day of the year.
+
+    Args:
+        arr: (time, rivid) flows
+        day_segments: the day of year segments of the time steps of arr, see aggregation.segments
+        percentiles: sequence of percentiles between 0 and 100
+        number_days: number of days in the output year
+
+    Returns:
+        np.array: (rivid, day_of_year, quantile) flows, nan on days without any time steps
+    """
+    order, boundaries, counts, groups = day_segments
+    grouped = arr[order]
+    quantiles = np.full((number_days, len(percentiles), arr.shape[1]), np.nan, dtype=arr.dtype)
+    for day, first, count in zip(groups, boundaries, counts):
+        # np.percentile selects the neighbouring order statistics with np.partition rather than sorting each river
+        quantiles[day] = np.percentile(grouped[first:first + count], percentiles, axis=0)
+    return np.transpose(quantiles, (2, 0, 1))
+
+
+def create_quantiles_netcdf(path, source_nc, percentiles=PERCENTILES, number_days=365):
+    """
+    Creates the day of year quantile netcdf and returns it open for writing
+    """
+    new_nc = netCDF4.Dataset(path, mode='w')
+    new_nc.createDimension('rivid', size=source_nc.dimensions['rivid'].size)
+    new_nc.createDimension('day_of_year', size=number_days)
+    new_nc.createDimension('quantile', size=len(percentiles))
+    new_nc.createVariable('rivid', datatype='i4', dimensions=('rivid',))
+    new_nc.createVariable('day_of_year', datatype='i4', dimensions=('day_of_year',))
+    new_nc.createVariable('quantile', datatype='f4', dimensions=('quantile',))
+    new_nc.variables['rivid'][:] = source_nc.variables['rivid'][:]
+    new_nc.variables['day_of_year'][:] = np.arange(1, number_days + 1)
+    new_nc.variables['quantile'][:] = percentiles
+    new_nc.variables['quantile'].setncattr('units', 'percent')
+    # chunk by river so a lookup of one river's climatology reads a single chunk
+    new_nc.createVariable('flow_quantile', datatype='f4', dimensions=('rivid', 'day_of_year', 'quantile'),
+                          chunksizes=(1, number_days, len(percentiles)))
+    new_nc.variables['flow_quantile'].setncattr('units', 'm3 s-1')
+    return new_nc
+
+
+def gen_flow_quantiles(path_Qout, percentiles=PERCENTILES, write_frequency=None, workers=1, max_memory='4GB',
+                       leap_day='drop'):
+    """
+    Computes the day of year percentiles of the flows of every river in a Qout and writes them next to it.
+
+    Args:
+        path_Qout: path to the Qout netcdf
+        percentiles: sequence of percentiles between 0 and 100
+        write_frequency: number of rivers per block, picked from max_memory by default
+        workers: number of worker processes
+        max_memory: memory budget, see block_io.rivers_per_block
+        leap_day: how day 366 of leap years is handled, see aggregation.day_of_year
+    """
+    if not os.path.isfile(path_Qout):
+        raise FileNotFoundError('Qout file not found at this path')
+    newfilepath = os.path.join(os.path.dirname(path_Qout), QUANTILES_FILE)
+    percentiles = tuple(percentiles)
+
+    path_read = river_major_path(path_Qout)
+    source_nc = netCDF4.Dataset(filename=path_read, mode='r')
+    source_var = source_nc.variables['Qout']
+    number_days, day_segments, _ = seasonal_segments(source_nc.variables['time'], leap_day)
+    new_nc = create_quantiles_netcdf(newfilepath, source_nc, percentiles, number_days)
+    logging.info(f'computing the {percentiles} percentiles of {number_days} days of the year')
+
+    def read_block(start, end):
+        return read_river_block(source_var, start, end)
+
+    def write_block(results, start, end):
+        new_nc.variables['flow_quantile'][start:end, :, :] = results[0]
+        new_nc.sync()
+
+    if write_frequency is None:
+        # the block sorted by day of year is the only full size copy
+        write_frequency = rivers_per_block(max_memory, source_var, working_copies=1, workers=workers,
+                                           output_values=number_days * len(percentiles))
+    blocks = river_blocks(source_nc.dimensions['rivid'].size, write_frequency)
+    compute_block = functools.partial(_quantile_block, day_segments=day_segments, percentiles=percentiles,
+                                      number_days=number_days)
+    if workers > 1:
+        process_blocks_parallel(path_read, blocks, compute_block, write_block, workers)
+    else:
+        process_blocks(blocks, read_block, compute_block, write_block)
+
+    new_nc.close()
+    source_nc.close()
+    logging.info('FINISHED ' + datetime.datetime.utcnow().strftime("%D at %R"))
+    return newfilepath
+
+
+def _quantile_block(arr, start, end, day_segments, percentiles, number_days):
+    return day_of_year_quantiles(arr, day_segments, percentiles, number_days),
+
+
+if __name__ == '__main__':
+    """
+    sys.argv[0] this script e.g. flow_quantiles.py
+    sys.argv[1] path to Qout file
+    sys.argv[2] path to log file
+    sys.argv[3] (optional) comma separated percentiles. default 5,10,25,50,75,90,95
+    sys.argv[4] (optional) number of worker processes. default 1
+    """
+    logging.basicConfig(filename=sys.argv[2], filemode='w', level=logging.INFO, format='%(message)s')
+    logging.info('Flow quantiles started on ' + datetime.datetime.utcnow().strftime("%D at %R"))
+    gen_flow_quantiles(
+        sys.argv[1],
+        percentiles=tuple(float(p) for p in sys.argv[3].split(',')) if len(sys.argv) > 3 else PERCENTILES,
+        workers=int(sys.argv[4]) if len(sys.argv) > 4 else 1,
+    )
@@ -1,27 +1,54 @@
+import functools
 import netCDF4 as nc
-import pandas as pd
 import os
 import numpy as np
 import plotly.graph_objs as go
 import logging
 import sys
 
-
-def gen_simulated_averages(path_Qout, write_frequency=1000):
-    # sort out the file paths
-    if not os.path.isfile(path_Qout):
-        raise FileNotFoundError('Qout file not found at this path')
-
-    newfilepath = os.path.join(os.path.dirname(path_Qout), 'simulated_average_flows.nc4')
-
-    # read the source netcdf
-    source_nc = nc.Dataset(filename=path_Qout, mode='r')
-
-    # create the new netcdf
-    new_nc = nc.Dataset(filename=newfilepath, mode='w')
+from aggregation import day_of_year, month_of_year, read_times, reduce_segments, segments
+from block_io import river_blocks, rivers_per_block, process_blocks, process_blocks_parallel
+from output_profiles import create_flow_variable, finish_output
+from qout_cache import QoutCache, open_qout_cache
+from qout_reader import QoutReader, river_major_path
+
+SEASONAL_VARIABLES = ('daily_min', 'daily_avg', 'daily_max', 'monthly_min', 'monthly_avg', 'monthly_max')
+
+
+def seasonal_block(arr, start_idx, end_idx, day_segments, month_segments, number_days=365):
+    # group the flows of each day of the year then each month with one sort of the block apiece, the day and month of
+    # each time step were turned into sorted segments once for the whole file
+    daily_min, daily_avg, daily_max = reduce_segments(arr, day_segments, number_days)
+    monthly_min, monthly_avg, monthly_max = reduce_segments(arr, month_segments, 12)
+    return tuple(np.transpose(values) for values in
+                 (daily_min, daily_avg, daily_max, monthly_min, monthly_avg, monthly_max))
+
+
+def seasonal_segments(time_var, leap_day='drop'):
+    """
+    Sorts the time steps of a Qout time variable into days of the year and months once for every block.
+
+    Returns:
+        tuple: the number of days in the year, the day of year segments and the month segments, see
+            aggregation.segments
+    """
+    number_days = 366 if leap_day == 'keep' else 365
+    times = read_times(time_var)
+    days = day_of_year(times, leap_day)
+    if leap_day == 'drop' and np.any(days == 0):
+        logging.info(f'  leaving out {np.count_nonzero(days == 0)} time steps on day 366 of leap years')
+    return number_days, segments(days, number_days), segments(month_of_year(times), 12)
+
+
+def create_seasonal_netcdf(path, source_nc, number_days=365, profile='default'):
+    """
+    Creates the netcdf of the day of year and monthly min, average and max flows and returns it open for writing. The
+    flows are stored with an output_profiles profile.
+    """
+    new_nc = nc.Dataset(filename=path, mode='w')
     # create rivid and time *dimensions*
     new_nc.createDimension('rivid', size=source_nc.dimensions['rivid'].size)
-    new_nc.createDimension('day_of_year', size=365)
+    new_nc.createDimension('day_of_year', size=number_days)
     new_nc.createDimension('month', size=12)
     # create rivid and time *variables*
     new_nc.createVariable('rivid', datatype='i4', dimensions=('rivid',))
@@ -29,76 +56,81 @@ def gen_simulated_averages(path_Qout, write_frequency=1000):
     new_nc.createVariable('month', datatype='i4', dimensions=('month',))
     # fill those variables with their data
     new_nc.variables['rivid'][:] = source_nc.variables['rivid'][:]
-    new_nc.variables['day_of_year'][:] = list(range(1, 366))
+    new_nc.variables['day_of_year'][:] = list(range(1, number_days + 1))
     new_nc.variables['month'][:] = list(range(1, 13))
     # create the variables for the flows
-    new_nc.createVariable('daily_min', datatype='f4', dimensions=('rivid', 'day_of_year'))
-    new_nc.createVariable('daily_avg', datatype='f4', dimensions=('rivid', 'day_of_year'))
-    new_nc.createVariable('daily_max', datatype='f4', dimensions=('rivid', 'day_of_year'))
-    new_nc.createVariable('monthly_min', datatype='f4', dimensions=('rivid', 'month'))
-    new_nc.createVariable('monthly_avg', datatype='f4', dimensions=('rivid', 'month'))
-    new_nc.createVariable('monthly_max', datatype='f4', dimensions=('rivid', 'month'))
+    for name in SEASONAL_VARIABLES:
+        create_flow_variable(new_nc, name, ('rivid', 'day_of_year' if name.startswith('daily') else 'month'), profile)
+    return new_nc
+
+
+def gen_simulated_averages(path_Qout, write_frequency=None, workers=1, max_memory='4GB', leap_day='drop',
+                           use_cache=False, profile='default'):
+    """
+    Computes the min, average and max flow of each river for every day of the year and every month.
+
+    Args:
+        path_Qout: path to the Qout netcdf
+        write_frequency: number of rivers per block, picked from max_memory by default
+        workers: number of worker processes
+        max_memory: memory budget, see block_io.rivers_per_block
+        leap_day: how day 366 of leap years is handled, see aggregation.day_of_year. 'drop' leaves out Dec 31 of leap
+            years (the original output), 'noleap' counts Feb 29 with Feb 28 so each day is the same date every year
+            and 'keep' writes a 366 day year
+        use_cache: read the flows from the decompressed cache of qout_cache, building it first if needed
+        profile: how the flows are stored, see output_profiles.PROFILES
+    """
+    # sort out the file paths
+    if not os.path.isfile(path_Qout):
+        raise FileNotFoundError('Qout file not found at this path')
+
+    newfilepath = os.path.join(os.path.dirname(path_Qout), 'simulated_average_flows.nc4')
+
+    # read the source netcdf
+    path_read = river_major_path(path_Qout)
+    source_nc = nc.Dataset(filename=path_read, mode='r')
+
+    # create the new netcdf
+    number_days, day_segments, month_segments = seasonal_segments(source_nc.variables['time'], leap_day)
+    new_nc = create_seasonal_netcdf(newfilepath, source_nc, number_days, profile)
 
     # collect information used to create iteration parameters
     num_rivers = source_nc.dimensions['rivid'].size
+    source_var = source_nc.variables['Qout']
 
-    # create a set of indices for slicing the array in sub groups determined by the write_frequency param
-    indices = list(range(num_rivers))
-    index_pairs = []
-    while len(indices) > 0:
-        arr = indices[:write_frequency]
-        index_pairs.append((arr[0], arr[-1]))
-        indices = indices[write_frequency:]
-
-    # create a list of times for the dataframe
-    times = pd.to_datetime(source_nc['time'][:], origin='unix', unit='s', utc=True)
-
-    for group_num, pairs in enumerate(index_pairs):
-        logging.info(f'    working on group {group_num}/{len(index_pairs)}')
-        start_idx = pairs[0]
-        end_idx = pairs[1]
-
-        # depending on the version of rapid used, the dimension order is different
-        if source_nc.variables['Qout'].dimensions == ('time', 'rivid'):
-            arr = np.asarray(source_nc.variables['Qout'][:, start_idx:end_idx])
-        elif source_nc.variables['Qout'].dimensions == ('rivid', 'time'):
-            arr = np.transpose(np.asarray(source_nc.variables['Qout'][start_idx:end_idx, :]))
-
-        columns = source_nc['rivid'][start_idx:end_idx]
-
-        logging.info('    building dataframe 1')
-        # made a dataframe of that array of flows where the index is the day of the year ('%j')
-        df = pd.DataFrame(arr, index=times.strftime('%j'), columns=columns)
-        # for each day of the year
-        for i in range(1, 366):
-            # filter the data frame
-            day_of_year_flows = df[df.index == f'{i:03}']
-            # select min/avg/max flow by column and store it in the new netcdf's variable
-            # use i in the range to select the day of the year but store at i-1 because indexes start at 0, not 1
-            new_nc['daily_min'][start_idx:end_idx, i - 1] = day_of_year_flows.min(axis=0).to_numpy()
-            new_nc['daily_avg'][start_idx:end_idx, i - 1] = day_of_year_flows.mean(axis=0).to_numpy()
-            new_nc['daily_max'][start_idx:end_idx, i - 1] = day_of_year_flows.max(axis=0).to_numpy()
-        # write the changes to the file on the hard drive
-        new_nc.sync()
+    if use_cache:
+        source, path_source, open_source = open_qout_cache(path_Qout, max_memory=max_memory), path_Qout, QoutCache
+    else:
+        source, path_source, open_source = QoutReader(source_var), path_read, QoutReader
 
-        logging.info('    building dataframe 2')
-        # now redo the dataframe with the months and repeat the process
-        df = pd.DataFrame(arr, index=times.strftime('%m'), columns=columns)
-        # for each month of the year
-        for i in range(1, 13):
-            # filter the data frame
-            month_of_year_flows = df[df.index == f'{i:02}']
-            # select min/avg/max flow by column and store it in the new netcdf's variable
-            # use i in the range to select the day of the year but store at i-1 because indexes start at 0, not 1
-            new_nc['monthly_min'][start_idx:end_idx, i - 1] = month_of_year_flows.min(axis=0).to_numpy()
-            new_nc['monthly_avg'][start_idx:end_idx, i - 1] = month_of_year_flows.mean(axis=0).to_numpy()
-            new_nc['monthly_max'][start_idx:end_idx, i - 1] = month_of_year_flows.max(axis=0).to_numpy()
+    def read_block(start_idx, end_idx):
+        return source.read(slice(start_idx, end_idx))
+
+    def write_block(results, start_idx, end_idx):
+        for name, values in zip(SEASONAL_VARIABLES, results):
+            new_nc[name][start_idx:end_idx, :] = values
         # write the changes to the file on the hard drive
         new_nc.sync()
 
+    # read, compute and write groups of rivers with the next read and previous write in the background, or spread the
+    # groups over several worker processes with this one writing the results
+    if write_frequency is None:
+        # the day and month groupings each hold one sorted copy of the block
+        write_frequency = rivers_per_block(max_memory, source_var, working_copies=1, workers=workers,
+                                           output_values=3 * (number_days + 12))
+    blocks = river_blocks(num_rivers, write_frequency)
+    compute_block = functools.partial(seasonal_block, day_segments=day_segments, month_segments=month_segments,
+                                      number_days=number_days)
+    if workers > 1:
+        process_blocks_parallel(path_source, blocks, compute_block, write_block, workers, open_source=open_source)
+    else:
+        process_blocks(blocks, read_block, compute_block, write_block)
+
     # close the new netcdf
     new_nc.close()
+    source.close()
     source_nc.close()
+    finish_output(newfilepath, profile)
 
     return newfilepath
 
@@ -200,7 +232,7 @@ if __name__ == '__main__':
     for file in files:
         try:
             logging.info(f'starting on file:  {file}')
-            gen_simulated_averages(file, 1000)
+            gen_simulated_averages(file)
         except Exception as e:
             logging.info('         FAILED!')
             logging.info(e)
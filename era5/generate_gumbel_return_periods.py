@@ -2,55 +2,93 @@ import os
 import sys
 import netCDF4
 import logging
-import statistics
-import math
 import datetime
-import pandas
+import functools
 import glob
 
+import numpy as np
 
-def solve_gumbel_flow(std, xbar, rp):
+from aggregation import read_times, year_boundaries
+from annual_maxima import ANNUAL_MAXIMA_FILE, annual_maxima_block, matches_source, stamp_annual_maxima
+from block_io import river_blocks, rivers_per_block, read_river_block, process_blocks, process_blocks_parallel
+from checkpoint import BlockCheckpoint
+from output_profiles import OUTPUT_PROFILE_ATTRIBUTE, create_flow_variable, finish_output, profile_packs
+from qout_reader import river_major_path
+from extreme_value import DISTRIBUTIONS, bootstrap_distributions, fit_distributions, solve_gumbel_flow
+
+RETURN_PERIODS = (100, 50, 25, 10, 5, 2)
+# running sums of the annual maxima kept in the return period file so a new year can be folded in without the old ones
+SUFFICIENT_STATISTICS = ('annual_max_count', 'annual_max_sum', 'annual_max_sum_squares')
+
+
+def yearly_max_flows(arr, boundaries):
     """
-    Solves the Gumbel Type I pdf = exp(-exp(-b))
-    where b is the covariate
+    Returns the (years, rivid) maximum flows of a (time, rivid) array where boundaries is the index of the first time
+    step of each year. The last year runs to the end of arr.
     """
-    # xbar = statistics.mean(year_max_flow_list)
-    # std = statistics.stdev(year_max_flow_list, xbar=xbar)
-    return -math.log(-math.log(1 - (1 / rp))) * std * .7797 + xbar - (.45 * std)
+    return np.maximum.reduceat(arr, boundaries, axis=0)
 
 
-def daily_to_yearly_max_flow(daily_flow_list, start_yr, end_yr):
-    yearly_max_flows = []
-    dates = pandas.Series(pandas.date_range(str(start_yr) + '-1-1 00:00:00', periods=len(daily_flow_list), freq='D'))
-    df = pandas.DataFrame(daily_flow_list, columns=['simulated_flow'], index=dates)
-    for i in range(start_yr, end_yr + 1):
-        yearly_max_flows.append(max(df[df.index.year == i]['simulated_flow']))
-    return yearly_max_flows
+def sufficient_statistics(annual_max):
+    """
+    Returns the count, sum and sum of squares of the (years, rivid) annual maxima of each river
+    """
+    annual_max = annual_max.astype(np.float64)
+    count = np.full(annual_max.shape[1], annual_max.shape[0], dtype=np.float64)
+    return count, annual_max.sum(axis=0), (annual_max ** 2).sum(axis=0)
 
 
-def gumbel_return_periods(path_Qout):
-    # sort out the file paths
-    if not os.path.isfile(path_Qout):
-        logging.info(path_Qout)
-        raise FileNotFoundError('Qout file not found at this path')
+def gumbel_from_statistics(count, total, total_squares, return_periods):
+    """
+    Computes the (return periods, rivid) gumbel flows from the running count, sum and sum of squares of the annual
+    maxima, the same fit as extreme_value.gumbel_flows
+    """
+    xbar = total / count
+    std = np.sqrt(np.maximum(total_squares - total * xbar, 0) / (count - 1))
+    return solve_gumbel_flow(std, xbar, np.asarray(return_periods, dtype=np.float64)[:, np.newaxis])
 
-    flow_var = 'Qout'
-    if 'erai' in str(os.path.basename(path_Qout)).lower():
-        start_yr = 1980
-        end_yr = 2014
-        # series_len = 12784
-    elif 'era5' in str(os.path.basename(path_Qout)).lower():
-        start_yr = 1979
-        end_yr = 2018
-        # series_len = 350616
-    else:
-        raise ValueError('unrecognized file, should be erai or era5')
 
-    rp_nc_path = os.path.join(os.path.dirname(path_Qout), 'gumbel_return_periods.nc')
+def return_period_block(arr, start, end, boundaries, return_periods, distributions, variable_names, bootstrap=0,
+                        confidence=0.9, seed=0):
+    # every distribution and bootstrap resample is fit from the same annual maxima, arr already is the annual maxima
+    # when it was read from the annual maxima product
+    annual_max = arr if boundaries is None else yearly_max_flows(arr, boundaries)
+    fits = fit_distributions(annual_max, return_periods, distributions)
+    if bootstrap:
+        fits.update(bootstrap_distributions(annual_max, return_periods, distributions, bootstrap, confidence, seed,
+                                            first_river=start))
+    fits.update(zip(SUFFICIENT_STATISTICS, sufficient_statistics(annual_max)))
+    return [fits[name] for name in variable_names]
 
-    # read the netcdfs
-    source_nc = netCDF4.Dataset(filename=path_Qout, mode='r')
-    rp_nc = netCDF4.Dataset(filename=rp_nc_path, mode='w')
+
+def return_period_variables(distributions, bootstrap=0, confidence=0.9, seed=None):
+    """
+    Lists the variables of the return period netcdf for the distributions and bootstrap bounds, in the order
+    return_period_block computes them. A seed is picked and logged when bootstrapping without one.
+
+    Returns:
+        tuple: the list of variable names and the bootstrap seed
+    """
+    for name in distributions:
+        if name not in DISTRIBUTIONS:
+            raise ValueError(f'unrecognized distribution "{name}", choose from {tuple(DISTRIBUTIONS)}')
+    variable_names = [f'{DISTRIBUTIONS[name][0]}_{rp}' for name in distributions for rp in RETURN_PERIODS]
+    if bootstrap:
+        # without a seed pick one for the whole run and log it so the run can be repeated
+        if seed is None:
+            seed = int(np.random.SeedSequence().entropy % 2 ** 63)
+        logging.info(f'bootstrapping {bootstrap} resamples for {confidence:.0%} intervals with seed {seed}')
+        variable_names += [f'{name}_{bound}' for name in variable_names for bound in ('lower', 'upper')]
+    return variable_names + list(SUFFICIENT_STATISTICS), seed
+
+
+def create_return_period_netcdf(path, source_nc, variable_names, years, distributions, bootstrap=0, confidence=0.9,
+                                seed=None, profile='default'):
+    """
+    Creates the return period netcdf for the rivers of source_nc and returns it open for writing. The return period
+    flows are stored with an output_profiles profile, the running statistics are always exact.
+    """
+    rp_nc = netCDF4.Dataset(filename=path, mode='w')
 
     # create rivid and time dimensions
     logging.info('creating new netcdf variables/dimensions')
@@ -62,62 +100,307 @@ def gumbel_return_periods(path_Qout):
     rp_nc.createVariable('lon', datatype='f4', dimensions=('rivid',))
     rp_nc.variables['lat'][:] = source_nc.variables['lat'][:]
     rp_nc.variables['lon'][:] = source_nc.variables['lon'][:]
-    # create the variables for the flows
-    rp_nc.createVariable('return_period_100', datatype='f4', dimensions=('rivid',))
-    rp_nc.createVariable('return_period_50', datatype='f4', dimensions=('rivid',))
-    rp_nc.createVariable('return_period_25', datatype='f4', dimensions=('rivid',))
-    rp_nc.createVariable('return_period_10', datatype='f4', dimensions=('rivid',))
-    rp_nc.createVariable('return_period_5', datatype='f4', dimensions=('rivid',))
-    rp_nc.createVariable('return_period_2', datatype='f4', dimensions=('rivid',))
-
-    # determine which order of dimensions
-    if source_nc.variables[flow_var].dimensions == ('time', 'rivid'):
-        time_first = True
-    elif source_nc.variables[flow_var].dimensions == ('rivid', 'time'):
-        time_first = False
-    else:
-        logging.info('Unable to identify the order of the Qout variables\' dimensions. Exiting')
-        exit()
+    # create the variables for the flows, one set of return periods (and their bounds) for each distribution
+    for name in variable_names:
+        if name in SUFFICIENT_STATISTICS:
+            rp_nc.createVariable(name, datatype='f8', dimensions=('rivid',))
+        else:
+            create_flow_variable(rp_nc, name, ('rivid',), profile)
+        if name.endswith('_lower') or name.endswith('_upper'):
+            rp_nc.variables[name].setncattr('confidence', confidence)
+            rp_nc.variables[name].setncattr('bootstrap_resamples', bootstrap)
+            rp_nc.variables[name].setncattr('bootstrap_seed', str(seed))
+    # record what the file was computed from for incremental updates
+    rp_nc.setncattr('first_year', int(years[0]))
+    rp_nc.setncattr('last_year', int(years[-1]))
+    rp_nc.setncattr('distributions', ','.join(distributions))
 
     # configure the rivid variable
     logging.info('populating the rivid variable')
     rp_nc.variables['rivid'][:] = source_nc.variables['rivid'][:]
+    rp_nc.sync()
+    return rp_nc
+
+
+def stored_bootstrap_seed(rp_nc):
+    """
+    Returns the bootstrap seed recorded on the bounds of a return period netcdf, or None when it has no bounds
+    """
+    for variable in rp_nc.variables.values():
+        if 'bootstrap_seed' in variable.ncattrs() and variable.getncattr('bootstrap_seed') != 'None':
+            return int(variable.getncattr('bootstrap_seed'))
+    return None
+
+
+def find_source_years(path_Qout, path_annual_maxima=None):
+    """
+    Picks where to read the annual maxima from and which years are available. An annual maxima product next to the
+    Qout which was made from the current version of it is preferred over rereading the whole Qout.
+
+    Returns:
+        tuple: path of the source file, name of its flow variable, array of the complete years, index of the first
+            time step (or year) of each year and index after the last one
+    """
+    if path_annual_maxima is None:
+        sibling = os.path.join(os.path.dirname(path_Qout), ANNUAL_MAXIMA_FILE)
+        if os.path.isfile(sibling) and matches_source(sibling, path_Qout):
+            path_annual_maxima = sibling
+    if path_annual_maxima:
+        with netCDF4.Dataset(path_annual_maxima, 'r') as maxima_nc:
+            years = np.asarray(maxima_nc.variables['year'][:])
+        positions = np.arange(len(years))
+        return path_annual_maxima, 'annual_max', years, positions, positions + 1
+    path_Qout = river_major_path(path_Qout)
+    with netCDF4.Dataset(path_Qout, 'r') as source_nc:
+        years, starts, ends = year_boundaries(read_times(source_nc.variables['time']))
+    return path_Qout, 'Qout', years, starts, ends
+
 
-    # for each river read the whole time series
+def gumbel_return_periods(path_Qout, write_frequency=None, max_memory='4GB', resume=True, distributions=('gumbel',),
+                          bootstrap=0, confidence=0.9, seed=None, workers=1, path_annual_maxima=None,
+                          profile='default'):
+    # sort out the file paths
+    if not os.path.isfile(path_Qout):
+        logging.info(path_Qout)
+        raise FileNotFoundError('Qout file not found at this path')
+    rp_nc_path = os.path.join(os.path.dirname(path_Qout), 'gumbel_return_periods.nc')
+
+    # the years come from the time variable (or the annual maxima product), only complete years are used
+    source_path, flow_var, years, starts, ends = find_source_years(path_Qout, path_annual_maxima)
+    if len(years) < 3:
+        raise RuntimeError(f'found {len(years)} complete years in {source_path}, need at least 3')
+    start_yr, end_yr = int(years[0]), int(years[-1])
+    logging.info(f'reading {len(years)} years of annual maxima from {start_yr} to {end_yr} from {source_path}')
+    first_time, stop = int(starts[0]), int(ends[-1])
+    boundaries = None if flow_var == 'annual_max' else starts - first_time
+
+    # read the source netcdf
+    source_nc = netCDF4.Dataset(filename=source_path, mode='r')
     num_rivers = source_nc.dimensions['rivid'].size
+    return_periods = RETURN_PERIODS
 
-    for i in range(num_rivers):
-        logging.info(str(i) + '/' + str(num_rivers))
+    # pick up a partially written return period file where it stopped if the source file hasn't changed. the seed in
+    # the settings is the one given, a seed drawn for the run is read back from the partial file so it resumes too
+    settings = {'start_yr': start_yr, 'end_yr': end_yr, 'distributions': list(distributions), 'bootstrap': bootstrap,
+                'confidence': confidence, 'seed': seed, 'profile': profile}
+    checkpoint = BlockCheckpoint(rp_nc_path, source_path, settings=settings)
+    blocks = checkpoint.resume() if resume else None
+    if blocks is not None:
+        rp_nc = netCDF4.Dataset(filename=rp_nc_path, mode='a')
+        if bootstrap and seed is None:
+            seed = stored_bootstrap_seed(rp_nc)
+            if seed is None:
+                logging.info('  no bootstrap seed in the partial return period file, rebuilding')
+                rp_nc.close()
+                blocks = None
+    variable_names, seed = return_period_variables(distributions, bootstrap, confidence, seed)
+    if blocks is None:
+        if write_frequency is None:
+            write_frequency = rivers_per_block(max_memory, source_nc.variables[flow_var], stop - first_time,
+                                               working_copies=1, workers=workers,
+                                               output_values=len(years) + len(variable_names))
+        blocks = river_blocks(num_rivers, write_frequency)
+        rp_nc = create_return_period_netcdf(rp_nc_path, source_nc, variable_names, years, distributions, bootstrap,
+                                            confidence, seed, profile)
+        checkpoint.start(blocks)
 
-        # slice the array propertly based on the order of the dimensions
-        if time_first:
-            yearly_max_flows = daily_to_yearly_max_flow(source_nc.variables[flow_var][:, i], start_yr, end_yr)
-        else:
-            yearly_max_flows = daily_to_yearly_max_flow(source_nc.variables[flow_var][i, :], start_yr, end_yr)
-
-        xbar = statistics.mean(yearly_max_flows)
-        std = statistics.stdev(yearly_max_flows, xbar=xbar)
-        rp_nc.variables['return_period_100'][i] = solve_gumbel_flow(std, xbar, 100)
-        rp_nc.variables['return_period_50'][i] = solve_gumbel_flow(std, xbar, 50)
-        rp_nc.variables['return_period_25'][i] = solve_gumbel_flow(std, xbar, 25)
-        rp_nc.variables['return_period_10'][i] = solve_gumbel_flow(std, xbar, 10)
-        rp_nc.variables['return_period_5'][i] = solve_gumbel_flow(std, xbar, 5)
-        rp_nc.variables['return_period_2'][i] = solve_gumbel_flow(std, xbar, 2)
+    # read the whole time series for a group of rivers at a time
+    def read_block(start, end):
+        return read_river_block(source_nc.variables[flow_var], start, end, stop, first_time)
+
+    def write_block(results, start, end):
+        for name, flows in zip(variable_names, results):
+            rp_nc.variables[name][start:end] = flows
         rp_nc.sync()
+        checkpoint.mark_complete(start, end)
 
+    compute_block = functools.partial(
+        return_period_block, boundaries=boundaries, return_periods=return_periods, distributions=distributions,
+        variable_names=variable_names, bootstrap=bootstrap, confidence=confidence, seed=seed)
+    if workers > 1:
+        process_blocks_parallel(source_path, checkpoint.remaining(), compute_block, write_block, workers,
+                                flow_var=flow_var, number_times=stop, first_time=first_time)
+    else:
+        process_blocks(checkpoint.remaining(), read_block, compute_block, write_block)
+
+    rp_nc.close()
     source_nc.close()
+    checkpoint.finish()
+    finish_output(rp_nc_path, profile)
     logging.info('')
     logging.info('FINISHED')
     logging.info(datetime.datetime.utcnow().strftime("%D at %R"))
     return
 
 
+def update_return_periods(path_Qout, write_frequency=None, max_memory='4GB', path_annual_maxima=None):
+    """
+    Folds the complete years of path_Qout after the last year of an existing gumbel_return_periods.nc into its
+    return periods without rereading the older years. The gumbel fit is updated from the running count, sum and sum of
+    squares of the annual maxima. The new years are appended to the annual maxima product when it exists, and any other
+    distributions or bootstrap bounds in the file are refit from it. last_year is only moved once every variable
+    covers the new years, if the refit fails the next update only repeats the refit.
+    """
+    rp_nc_path = os.path.join(os.path.dirname(path_Qout), 'gumbel_return_periods.nc')
+    if not os.path.isfile(rp_nc_path):
+        raise FileNotFoundError('no return period file to update, run gumbel_return_periods first')
+    if path_annual_maxima is None:
+        path_annual_maxima = os.path.join(os.path.dirname(path_Qout), ANNUAL_MAXIMA_FILE)
+    has_maxima = os.path.isfile(path_annual_maxima)
+
+    rp_nc = netCDF4.Dataset(rp_nc_path, mode='a')
+    source_nc = maxima_nc = None
+    try:
+        if 'last_year' not in rp_nc.ncattrs() or any(name not in rp_nc.variables for name in SUFFICIENT_STATISTICS):
+            raise RuntimeError(f'{rp_nc_path} has no running statistics, rebuild it with gumbel_return_periods')
+        profile = 'default'
+        if OUTPUT_PROFILE_ATTRIBUTE in rp_nc.ncattrs():
+            profile = rp_nc.getncattr(OUTPUT_PROFILE_ATTRIBUTE)
+        if profile_packs(profile):
+            # new flows outside the packed range would overflow the int16 values
+            raise RuntimeError(f'{rp_nc_path} is packed to int16 and can not be updated, rebuild it with '
+                               f'gumbel_return_periods')
+        last_year = int(rp_nc.getncattr('last_year'))
+        distributions = [name for name in rp_nc.getncattr('distributions').split(',') if name]
+        # the running statistics are always kept but the gumbel flows are only in files fit with gumbel
+        gumbel_names = []
+        if 'gumbel' in distributions:
+            gumbel_names = [f'{DISTRIBUTIONS["gumbel"][0]}_{rp}' for rp in RETURN_PERIODS]
+        refit = [name for name in distributions if name != 'gumbel']
+        bootstrapped = any(name.endswith('_lower') for name in rp_nc.variables)
+        if (refit or bootstrapped) and not has_maxima:
+            raise RuntimeError(f'{rp_nc_path} has distributions or bounds which need {ANNUAL_MAXIMA_FILE} to update')
+
+        # the running statistics, gumbel flows and annual maxima cover the years through folded_year. it is after
+        # last_year when the refit of the other distributions failed during an earlier update
+        folded_year = last_year
+        if 'folded_year' in rp_nc.ncattrs():
+            folded_year = int(rp_nc.getncattr('folded_year'))
+
+        # find the complete years in the qout after the ones already in the return period file
+        source_nc = netCDF4.Dataset(river_major_path(path_Qout), mode='r')
+        source_var = source_nc.variables['Qout']
+        time_values = np.asarray(source_nc.variables['time'][:])
+        years, starts, ends = year_boundaries(read_times(source_nc.variables['time']))
+        new = years > folded_year
+        if not new.any() and folded_year == last_year:
+            logging.info(f'no complete years after {last_year} in {path_Qout}, nothing to update')
+            return
+        if new.any():
+            years, starts, ends = years[new], starts[new], ends[new]
+            if years[0] != folded_year + 1 or not np.array_equal(years, np.arange(years[0], years[-1] + 1)):
+                raise RuntimeError(f'the years after {folded_year} in {path_Qout} are not consecutive: {years}')
+            first_time, stop = int(starts[0]), int(ends[-1])
+            logging.info(f'folding in {len(years)} new years: {years[0]} to {years[-1]}')
+
+            if has_maxima:
+                maxima_nc = netCDF4.Dataset(path_annual_maxima, mode='a')
+                maxima_years = np.asarray(maxima_nc.variables['year'][:])
+                if maxima_years[-1] != folded_year:
+                    raise RuntimeError(f'{path_annual_maxima} ends in {maxima_years[-1]}, expected {folded_year}')
+                maxima_nc.variables['year'][len(maxima_years):] = years
+                year_slice = slice(len(maxima_years), len(maxima_years) + len(years))
+
+            def read_block(start, end):
+                previous = [np.asarray(rp_nc.variables[name][start:end]) for name in SUFFICIENT_STATISTICS]
+                return read_river_block(source_var, start, end, stop, first_time), previous
+
+            def compute_block(block, start, end):
+                arr, (previous_count, previous_total, previous_squares) = block
+                maxima, positions = annual_maxima_block(arr, starts - first_time, ends - first_time)
+                count, total, total_squares = sufficient_statistics(maxima)
+                count += previous_count
+                total += previous_total
+                total_squares += previous_squares
+                flows = gumbel_from_statistics(count, total, total_squares, RETURN_PERIODS) if gumbel_names else []
+                return maxima, positions + first_time, count, total, total_squares, flows
+
+            def write_block(results, start, end):
+                maxima, positions, count, total, total_squares, flows = results
+                for name, values in zip(SUFFICIENT_STATISTICS, (count, total, total_squares)):
+                    rp_nc.variables[name][start:end] = values
+                for name, values in zip(gumbel_names, flows):
+                    rp_nc.variables[name][start:end] = values
+                rp_nc.sync()
+                if maxima_nc is not None:
+                    maxima_nc.variables['annual_max'][start:end, year_slice] = np.transpose(maxima)
+                    maxima_nc.variables['annual_max_time'][start:end, year_slice] = np.transpose(time_values[positions])
+                    maxima_nc.sync()
+
+            # only the time steps of the new years are read from the qout
+            fold_frequency = write_frequency
+            if fold_frequency is None:
+                fold_frequency = rivers_per_block(max_memory, source_var, stop - first_time, working_copies=0,
+                                                  output_values=2 * len(years) + 3 + len(gumbel_names))
+            process_blocks(river_blocks(source_nc.dimensions['rivid'].size, fold_frequency), read_block,
+                           compute_block, write_block)
+            folded_year = int(years[-1])
+            rp_nc.setncattr('folded_year', folded_year)
+            rp_nc.sync()
+            if maxima_nc is not None:
+                stamp_annual_maxima(maxima_nc, path_Qout)
+                maxima_nc.close()
+        else:
+            logging.info(f'refitting the years {last_year + 1} to {folded_year} folded in by an earlier update')
+        source_nc.close()
+
+        # the other distributions need every year so refit them from the small annual maxima product
+        if refit or bootstrapped:
+            logging.info('refitting the other distributions and bounds from ' + path_annual_maxima)
+            variable_names = [name for name in rp_nc.variables if name not in ('rivid', 'lat', 'lon')
+                              and name not in SUFFICIENT_STATISTICS]
+            bootstrap, confidence, seed = 0, 0.9, 0
+            if bootstrapped:
+                bound = rp_nc.variables[next(name for name in variable_names if name.endswith('_lower'))]
+                bootstrap = int(bound.getncattr('bootstrap_resamples'))
+                confidence = float(bound.getncattr('confidence'))
+                seed = int(bound.getncattr('bootstrap_seed'))
+            maxima_nc = netCDF4.Dataset(path_annual_maxima, mode='r')
+            maxima_years = np.asarray(maxima_nc.variables['year'][:])
+            if maxima_years[-1] != folded_year:
+                raise RuntimeError(f'{path_annual_maxima} ends in {maxima_years[-1]}, expected {folded_year}')
+            compute_block = functools.partial(
+                return_period_block, boundaries=None, return_periods=RETURN_PERIODS, distributions=distributions,
+                variable_names=variable_names, bootstrap=bootstrap, confidence=confidence, seed=seed)
+
+            def read_maxima(start, end):
+                return read_river_block(maxima_nc.variables['annual_max'], start, end)
+
+            def write_fits(results, start, end):
+                for name, values in zip(variable_names, results):
+                    rp_nc.variables[name][start:end] = values
+                rp_nc.sync()
+
+            refit_frequency = write_frequency
+            if refit_frequency is None:
+                refit_frequency = rivers_per_block(max_memory, maxima_nc.variables['annual_max'], len(maxima_years),
+                                                   working_copies=1, output_values=len(variable_names))
+            process_blocks(river_blocks(maxima_nc.dimensions['rivid'].size, refit_frequency), read_maxima,
+                           compute_block, write_fits)
+
+        # every variable now covers the new years
+        rp_nc.setncattr('last_year', folded_year)
+        rp_nc.delncattr('folded_year')
+    finally:
+        # close whatever is still open, also when the update fails part way
+        for dataset in (rp_nc, source_nc, maxima_nc):
+            if dataset is not None and dataset.isopen():
+                dataset.close()
+
+    logging.info('FINISHED updating return periods ' + datetime.datetime.utcnow().strftime("%D at %R"))
+    return
+
+
 # for running this script from the command line with a script
 if __name__ == '__main__':
     """
     sys.argv[0] this script e.g. generate_gumbel_return_periods.py
     sys.argv[1] path to Qout file or directory
     sys.argv[2] path to directory for storing logs
+    sys.argv[3] (optional) comma separated distributions to fit: gumbel, gumbel_lmoments, gev, lp3. default gumbel
+        or "update" to fold the new years of the Qout into the existing return period files
+    sys.argv[4] (optional) number of bootstrap resamples for 90% confidence bounds, 0 for none. default 0
+    sys.argv[5] (optional) number of worker processes. default 1
     """
     # enable logging to track the progress of the workflow and for debugging
     logging.basicConfig(
@@ -128,11 +411,21 @@ if __name__ == '__main__':
     )
     logging.info('Gumbel Return Period Processing started on ' + datetime.datetime.utcnow().strftime("%D at %R"))
     qoutpath = sys.argv[1]
+    if len(sys.argv) > 3 and sys.argv[3] == 'update':
+        function = update_return_periods
+        options = {}
+    else:
+        function = gumbel_return_periods
+        options = {
+            'distributions': tuple(sys.argv[3].split(',')) if len(sys.argv) > 3 else ('gumbel',),
+            'bootstrap': int(sys.argv[4]) if len(sys.argv) > 4 else 0,
+            'workers': int(sys.argv[5]) if len(sys.argv) > 5 else 1,
+        }
     if os.path.isdir(qoutpath):
         files = glob.glob(os.path.join(qoutpath, '*', 'Qout*.nc'))
         print(files)
         for file in files:
             logging.info('Working on file ' + str(file))
-            gumbel_return_periods(file)
+            function(file, **options)
     elif os.path.isfile(qoutpath):
-        gumbel_return_periods(qoutpath)
+        function(qoutpath, **options)
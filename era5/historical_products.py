@@ -0,0 +1,383 @@
+"""
+historical_products.py
+
+Author: Riley Hales
+License: BSD 3 Clause
+
+Makes every historical product of an ERA5 Qout in a single pass over the file. Each block of rivers is read once and
+handed to a set of reducers which each compute and write their own output file: the daily aggregate, the day of year
+and monthly averages, the day of year flow quantiles, the flow duration curves, the annual maxima, the rolling n-day
+extremes and the return periods. The products are the same as running optimized_aggregate, gen_seasonal_averages,
+flow_quantiles, flow_duration_curves, annual_maxima, rolling_extremes and generate_gumbel_return_periods one after
+another without rereading the multi GB Qout for each of them. The aggregate, seasonal and return period products take
+an output_profiles profile in their options like the standalone tools do.
+
+Unlike the standalone tools the fused run keeps no checkpoint, so a run which stops part way through starts over, and
+the return periods are always fit from the blocks of the Qout it reads rather than from an annual maxima product. The
+maxima and so the return periods are the same either way.
+
+A new product plugs in by subclassing Reducer and adding it to REDUCERS.
+"""
+import datetime
+import functools
+import logging
+import os
+import sys
+from abc import ABC, abstractmethod
+
+import netCDF4
+import numpy as np
+
+from aggregation import aggregate_time_periods, read_time_bounds, read_times, time_periods, year_boundaries
+from annual_maxima import (ANNUAL_MAXIMA_FILE, annual_maxima_block, create_annual_maxima_netcdf, stamp_annual_maxima,
+                           write_annual_maxima)
+from block_io import river_blocks, rivers_per_block, process_blocks, process_blocks_parallel
+from flow_duration_curves import FDC_FILE, PROB_STEPS, create_fdc_netcdf, flow_duration_block
+from flow_quantiles import PERCENTILES, QUANTILES_FILE, create_quantiles_netcdf, day_of_year_quantiles
+from gen_seasonal_averages import SEASONAL_VARIABLES, create_seasonal_netcdf, seasonal_block, seasonal_segments
+from generate_gumbel_return_periods import (RETURN_PERIODS, create_return_period_netcdf, return_period_block,
+                                            return_period_variables)
+from optimized_aggregate import create_aggregated_netcdf, write_aggregated
+from qout_cache import QoutCache, open_qout_cache
+from output_profiles import finish_output
+from qout_reader import QoutReader, river_major_path
+from rolling_extremes import ROLLING_EXTREMES_FILE, WINDOWS, create_rolling_extremes_netcdf, rolling_extremes_block
+
+
+class Reducer(ABC):
+    """
+    One product computed from the blocks of a Qout. A reducer is built from the open source netcdf before any block is
+    read and is copied to the worker processes, so it only holds numpy arrays and settings. The output netcdf stays
+    in the writing process and is passed to write.
+
+    Attributes:
+        number_times: number of time steps from the start of the Qout the reducer needs
+        number_results: number of arrays compute returns
+        output_values: number of values computed for each river, summed over the results
+        working_copies: number of (time, rivid) sized arrays compute holds besides the block
+        profile: output_profiles profile the output is packed with once it is finished
+    """
+    number_times = 0
+    number_results = 0
+    output_values = 0
+    working_copies = 0
+    profile = 'default'
+
+    def __init__(self, source_nc, **options):
+        self.options = options
+
+    @abstractmethod
+    def create(self, source_nc, directory):
+        """
+        Creates the output netcdf in directory and returns it open for writing
+        """
+
+    @abstractmethod
+    def compute(self, arr, start, end):
+        """
+        Returns a tuple of arrays computed from the (time, rivid) flows of rivers start:end
+        """
+
+    @abstractmethod
+    def write(self, new_nc, results, start, end):
+        """
+        Writes the results of compute for rivers start:end to the output netcdf
+        """
+
+    def finish(self, new_nc, path_Qout):
+        """
+        Called with the output netcdf once every block has been written, before it is closed
+        """
+
+
+class AggregateReducer(Reducer):
+    def __init__(self, source_nc, period='daily', partial='drop', profile='default'):
+        super().__init__(source_nc, period=period, partial=partial)
+        self.period = period
+        self.profile = profile
+        labels, self.starts, self.ends, self.steps = time_periods(
+            read_times(source_nc.variables['time']), period, partial, read_time_bounds(source_nc))
+        if len(labels) == 0:
+            raise RuntimeError(f'no complete {period} periods found in the time steps')
+        self.first_day = str(labels[0])
+        self.boundaries = (labels - labels[0]).astype(int)
+        self.number_times = int(self.ends[-1])
+        self.number_results = 3
+        self.output_values = 4 * len(labels)
+        self.working_copies = 2
+
+    def create(self, source_nc, directory):
+        prefix = 'DailyAggregated_' if self.period == 'daily' else self.period.capitalize() + 'Aggregated_'
+        path = os.path.join(directory, prefix + os.path.basename(source_nc.filepath()) + '4')
+        return create_aggregated_netcdf(path, source_nc, self.boundaries, self.first_day, self.profile, self.steps)
+
+    def compute(self, arr, start, end):
+        return aggregate_time_periods(arr, self.starts, self.ends)
+
+    def write(self, new_nc, results, start, end):
+        write_aggregated(new_nc, results, start, end)
+
+
+class SeasonalReducer(Reducer):
+    def __init__(self, source_nc, leap_day='drop', profile='default'):
+        super().__init__(source_nc, leap_day=leap_day)
+        self.profile = profile
+        self.number_days, self.day_segments, self.month_segments = seasonal_segments(
+            source_nc.variables['time'], leap_day)
+        self.number_times = source_nc.variables['time'].shape[0]
+        self.number_results = len(SEASONAL_VARIABLES)
+        self.output_values = 3 * (self.number_days + 12)
+        self.working_copies = 1
+
+    def create(self, source_nc, directory):
+        return create_seasonal_netcdf(os.path.join(directory, 'simulated_average_flows.nc4'), source_nc,
+                                      self.number_days, self.profile)
+
+    def compute(self, arr, start, end):
+        return seasonal_block(arr, start, end, self.day_segments, self.month_segments, self.number_days)
+
+    def write(self, new_nc, results, start, end):
+        for name, values in zip(SEASONAL_VARIABLES, results):
+            new_nc.variables[name][start:end, :] = values
+
+
+class QuantileReducer(Reducer):
+    def __init__(self, source_nc, percentiles=PERCENTILES, leap_day='drop'):
+        super().__init__(source_nc, percentiles=tuple(percentiles), leap_day=leap_day)
+        self.percentiles = tuple(percentiles)
+        self.number_days, self.day_segments, _ = seasonal_segments(source_nc.variables['time'], leap_day)
+        self.number_times = source_nc.variables['time'].shape[0]
+        self.number_results = 1
+        self.output_values = self.number_days * len(self.percentiles)
+        self.working_copies = 1
+
+    def create(self, source_nc, directory):
+        return create_quantiles_netcdf(os.path.join(directory, QUANTILES_FILE), source_nc, self.percentiles,
+                                       self.number_days)
+
+    def compute(self, arr, start, end):
+        return day_of_year_quantiles(arr, self.day_segments, self.percentiles, self.number_days),
+
+    def write(self, new_nc, results, start, end):
+        new_nc.variables['flow_quantile'][start:end, :, :] = results[0]
+
+
+class FlowDurationReducer(Reducer):
+    def __init__(self, source_nc, prob_steps=PROB_STEPS):
+        super().__init__(source_nc, prob_steps=prob_steps)
+        self.prob_steps = prob_steps
+        self.number_times = source_nc.variables['time'].shape[0]
+        self.number_results = 1
+        self.output_values = prob_steps + 1
+        self.working_copies = 1
+
+    def create(self, source_nc, directory):
+        return create_fdc_netcdf(os.path.join(directory, FDC_FILE), source_nc, self.prob_steps)
+
+    def compute(self, arr, start, end):
+        return flow_duration_block(arr, self.prob_steps),
+
+    def write(self, new_nc, results, start, end):
+        new_nc.variables['flow'][start:end, :] = results[0]
+
+
+class AnnualMaximaReducer(Reducer):
+    def __init__(self, source_nc):
+        super().__init__(source_nc)
+        self.time_values = np.asarray(source_nc.variables['time'][:])
+        self.years, self.starts, self.ends = year_boundaries(read_times(source_nc.variables['time']))
+        if len(self.years) == 0:
+            raise RuntimeError('no complete years found in the Qout file')
+        self.number_times = int(self.ends[-1])
+        self.number_results = 2
+        self.output_values = 2 * len(self.years)
+
+    def create(self, source_nc, directory):
+        return create_annual_maxima_netcdf(os.path.join(directory, ANNUAL_MAXIMA_FILE), source_nc, self.years)
+
+    def compute(self, arr, start, end):
+        return annual_maxima_block(arr, self.starts, self.ends)
+
+    def write(self, new_nc, results, start, end):
+        write_annual_maxima(new_nc, *results, self.time_values, start, end)
+
+    def finish(self, new_nc, path_Qout):
+        stamp_annual_maxima(new_nc, path_Qout)
+
+
+class RollingExtremesReducer(Reducer):
+    def __init__(self, source_nc, windows=WINDOWS):
+        super().__init__(source_nc, windows=tuple(windows))
+        self.windows = tuple(windows)
+        # the same complete days as the DailyAggregated file of the aggregate product, grouped by their time steps
+        days, self.day_starts, self.day_ends, _ = time_periods(read_times(source_nc.variables['time']), 'daily', 'drop',
+                                                               read_time_bounds(source_nc))
+        if len(days) == 0:
+            raise RuntimeError('no complete days found in the Qout file')
+        self.years, self.starts, self.ends = year_boundaries(days.astype('datetime64[s]'))
+        if len(self.years) == 0:
+            raise RuntimeError('no complete years found in the Qout file')
+        self.number_times = int(self.day_ends[-1])
+        self.number_results = 2
+        self.output_values = 2 * len(self.years) * len(self.windows)
+        # the daily means and their float64 rolling sums together are a fraction of the hourly block
+        self.working_copies = 1
+
+    def create(self, source_nc, directory):
+        return create_rolling_extremes_netcdf(os.path.join(directory, ROLLING_EXTREMES_FILE), source_nc, self.years,
+                                              self.windows)
+
+    def compute(self, arr, start, end):
+        daily = aggregate_time_periods(arr, self.day_starts, self.day_ends)[1]
+        return rolling_extremes_block(daily, self.starts, self.ends, self.windows)
+
+    def write(self, new_nc, results, start, end):
+        new_nc.variables['annual_max_rolling_mean'][start:end, :, :] = results[0]
+        new_nc.variables['annual_min_rolling_mean'][start:end, :, :] = results[1]
+
+
+class ReturnPeriodReducer(Reducer):
+    def __init__(self, source_nc, distributions=('gumbel',), bootstrap=0, confidence=0.9, seed=None, profile='default'):
+        self.years, starts, ends = year_boundaries(read_times(source_nc.variables['time']))
+        if len(self.years) < 3:
+            raise RuntimeError(f'found {len(self.years)} complete years in the Qout, need at least 3')
+        self.variable_names, seed = return_period_variables(distributions, bootstrap, confidence, seed)
+        super().__init__(source_nc, distributions=distributions, bootstrap=bootstrap, confidence=confidence, seed=seed)
+        self.profile = profile
+        self.first_time = int(starts[0])
+        self.boundaries = starts - self.first_time
+        self.number_times = int(ends[-1])
+        self.number_results = len(self.variable_names)
+        self.output_values = len(self.years) + len(self.variable_names)
+
+    def create(self, source_nc, directory):
+        return create_return_period_netcdf(
+            os.path.join(directory, 'gumbel_return_periods.nc'), source_nc, self.variable_names, self.years,
+            self.options['distributions'], self.options['bootstrap'], self.options['confidence'], self.options['seed'],
+            self.profile)
+
+    def compute(self, arr, start, end):
+        return return_period_block(arr[self.first_time:self.number_times], start, end, self.boundaries, RETURN_PERIODS,
+                                   variable_names=self.variable_names, **self.options)
+
+    def write(self, new_nc, results, start, end):
+        for name, values in zip(self.variable_names, results):
+            new_nc.variables[name][start:end] = values
+
+
+# reducer class of each product name
+REDUCERS = {
+    'aggregate': AggregateReducer,
+    'seasonal': SeasonalReducer,
+    'quantiles': QuantileReducer,
+    'flow_duration': FlowDurationReducer,
+    'annual_maxima': AnnualMaximaReducer,
+    'rolling_extremes': RollingExtremesReducer,
+    'return_periods': ReturnPeriodReducer,
+}
+
+
+def fused_block(arr, start, end, reducers):
+    """
+    Runs every reducer on the same block and returns all of their results as one flat tuple of arrays
+    """
+    results = ()
+    for reducer in reducers:
+        results += tuple(reducer.compute(arr, start, end))
+    return results
+
+
+def historical_products(path_Qout, products=tuple(REDUCERS), options=None, write_frequency=None, workers=1,
+                        max_memory='4GB', use_cache=False):
+    """
+    Computes several historical products from one read of each block of rivers of a Qout netcdf.
+
+    Args:
+        path_Qout: path to the Qout netcdf, the products are written next to it
+        products: names of the products in REDUCERS to make
+        options: dictionary of product name to a dictionary of options for its reducer, e.g.
+            {'aggregate': {'period': 'monthly', 'profile': 'zlib'}, 'return_periods': {'distributions': ('gumbel',
+            'gev')}}
+        write_frequency: number of rivers per block, picked from max_memory by default
+        workers: number of worker processes
+        max_memory: memory budget shared by all the products, see block_io.rivers_per_block
+        use_cache: read the flows from the decompressed cache of qout_cache, building it first if needed
+
+    Returns:
+        dict: product name to the path of its output netcdf
+    """
+    if not os.path.isfile(path_Qout):
+        raise FileNotFoundError('Qout file not found at this path')
+    options = options or {}
+    for name in products:
+        if name not in REDUCERS:
+            raise ValueError(f'unrecognized product "{name}", choose from {tuple(REDUCERS)}')
+    directory = os.path.dirname(path_Qout)
+
+    path_read = river_major_path(path_Qout)
+    source_nc = netCDF4.Dataset(filename=path_read, mode='r')
+    source_var = source_nc.variables['Qout']
+    reducers = [REDUCERS[name](source_nc, **options.get(name, {})) for name in products]
+    outputs = [reducer.create(source_nc, directory) for reducer in reducers]
+    # read as far into the record as the reducer needing the most time steps goes
+    number_times = max(reducer.number_times for reducer in reducers)
+    logging.info(f'making {", ".join(products)} from {number_times} time steps of {path_Qout}')
+
+    if use_cache:
+        source, path_source, open_source = open_qout_cache(path_Qout, max_memory=max_memory), path_Qout, QoutCache
+    else:
+        source, path_source, open_source = QoutReader(source_var), path_read, QoutReader
+
+    def read_block(start, end):
+        return source.read(slice(start, end), slice(0, number_times))
+
+    def write_block(results, start, end):
+        position = 0
+        for reducer, new_nc in zip(reducers, outputs):
+            reducer.write(new_nc, results[position:position + reducer.number_results], start, end)
+            new_nc.sync()
+            position += reducer.number_results
+
+    if write_frequency is None:
+        # the reducers run one after another so only the largest working copy is held at once
+        write_frequency = rivers_per_block(max_memory, source_var, number_times, workers=workers,
+                                           working_copies=max(reducer.working_copies for reducer in reducers),
+                                           output_values=sum(reducer.output_values for reducer in reducers))
+    blocks = river_blocks(source_nc.dimensions['rivid'].size, write_frequency)
+    compute_block = functools.partial(fused_block, reducers=reducers)
+    if workers > 1:
+        process_blocks_parallel(path_source, blocks, compute_block, write_block, workers, number_times=number_times,
+                                open_source=open_source)
+    else:
+        process_blocks(blocks, read_block, compute_block, write_block)
+
+    paths = {}
+    for name, reducer, new_nc in zip(products, reducers, outputs):
+        reducer.finish(new_nc, path_Qout)
+        paths[name] = new_nc.filepath()
+        new_nc.close()
+        finish_output(paths[name], reducer.profile)
+    source.close()
+    source_nc.close()
+    logging.info('FINISHED ' + datetime.datetime.utcnow().strftime("%D at %R"))
+    return paths
+
+
+if __name__ == '__main__':
+    """
+    sys.argv[0] this script e.g. historical_products.py
+    sys.argv[1] path to Qout file
+    sys.argv[2] path to log file
+    sys.argv[3] (optional) comma separated products: aggregate, seasonal, quantiles, flow_duration, annual_maxima,
+        rolling_extremes, return_periods. default all
+    sys.argv[4] (optional) number of worker processes. default 1
+    sys.argv[5] (optional) memory budget used to size the groups of rivers, e.g. 16GB. default 4GB
+    """
+    logging.basicConfig(filename=sys.argv[2], filemode='w', level=logging.INFO, format='%(message)s')
+    logging.info('Historical products started on ' + datetime.datetime.utcnow().strftime("%D at %R"))
+    historical_products(
+        sys.argv[1],
+        products=tuple(sys.argv[3].split(',')) if len(sys.argv) > 3 else tuple(REDUCERS),
+        workers=int(sys.argv[4]) if len(sys.argv) > 4 else 1,
+        max_memory=sys.argv[5] if len(sys.argv) > 5 else '4GB',
+    )
@@ -10,113 +10,176 @@ import pandas as pd
 import sys
 import logging
 import datetime
+import functools
 import plotly.graph_objs as go
 
+from aggregation import PERIODS, aggregate_time_periods, read_time_bounds, read_times, time_periods, year_boundaries
+from annual_maxima import (ANNUAL_MAXIMA_FILE, annual_maxima_block, create_annual_maxima_netcdf, stamp_annual_maxima,
+                           write_annual_maxima)
+from block_io import river_blocks, rivers_per_block, read_river_block, process_blocks, process_blocks_parallel
+from checkpoint import BlockCheckpoint
+from output_profiles import create_flow_variable, finish_output
+from qout_cache import open_qout_cache
+from qout_reader import QoutReader, river_major_path
 
-def aggregate_by_day(path_Qout, write_frequency=500):
-    # sort out the file paths
-    if not os.path.isfile(path_Qout):
-        raise FileNotFoundError('Qout file not found at this path')
-    newfilepath = os.path.join(os.path.dirname(path_Qout), 'DailyAggregated_' + os.path.basename(path_Qout) + '4')
 
-    # read the netcdfs
-    source_nc = netCDF4.Dataset(filename=path_Qout, mode='r')
-    new_nc = netCDF4.Dataset(filename=newfilepath, mode='w')
+def aggregate_block(arr, start_index, end_index, period_starts, period_ends, year_starts=None, year_ends=None):
+    # reduce the time steps of each period, e.g. through a (days, 24, rivid) view of an hourly record
+    results = aggregate_time_periods(arr, period_starts, period_ends)
+    # while the hourly flows are in memory also find the annual maxima if they were requested
+    if year_starts is not None:
+        results += annual_maxima_block(arr, year_starts, year_ends)
+    return results
+
+
+def create_aggregated_netcdf(path, source_nc, boundaries, first_day, profile='default', steps=None):
+    """
+    Creates the netcdf of the min, mean and max flow of each period and returns it open for writing. boundaries is the
+    index of the first day of each period counted from first_day, e.g. the days from first_day to each label of
+    aggregation.time_periods. The flows are stored with an output_profiles profile. steps is the number of time steps
+    in each period, written to a time_steps variable when given so partial periods can be told apart.
+    """
+    new_nc = netCDF4.Dataset(filename=path, mode='w')
 
     # create rivid and time dimensions
     logging.info('creating new netcdf variables/dimensions')
     new_nc.createDimension('rivid', size=source_nc.dimensions['rivid'].size)
-    new_nc.createDimension('time', size=source_nc.dimensions['time'].size // 24)
+    new_nc.createDimension('time', size=len(boundaries))
     # create rivid and time variables
     new_nc.createVariable('rivid', datatype='f4', dimensions=('rivid',))
     new_nc.createVariable('time', datatype='f4', dimensions=('time',))
     # create the variables for the flows
-    # new_nc.createVariable('Qout_min', datatype='f4', dimensions=('time', 'rivid'))
-    new_nc.createVariable('Qout', datatype='f4', dimensions=('time', 'rivid'))
-    # new_nc.createVariable('Qout_max', datatype='f4', dimensions=('time', 'rivid'))
+    for name in ('Qout_min', 'Qout', 'Qout_max'):
+        create_flow_variable(new_nc, name, ('time', 'rivid'), profile)
 
-    # configure the time variable
-    new_nc.variables['time'][:] = range(new_nc.dimensions['time'].size)
-    new_nc.variables['time'].__dict__['units'] = 'days since 1979-01-01 00:00:00+00:00'
-    new_nc.variables['time'].__dict__['calendar'] = 'gregorian'
+    # configure the time variable, each step is labeled by the first day of its period
+    new_nc.variables['time'][:] = boundaries
+    new_nc.variables['time'].setncattr('units', f'days since {first_day} 00:00:00+00:00')
+    new_nc.variables['time'].setncattr('calendar', 'gregorian')
+    if steps is not None:
+        new_nc.createVariable('time_steps', datatype='i4', dimensions=('time',))
+        new_nc.variables['time_steps'][:] = steps
 
     # configure the rivid variable
     new_nc.variables['rivid'][:] = source_nc.variables['rivid'][:]
+    new_nc.sync()
+    return new_nc
+
+
+def write_aggregated(new_nc, results, start_index, end_index):
+    """
+    Writes the (periods, rivid) min, mean and max flows of rivers start_index:end_index from aggregate_time_periods
+    """
+    min_arr, mean_arr, max_arr = results
+    new_nc.variables['Qout_min'][:, start_index:end_index] = min_arr
+    new_nc.variables['Qout'][:, start_index:end_index] = mean_arr
+    new_nc.variables['Qout_max'][:, start_index:end_index] = max_arr
+
+
+def aggregate_by_day(path_Qout, write_frequency=None, period='daily', workers=1, max_memory='4GB', resume=True,
+                     annual_maxima=False, profile='default', partial='drop'):
+    """
+    Computes the min, mean and max flow of each river in each calendar period of a Qout and writes them next to it.
+    The periods come from the time coordinate of the Qout so any time step or record length works, e.g. 3 hourly
+    forecast records or partial years.
+
+    Args:
+        path_Qout: path to the Qout netcdf
+        write_frequency: number of rivers per block, picked from max_memory by default
+        period: one of aggregation.PERIODS
+        workers: number of worker processes
+        max_memory: memory budget, see block_io.rivers_per_block
+        resume: continue a partially written output, see checkpoint.BlockCheckpoint
+        annual_maxima: also write the annual maxima product from the same reads
+        profile: how the flows are stored, see output_profiles.PROFILES
+        partial: 'drop' or 'keep' periods the record only partly covers, see aggregation.time_periods
+    """
+    # sort out the file paths
+    if not os.path.isfile(path_Qout):
+        raise FileNotFoundError('Qout file not found at this path')
+    if period not in PERIODS:
+        raise ValueError(f'unrecognized period "{period}", choose from {PERIODS}')
+    prefix = 'DailyAggregated_' if period == 'daily' else period.capitalize() + 'Aggregated_'
+    newfilepath = os.path.join(os.path.dirname(path_Qout), prefix + os.path.basename(path_Qout) + '4')
+
+    # read the source netcdf
+    path_read = river_major_path(path_Qout)
+    source_nc = netCDF4.Dataset(filename=path_read, mode='r')
+    source_var = source_nc.variables['Qout']
+    # raises a ValueError for a dimension order other than ('time', 'rivid') or ('rivid', 'time')
+    QoutReader(source_var)
 
     # collect information used to create iteration parameters
     num_rivers = source_nc.dimensions['rivid'].size
-    number_hours = source_nc.variables['time'].shape[0]
-    if number_hours == 350641:
-        logging.info('----WARNING---- TIME 350641 (expected 350640)')
-        exact = False
-    elif number_hours == 350640:
-        exact = True
+    times = read_times(source_nc.variables['time'])
+    labels, period_starts, period_ends, steps = time_periods(times, period, partial, read_time_bounds(source_nc))
+    if len(labels) == 0:
+        raise RuntimeError(f'no complete {period} periods found in the {len(times)} time steps of {path_Qout}')
+    # only the time steps of the periods are read, the time axis counts days from the first period
+    first_time, stop = int(period_starts[0]), int(period_ends[-1])
+    boundaries = (labels - labels[0]).astype(int)
+    logging.info(f'number of rivers: {num_rivers}, {len(labels)} {period} periods from {labels[0]} to {labels[-1]}')
+
+    # the annual maxima side output covers the complete years of the time steps that get aggregated
+    year_starts = year_ends = maxima_nc = None
+    if annual_maxima:
+        time_values = np.asarray(source_nc.variables['time'][first_time:stop])
+        years, year_starts, year_ends = year_boundaries(times[first_time:stop])
+        maxima_path = os.path.join(os.path.dirname(path_Qout), ANNUAL_MAXIMA_FILE)
+
+    # pick up a partially written output where it stopped if the source file hasn't changed
+    checkpoint = BlockCheckpoint(newfilepath, path_Qout, settings={'period': period, 'annual_maxima': annual_maxima,
+                                                                  'profile': profile, 'partial': partial})
+    blocks = checkpoint.resume() if resume else None
+    if blocks is not None:
+        new_nc = netCDF4.Dataset(filename=newfilepath, mode='a')
+        if annual_maxima:
+            maxima_nc = netCDF4.Dataset(filename=maxima_path, mode='a')
     else:
-        raise RuntimeError('unexpected length of times found.')
-    number_days = number_hours // 24
-    logging.info('number of rivers: ' + str(num_rivers))
-
-    # create a set of indices for slicing the array in larger groups
-    indices = list(range(num_rivers))
-    index_pairs = []
-    while len(indices) > 0:
-        arr = indices[:write_frequency]
-        index_pairs.append((arr[0], arr[-1]))
-        indices = indices[write_frequency:]
-    number_groups = len(index_pairs)
-
-    for group_num, pairs in enumerate(index_pairs):
-        start_index = pairs[0]
-        end_index = pairs[1]
-        logging.info('Started group ' + str(group_num) + '/' + str(number_groups) + ' -- ' + datetime.datetime.utcnow().strftime("%c"))
-
-        # depending on the version of rapid used, the dimension order is different
-        if source_nc.variables['Qout'].dimensions == ('time', 'rivid'):
-            if exact:
-                arr = np.asarray(source_nc.variables['Qout'][:, start_index:end_index])
-            elif not exact:
-                arr = np.asarray(source_nc.variables['Qout'][0:350640, start_index:end_index])
-        elif source_nc.variables['Qout'].dimensions == ('rivid', 'time'):
-            if exact:
-                arr = np.transpose(np.asarray(source_nc.variables['Qout'][start_index:end_index, :]))
-            elif not exact:
-                arr = np.transpose(np.asarray(source_nc.variables['Qout'][start_index:end_index, 0:350640]))
-        else:
-            logging.info('Unable to recognize the dimension order, exiting')
-            exit()
-
-        logging.info(arr.shape)
-
-        # min_arr = []
-        mean_arr = []
-        # max_arr = []
-
-        # if the array is at least 'size' long
-        logging.info('splitting the array into {0} days'.format(number_days))
-        for day_flows in np.split(arr, number_days):
-            # min_arr.append(day_flows.min(axis=0))
-            mean_arr.append(day_flows.mean(axis=0))
-            # max_arr.append(day_flows.max(axis=0))
-
-        # min_arr = np.asarray(min_arr)
-        mean_arr = np.asarray(mean_arr)
-        # max_arr = np.asarray(max_arr)
-
-        # logging.info(min_arr.shape)
-        logging.info(mean_arr.shape)
-        # logging.info(max_arr.shape)
-
-        # logging.info('  writing Qmin group')
-        # new_nc.variables['Qout_min'][:, start_index:end_index] = min_arr
-        logging.info('  writing Qout group')
-        new_nc.variables['Qout'][:, start_index:end_index] = mean_arr
-        # logging.info('  writing Qmax group')
-        # new_nc.variables['Qout_max'][:, start_index:end_index] = max_arr
+        if write_frequency is None:
+            # the min, max and float64 sum of the runs of time steps reduced through a view are about a block when
+            # the runs are short, e.g. a 3 hourly record starting mid day
+            write_frequency = rivers_per_block(max_memory, source_var, stop - first_time, working_copies=2,
+                                               workers=workers, output_values=4 * len(labels))
+        blocks = river_blocks(num_rivers, write_frequency)
+        new_nc = create_aggregated_netcdf(newfilepath, source_nc, boundaries, str(labels[0]), profile, steps)
+        if annual_maxima:
+            maxima_nc = create_annual_maxima_netcdf(maxima_path, source_nc, years)
+            maxima_nc.sync()
+        checkpoint.start(blocks)
+
+    def read_block(start_index, end_index):
+        return read_river_block(source_var, start_index, end_index, stop, first_time)
+
+    def write_block(results, start_index, end_index):
+        write_aggregated(new_nc, results[:3], start_index, end_index)
         new_nc.sync()
+        if maxima_nc is not None:
+            write_annual_maxima(maxima_nc, *results[3:], time_values, start_index, end_index)
+            maxima_nc.sync()
+        checkpoint.mark_complete(start_index, end_index)
+
+    # read, aggregate and write groups of rivers with the next read and previous write in the background, or spread
+    # the groups over several worker processes with this one writing the results
+    blocks = checkpoint.remaining()
+    compute_block = functools.partial(aggregate_block, period_starts=period_starts - first_time,
+                                      period_ends=period_ends - first_time, year_starts=year_starts,
+                                      year_ends=year_ends)
+    logging.info('aggregating {0} groups of rivers into {1} {2} periods'.format(len(blocks), len(labels), period))
+    if workers > 1:
+        process_blocks_parallel(path_read, blocks, compute_block, write_block, workers, number_times=stop,
+                                first_time=first_time)
+    else:
+        process_blocks(blocks, read_block, compute_block, write_block)
 
     # close the new netcdf
     new_nc.close()
+    if maxima_nc is not None:
+        stamp_annual_maxima(maxima_nc, path_Qout)
+        maxima_nc.close()
     source_nc.close()
+    checkpoint.finish()
+    finish_output(newfilepath, profile)
 
     logging.info('')
     logging.info('FINISHED')
@@ -124,23 +187,26 @@ def aggregate_by_day(path_Qout, write_frequency=500):
     return newfilepath
 
 
-def validate_aggregated_rivid(path_Qout, path_Aggregated_qout, rivid=None):
-    old_xar = xarray.open_dataset(path_Qout)
+def validate_aggregated_rivid(path_Qout, path_Aggregated_qout, rivid=None, use_cache=False):
+    old_xar = xarray.open_dataset(river_major_path(path_Qout))
     new_xar = xarray.open_dataset(path_Aggregated_qout)
 
     if not rivid:
         rivid = int(np.random.choice(new_xar.variables['rivid'], 1))
 
     old_times = pd.to_datetime(pd.Series(old_xar.sel(rivid=rivid).time))
-    oldflow = np.asarray(old_xar.sel(rivid=rivid).Qout)
-    new_times = np.asarray(new_xar.sel(rivid=rivid).time)
+    if use_cache:
+        # one river of the decompressed cache instead of decoding every chunk holding it
+        with open_qout_cache(path_Qout) as cache:
+            oldflow = np.array(cache.river(rivid))
+    else:
+        oldflow = np.asarray(old_xar.sel(rivid=rivid).Qout)
+    # xarray decodes the time axis from its units, the first day of each period
+    new_times = pd.to_datetime(pd.Series(new_xar.sel(rivid=rivid).time))
     newmin = np.asarray(new_xar.sel(rivid=rivid).Qout_min)
-    newmean = np.asarray(new_xar.sel(rivid=rivid).Qout_mean)
+    newmean = np.asarray(new_xar.sel(rivid=rivid).Qout)
     newmax = np.asarray(new_xar.sel(rivid=rivid).Qout_max)
 
-    start = datetime.datetime(year=1979, month=1, day=1)
-    new_times = [start + datetime.timedelta(days=int(i)) for i in new_times]
-
     new_scatter_min = go.Scatter(
         name='new_data_min',
         x=new_times,
@@ -183,9 +249,15 @@ if __name__ == '__main__':
     sys.argv[0] this script e.g. aggregate.py
     sys.argv[1] path to Qout file
     sys.argv[2] path to log file
+    sys.argv[3] (optional) aggregation period: daily, weekly, monthly or annual. default daily
+    sys.argv[4] (optional) number of worker processes. default 1
+    sys.argv[5] (optional) memory budget used to size the groups of rivers, e.g. 16GB. default 4GB
     """
     # enable logging to track the progress of the workflow and for debugging
     logging.basicConfig(filename=sys.argv[2], filemode='w', level=logging.INFO, format='%(message)s')
     logging.info('ERA5 aggregation started on ' + datetime.datetime.utcnow().strftime("%D at %R"))
-    aggregated_file = aggregate_by_day(sys.argv[1], write_frequency=1000)
+    period = sys.argv[3] if len(sys.argv) > 3 else 'daily'
+    workers = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+    max_memory = sys.argv[5] if len(sys.argv) > 5 else '4GB'
+    aggregated_file = aggregate_by_day(sys.argv[1], period=period, workers=workers, max_memory=max_memory)
     # validate_aggregated_rivid(sys.argv[1], aggregated_file)
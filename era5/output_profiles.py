@@ -0,0 +1,273 @@
+"""
+output_profiles.py
+
+Author: Riley Hales
+License: BSD 3 Clause
+
+Storage profiles for the flow variables of the derived netcdfs. The default profile writes uncompressed float32 with
+the netcdf default chunks like the tools always have. The other profiles compress with zlib and the shuffle filter in
+chunks of whole rivers, so reading one river decodes a single small chunk, and can trade precision for size by
+quantizing to a number of decimal places or packing to int16 with a scale_factor and add_offset. Each profile states
+the precision it loses.
+
+int16 packing needs the range of each variable so the tools write float32 in blocks and pack the finished file with
+finish_output. The benchmark in __main__ rewrites an existing product with each profile and reports the file size,
+the write time and the time to read one river.
+"""
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import netCDF4
+import numpy as np
+
+# variables with a rivid dimension which are coordinates rather than flows
+COORDINATE_VARIABLES = ('rivid', 'lat', 'lon', 'time')
+OUTPUT_PROFILE_ATTRIBUTE = 'output_profile'
+# target uncompressed size of one chunk of whole rivers
+CHUNK_BYTES = 2 ** 16
+INT16_FILL = -32768
+
+PROFILES = {
+    'default': {
+        'description': 'uncompressed float32 with the netcdf default chunks',
+        'precision': 'exact',
+    },
+    'zlib': {
+        'description': 'float32, zlib level 4 and shuffle in chunks of whole rivers',
+        'precision': 'exact',
+        'zlib': True, 'complevel': 4, 'shuffle': True,
+    },
+    'zlib_fast': {
+        'description': 'float32, zlib level 1 and shuffle in chunks of whole rivers',
+        'precision': 'exact',
+        'zlib': True, 'complevel': 1, 'shuffle': True,
+    },
+    'lsd3': {
+        'description': 'float32 rounded to 3 decimal places, zlib level 4 and shuffle in chunks of whole rivers',
+        'precision': 'absolute error at most 0.0005 m3 s-1',
+        'zlib': True, 'complevel': 4, 'shuffle': True, 'least_significant_digit': 3,
+    },
+    'lsd1': {
+        'description': 'float32 rounded to 1 decimal place, zlib level 4 and shuffle in chunks of whole rivers',
+        'precision': 'absolute error at most 0.05 m3 s-1',
+        'zlib': True, 'complevel': 4, 'shuffle': True, 'least_significant_digit': 1,
+    },
+    'int16': {
+        'description': 'int16 with a scale_factor and add_offset per variable, zlib level 4 and shuffle in chunks of '
+                       'whole rivers',
+        'precision': 'absolute error at most half the scale_factor, about 1/131000 of the range of each variable, '
+                     'recorded in its packing_max_error attribute',
+        'zlib': True, 'complevel': 4, 'shuffle': True, 'pack': 'i2',
+    },
+}
+
+
+def get_profile(profile):
+    """
+    Returns the settings of a profile in PROFILES by name
+    """
+    if profile not in PROFILES:
+        raise ValueError(f'unrecognized output profile "{profile}", choose from {tuple(PROFILES)}')
+    return PROFILES[profile]
+
+
+def profile_packs(profile):
+    """
+    Returns True when finish_output packs the flow variables of a profile
+    """
+    return 'pack' in get_profile(profile)
+
+
+def variable_options(profile, shape, river_axis=0):
+    """
+    Returns the netCDF4 createVariable keyword arguments of a flow variable written with a profile
+
+    Args:
+        profile: name of a profile in PROFILES
+        shape: size of each dimension of the variable, or of the chunk along the dimensions besides rivid when they
+            are unlimited or too long to read whole
+        river_axis: position of the rivid dimension
+    """
+    settings = get_profile(profile)
+    options = {key: settings[key] for key in ('zlib', 'complevel', 'shuffle', 'least_significant_digit')
+               if key in settings}
+    if settings.get('zlib'):
+        # whole rivers in each chunk, as many as fit CHUNK_BYTES
+        other = int(np.prod([max(size, 1) for axis, size in enumerate(shape) if axis != river_axis]))
+        rivers = int(min(max(CHUNK_BYTES // (4 * other), 1), max(shape[river_axis], 1)))
+        options['chunksizes'] = tuple(rivers if axis == river_axis else max(size, 1) for axis, size in enumerate(shape))
+    return options
+
+
+def is_flow_variable(variable):
+    """
+    Returns True for the float32 variables along rivid which the profiles apply to, the flows rather than coordinates
+    """
+    return variable.name not in COORDINATE_VARIABLES and 'rivid' in variable.dimensions and variable.dtype == np.float32
+
+
+def create_flow_variable(new_nc, name, dimensions, profile='default', datatype='f4', chunk_shape=None):
+    """
+    Creates a float flow variable with the storage settings of a profile. Packed profiles are applied later by
+    finish_output so the variable is created as compressed float32.
+
+    Args:
+        new_nc: the netcdf being written
+        name: name of the variable
+        dimensions: tuple of dimension names, one of them rivid
+        profile: name of a profile in PROFILES
+        datatype: datatype of the values written to the variable
+        chunk_shape: sizes used in place of the dimension sizes to pick the chunks, e.g. to give an unlimited
+            dimension a chunk length. The sizes of the dimensions by default
+
+    Returns:
+        netCDF4.Variable: the new variable
+    """
+    shape = chunk_shape or tuple(new_nc.dimensions[dimension].size for dimension in dimensions)
+    options = variable_options(profile, shape, dimensions.index('rivid'))
+    if profile != 'default':
+        new_nc.setncattr(OUTPUT_PROFILE_ATTRIBUTE, profile)
+    return new_nc.createVariable(name, datatype=datatype, dimensions=dimensions, **options)
+
+
+def _river_slices(variable, block_bytes=2 ** 26):
+    # (start, end) blocks along rivid of about block_bytes, as index tuples for the variable
+    river_axis = variable.dimensions.index('rivid')
+    number_rivers = variable.shape[river_axis]
+    per_river = max(variable.dtype.itemsize * int(np.prod(variable.shape)) // max(number_rivers, 1), 1)
+    step = max(block_bytes // per_river, 1)
+    for start in range(0, number_rivers, step):
+        index = [slice(None)] * len(variable.shape)
+        index[river_axis] = slice(start, min(start + step, number_rivers))
+        yield tuple(index)
+
+
+def write_profiled_copy(path, new_path, profile):
+    """
+    Copies a netcdf with its flow variables stored with a profile, see is_flow_variable. Packed variables get a
+    scale_factor and add_offset from their range and a packing_max_error attribute.
+    """
+    settings = get_profile(profile)
+    with netCDF4.Dataset(path, mode='r') as source_nc, netCDF4.Dataset(new_path, mode='w') as new_nc:
+        new_nc.setncatts({name: source_nc.getncattr(name) for name in source_nc.ncattrs()})
+        new_nc.setncattr(OUTPUT_PROFILE_ATTRIBUTE, profile)
+        for name, dimension in source_nc.dimensions.items():
+            new_nc.createDimension(name, None if dimension.isunlimited() else dimension.size)
+        for name, variable in source_nc.variables.items():
+            attributes = {attr: variable.getncattr(attr) for attr in variable.ncattrs() if attr != '_FillValue'}
+            if not is_flow_variable(variable):
+                new_var = new_nc.createVariable(name, variable.dtype, variable.dimensions,
+                                                fill_value=getattr(variable, '_FillValue', None))
+                new_var.setncatts(attributes)
+                new_var[:] = variable[:]
+                continue
+
+            # an unlimited dimension keeps the length of its chunks, the others are chunked whole
+            chunking = variable.chunking()
+            shape = tuple(chunking[axis] if source_nc.dimensions[dimension].isunlimited() else size
+                          for axis, (dimension, size) in enumerate(zip(variable.dimensions, variable.shape)))
+            options = variable_options(profile, shape, variable.dimensions.index('rivid'))
+            if 'pack' not in settings:
+                new_var = new_nc.createVariable(name, variable.dtype, variable.dimensions, **options)
+                new_var.setncatts(attributes)
+                for index in _river_slices(variable):
+                    new_var[index] = variable[index]
+                continue
+
+            # the packed values span -32767 to 32767 with -32768 left for the missing values
+            low, high = np.inf, -np.inf
+            for index in _river_slices(variable):
+                values = np.asarray(variable[index], dtype=np.float64)
+                if np.isfinite(values).any():
+                    low, high = min(low, np.nanmin(values)), max(high, np.nanmax(values))
+            if not np.isfinite(low):
+                low = high = 0.
+            # a little narrower than the int16 range so float32 rounding of the scale can't overflow it
+            scale_factor = np.float32(max(high - low, 1e-30) / 65532)
+            add_offset = np.float32((high + low) / 2)
+            new_var = new_nc.createVariable(name, settings['pack'], variable.dimensions, fill_value=INT16_FILL,
+                                            **options)
+            new_var.setncatts(attributes)
+            new_var.setncattr('scale_factor', scale_factor)
+            new_var.setncattr('add_offset', add_offset)
+            new_var.setncattr('packing_max_error', np.float32(scale_factor / 2))
+            for index in _river_slices(variable):
+                new_var[index] = np.ma.masked_invalid(np.asarray(variable[index]))
+            logging.info(f'  packed {name} from {low:.4g} to {high:.4g} to within {scale_factor / 2:.3g}')
+    return new_path
+
+
+def finish_output(path, profile):
+    """
+    Packs the flow variables of a finished output in place when the profile packs them, otherwise does nothing
+    """
+    if not profile_packs(profile):
+        return path
+    logging.info(f'packing {path} with the {profile} profile')
+    tmp_path = path + '.packing'
+    write_profiled_copy(path, tmp_path, profile)
+    os.replace(tmp_path, path)
+    return path
+
+
+def benchmark_profiles(path, profiles=tuple(PROFILES), rivers=50, seed=0):
+    """
+    Rewrites a derived netcdf with each profile and measures it
+
+    Args:
+        path: path to a product netcdf, e.g. simulated_average_flows.nc4
+        profiles: names of the profiles to compare
+        rivers: number of randomly chosen rivers to time reading
+        seed: seed of the choice of rivers
+
+    Returns:
+        list: a dictionary per profile of its size in bytes, write time, mean time to read every flow variable of one
+            river, and the largest absolute error measured against the original file
+    """
+    results = []
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(path))) as tmp_dir:
+        for profile in profiles:
+            new_path = os.path.join(tmp_dir, f'{profile}.nc')
+            t0 = time.perf_counter()
+            write_profiled_copy(path, new_path, profile)
+            write_time = time.perf_counter() - t0
+
+            with netCDF4.Dataset(path, mode='r') as source_nc, netCDF4.Dataset(new_path, mode='r') as new_nc:
+                flow_names = [name for name, variable in source_nc.variables.items() if is_flow_variable(variable)]
+                number_rivers = source_nc.dimensions['rivid'].size
+                picks = np.random.default_rng(seed).choice(number_rivers, min(rivers, number_rivers), replace=False)
+                t0 = time.perf_counter()
+                for river in picks:
+                    for name in flow_names:
+                        variable = new_nc.variables[name]
+                        index = [slice(None)] * len(variable.shape)
+                        index[variable.dimensions.index('rivid')] = int(river)
+                        variable[tuple(index)]
+                read_time = (time.perf_counter() - t0) / len(picks)
+
+                max_error = 0.
+                for name in flow_names:
+                    for index in _river_slices(source_nc.variables[name]):
+                        original = np.asarray(source_nc.variables[name][index], dtype=np.float64)
+                        copy = np.ma.filled(new_nc.variables[name][index].astype(np.float64), np.nan)
+                        max_error = max(max_error, float(np.nanmax(np.abs(original - copy), initial=0.)))
+            results.append({'profile': profile, 'size': os.path.getsize(new_path), 'write_time': write_time,
+                            'read_time': read_time, 'max_error': max_error,
+                            'precision': PROFILES[profile]['precision']})
+    return results
+
+
+if __name__ == '__main__':
+    """
+    sys.argv[0] this script e.g. output_profiles.py
+    sys.argv[1] path to a product netcdf to benchmark, e.g. simulated_average_flows.nc4
+    sys.argv[2] (optional) comma separated profiles. default all
+    """
+    results = benchmark_profiles(sys.argv[1], tuple(sys.argv[2].split(',')) if len(sys.argv) > 2 else tuple(PROFILES))
+    print(f'{"profile":<10} {"size MiB":>9} {"write s":>8} {"read ms/river":>14} {"max error":>10}  stated precision')
+    for result in results:
+        print(f'{result["profile"]:<10} {result["size"] / 2 ** 20:>9.2f} {result["write_time"]:>8.2f} '
+              f'{result["read_time"] * 1000:>14.3f} {result["max_error"]:>10.3g}  {result["precision"]}')
@@ -0,0 +1,173 @@
+"""
+qout_cache.py
+
+Author: Riley Hales
+License: BSD 3 Clause
+
+Decompressed cache of a Qout for repeated analysis passes. The flows are decoded once into a raw river major float32
+file with a small JSON header next to it in a qout_cache folder beside the Qout. Later passes map the file with
+np.memmap so reading a block of rivers is a view of the page cache rather than an HDF5 chunk decode, and looking up
+one river touches only the pages of its time series. The header records the size and modification time of the Qout
+and the cache is rebuilt whenever they change.
+"""
+import datetime
+import json
+import logging
+import os
+import sys
+
+import netCDF4
+import numpy as np
+
+from block_io import rivers_per_block
+from qout_reader import QoutReader, RIVER_MAJOR, TIME_MAJOR, river_major_path
+
+CACHE_DIRECTORY = 'qout_cache'
+CACHE_VERSION = 1
+
+
+def cache_paths(path_Qout, flow_var='Qout'):
+    """
+    Returns the paths of the JSON header, the raw flows and the rivid array of the cache of a Qout
+    """
+    stem = os.path.join(os.path.dirname(path_Qout), CACHE_DIRECTORY, f'{os.path.basename(path_Qout)}.{flow_var}')
+    return stem + '.json', stem + '.f32', stem + '.rivid.npy'
+
+
+def _source_stamp(path_Qout):
+    stat = os.stat(path_Qout)
+    return {'source_size': stat.st_size, 'source_mtime_ns': stat.st_mtime_ns}
+
+
+def read_cache_header(path_Qout, flow_var='Qout'):
+    """
+    Returns the header of the cache of a Qout when it exists and was made from the current file, otherwise None
+    """
+    header_path, flows_path, rivid_path = cache_paths(path_Qout, flow_var)
+    if not (os.path.isfile(header_path) and os.path.isfile(flows_path) and os.path.isfile(rivid_path)):
+        return None
+    with open(header_path) as f:
+        header = json.load(f)
+    stamp = _source_stamp(path_Qout)
+    if header.get('version') != CACHE_VERSION or any(header.get(key) != value for key, value in stamp.items()):
+        return None
+    if os.path.getsize(flows_path) != header['number_rivers'] * header['number_times'] * 4:
+        return None
+    return header
+
+
+def build_qout_cache(path_Qout, flow_var='Qout', max_memory='4GB'):
+    """
+    Decodes the flows of a Qout into the raw float32 cache, see the module docstring
+
+    Args:
+        path_Qout: path to the Qout netcdf
+        flow_var: name of the flow variable
+        max_memory: memory budget for the blocks of rivers decoded at once, see block_io.rivers_per_block
+
+    Returns:
+        dict: the cache header
+    """
+    if not os.path.isfile(path_Qout):
+        raise FileNotFoundError('Qout file not found at this path')
+    header_path, flows_path, rivid_path = cache_paths(path_Qout, flow_var)
+    os.makedirs(os.path.dirname(header_path), exist_ok=True)
+    # stamp before reading so a Qout rewritten while the cache is built invalidates it
+    stamp = _source_stamp(path_Qout)
+
+    with netCDF4.Dataset(river_major_path(path_Qout), mode='r') as source_nc:
+        reader = QoutReader(source_nc.variables[flow_var])
+        number_rivers, number_times = reader.number_rivers, reader.number_times
+        logging.info(f'caching {number_rivers} rivers x {number_times} times '
+                     f'({number_rivers * number_times * 4 / 2 ** 30:.2f} GiB) in {flows_path}')
+        np.save(rivid_path, np.asarray(source_nc.variables['rivid'][:]))
+
+        # the header is written last so a cache which has one is always complete
+        if os.path.isfile(header_path):
+            os.remove(header_path)
+        flows = np.memmap(flows_path, dtype=np.float32, mode='w+', shape=(number_rivers, number_times))
+        block_size = rivers_per_block(max_memory, reader.variable)
+        for start, end, arr in reader.iter_river_blocks(block_size, order=RIVER_MAJOR):
+            flows[start:end] = arr
+            logging.info(f'  rivers {start}:{end} of {number_rivers} -- {datetime.datetime.utcnow().strftime("%c")}')
+        flows.flush()
+        del flows
+
+    header = {'version': CACHE_VERSION, 'source': os.path.basename(path_Qout), 'flow_var': flow_var,
+              'dtype': 'float32', 'order': RIVER_MAJOR, 'number_rivers': number_rivers,
+              'number_times': number_times, **stamp}
+    with open(header_path + '.tmp', 'w') as f:
+        json.dump(header, f, indent=2)
+    os.replace(header_path + '.tmp', header_path)
+    return header
+
+
+def open_qout_cache(path_Qout, flow_var='Qout', max_memory='4GB'):
+    """
+    Returns a QoutCache of a Qout, building the cache first when there isn't a current one
+    """
+    if read_cache_header(path_Qout, flow_var) is None:
+        build_qout_cache(path_Qout, flow_var, max_memory)
+    return QoutCache(path_Qout, flow_var)
+
+
+class QoutCache:
+    def __init__(self, path_Qout, flow_var='Qout'):
+        """
+        Maps the cache of a Qout read only. It has the shape attributes and the read method of qout_reader.QoutReader
+        so the block tools can read from either.
+
+        Args:
+            path_Qout: path to the Qout netcdf the cache was built from, see open_qout_cache
+            flow_var: name of the flow variable
+        """
+        self.header = read_cache_header(path_Qout, flow_var)
+        if self.header is None:
+            raise FileNotFoundError(f'no current cache of {path_Qout}, see build_qout_cache')
+        _, flows_path, rivid_path = cache_paths(path_Qout, flow_var)
+        self.order = RIVER_MAJOR
+        self.number_rivers = self.header['number_rivers']
+        self.number_times = self.header['number_times']
+        self.flows = np.memmap(flows_path, dtype=np.float32, mode='r', shape=(self.number_rivers, self.number_times))
+        self.rivids = np.load(rivid_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        # views handed out keep the mapping open until they are released
+        self.flows = None
+
+    def read(self, rivers=slice(None), times=slice(None), order=TIME_MAJOR, contiguous=False):
+        """
+        Returns the flows of the rivers and time steps as a view of the mapped file, see QoutReader.read. A TIME_MAJOR
+        array is a transposed view and only contiguous makes a copy.
+        """
+        arr = self.flows[rivers, times]
+        if order != RIVER_MAJOR:
+            arr = arr.T
+        return np.ascontiguousarray(arr) if contiguous else arr
+
+    def river(self, rivid):
+        """
+        Returns a view of the whole time series of the river with this rivid
+        """
+        positions = np.flatnonzero(self.rivids == rivid)
+        if len(positions) == 0:
+            raise KeyError(f'rivid {rivid} is not in the cache')
+        return self.flows[positions[0]]
+
+
+if __name__ == '__main__':
+    """
+    sys.argv[0] this script e.g. qout_cache.py
+    sys.argv[1] path to Qout file
+    sys.argv[2] path to log file
+    sys.argv[3] (optional) memory budget, e.g. 16GB. default 4GB
+    """
+    logging.basicConfig(filename=sys.argv[2], filemode='w', level=logging.INFO, format='%(message)s')
+    logging.info('Qout cache started on ' + datetime.datetime.utcnow().strftime("%D at %R"))
+    build_qout_cache(sys.argv[1], max_memory=sys.argv[3] if len(sys.argv) > 3 else '4GB')
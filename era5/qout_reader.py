@@ -0,0 +1,157 @@
+"""
+qout_reader.py
+
+Author: Riley Hales
+License: BSD 3 Clause
+
+Reads RAPID Qout netcdfs whatever their dimension order and chunk layout. QoutReader works out once whether the flows
+are stored ('time', 'rivid') or ('rivid', 'time'), how they are chunked and how big the HDF5 chunk cache is, then reads
+blocks of rivers or of time steps in whichever orientation the caller asks for. Blocks are aligned to the on-disk
+chunks so no chunk is decompressed twice, and an array read against the on-disk order is returned as a transposed
+view rather than a copy.
+"""
+import logging
+import os
+
+import netCDF4
+import numpy as np
+
+TIME_MAJOR = 'time_major'
+RIVER_MAJOR = 'river_major'
+# folder next to a Qout where rechunk_qout writes its river major copy
+RIVER_MAJOR_DIRECTORY = 'river_major'
+
+
+def river_major_path(path_Qout):
+    """
+    Returns the path of the river major copy of a Qout made by rechunk_qout when there is one at least as new as the
+    Qout, otherwise path_Qout. Tools which read whole time series of rivers should open the file this returns.
+    """
+    copy_path = os.path.join(os.path.dirname(path_Qout), RIVER_MAJOR_DIRECTORY, os.path.basename(path_Qout))
+    if os.path.isfile(copy_path) and os.path.getmtime(copy_path) >= os.path.getmtime(path_Qout):
+        logging.info(f'  reading the river major copy {copy_path}')
+        return copy_path
+    return path_Qout
+
+
+class QoutReader:
+    def __init__(self, source, flow_var='Qout'):
+        """
+        Args:
+            source: path to a Qout netcdf, an open netCDF4.Dataset or the flow netCDF4.Variable itself. A file opened
+                from a path is closed by close(), an open dataset or variable is left to the caller.
+            flow_var: name of the flow variable when source is a path or dataset
+        """
+        self._owns_dataset = isinstance(source, str)
+        if self._owns_dataset:
+            source = netCDF4.Dataset(source, mode='r')
+        self.variable = source if isinstance(source, netCDF4.Variable) else source.variables[flow_var]
+        self.dataset = self.variable.group()
+
+        # the dimension besides rivid is the time axis, e.g. time in a Qout or year in the annual maxima
+        self.dimensions = tuple(self.variable.dimensions)
+        if len(self.dimensions) != 2 or 'rivid' not in self.dimensions:
+            raise ValueError(f'Unable to recognize the dimension order {self.dimensions}')
+        self.order = RIVER_MAJOR if self.dimensions[0] == 'rivid' else TIME_MAJOR
+        time_axis, river_axis = (1, 0) if self.order == RIVER_MAJOR else (0, 1)
+        self.number_times = self.variable.shape[time_axis]
+        self.number_rivers = self.variable.shape[river_axis]
+
+        # contiguous storage has no chunks to align to
+        chunking = self.variable.chunking()
+        self.contiguous = chunking == 'contiguous'
+        self.time_chunk = 1 if self.contiguous else chunking[time_axis]
+        self.river_chunk = 1 if self.contiguous else chunking[river_axis]
+        self.chunk_bytes = self.time_chunk * self.river_chunk * self.variable.dtype.itemsize
+        self.cache_bytes = self.variable.get_var_chunk_cache()[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._owns_dataset:
+            self.dataset.close()
+
+    def _aligned_size(self, size, chunk, total):
+        # round down to whole chunks when there is room for at least one
+        size = int(min(max(size, 1), total))
+        if size >= chunk:
+            size -= size % chunk
+        return size
+
+    def river_blocks(self, rivers_per_block):
+        """
+        Splits the rivers into (start, end) blocks of at most rivers_per_block rivers which begin and end on the
+        chunk boundaries along rivid, end is exclusive
+        """
+        size = self._aligned_size(rivers_per_block, self.river_chunk, self.number_rivers)
+        return [(start, min(start + size, self.number_rivers)) for start in range(0, self.number_rivers, size)]
+
+    def time_blocks(self, steps_per_block):
+        """
+        Splits the time steps into (start, end) blocks of at most steps_per_block steps which begin and end on the
+        chunk boundaries along time, end is exclusive
+        """
+        size = self._aligned_size(steps_per_block, self.time_chunk, self.number_times)
+        return [(start, min(start + size, self.number_times)) for start in range(0, self.number_times, size)]
+
+    def fit_chunk_cache(self, rivers=None, times=None, max_bytes=2 ** 30):
+        """
+        Grows the HDF5 chunk cache of the flow variable to hold every chunk a block of the given size touches, up to
+        max_bytes, so a chunk shared by two neighbouring blocks is only decompressed once.
+
+        Args:
+            rivers: number of rivers in a block, all of them by default
+            times: number of time steps in a block, all of them by default
+            max_bytes: largest cache to configure
+        """
+        if self.contiguous:
+            return
+        rivers = self.number_rivers if rivers is None else rivers
+        times = self.number_times if times is None else times
+        chunks = (-(-rivers // self.river_chunk) + 1) * (-(-times // self.time_chunk) + 1)
+        size = min(chunks * self.chunk_bytes, max_bytes)
+        if size > self.cache_bytes:
+            _, _, preemption = self.variable.get_var_chunk_cache()
+            self.variable.set_var_chunk_cache(size=size, nelems=max(chunks * 4 + 1, 521), preemption=preemption)
+            self.cache_bytes = size
+            logging.info(f'  chunk cache set to {size / 2 ** 20:.0f} MiB for {chunks} chunks per block')
+
+    def read(self, rivers=slice(None), times=slice(None), order=TIME_MAJOR, contiguous=False):
+        """
+        Reads flows as a 2D array in the requested orientation.
+
+        Args:
+            rivers: slice (or index array) of the rivers to read
+            times: slice (or index array) of the time steps to read
+            order: TIME_MAJOR for a (time, rivid) array or RIVER_MAJOR for a (rivid, time) array
+            contiguous: return a C contiguous array. When order differs from the on-disk order the result is a
+                transposed view of what was read unless a copy is asked for with contiguous
+
+        Returns:
+            np.array: the flows
+        """
+        if self.order == TIME_MAJOR:
+            arr = np.asarray(self.variable[times, rivers])
+        else:
+            arr = np.asarray(self.variable[rivers, times])
+        if order != self.order:
+            arr = arr.T
+        return np.ascontiguousarray(arr) if contiguous else arr
+
+    def iter_river_blocks(self, rivers_per_block, times=slice(None), order=TIME_MAJOR):
+        """
+        Yields (start, end, flows) for chunk aligned blocks of rivers, see river_blocks and read
+        """
+        for start, end in self.river_blocks(rivers_per_block):
+            yield start, end, self.read(slice(start, end), times, order)
+
+    def iter_time_blocks(self, steps_per_block, rivers=slice(None), order=TIME_MAJOR):
+        """
+        Yields (start, end, flows) for chunk aligned blocks of time steps, see time_blocks and read
+        """
+        for start, end in self.time_blocks(steps_per_block):
+            yield start, end, self.read(rivers, slice(start, end), order)
@@ -0,0 +1,157 @@
+"""
+rechunk_qout.py
+
+Author: Riley Hales
+License: BSD 3 Clause
+
+Makes a river major copy of a Qout netcdf. RAPID writes the flows time major so reading the whole time series of a block
+of rivers, which is what every tool here does, touches every chunk of the file. The copy stores Qout as
+('rivid', 'time') in compressed chunks of whole time series. It is written to a river_major folder next to the Qout
+with the same file name, and qout_reader.river_major_path points the tools at it while it is newer than the Qout.
+
+Both passes stay within a memory budget. When the source chunks span many rivers the flows are first copied time block
+by time block into an uncompressed intermediate file chunked (time block, river block), then river block by river
+block into the copy, so neither pass reads a chunk more than once. A source already chunked along rivid is copied in a
+single pass.
+"""
+import datetime
+import logging
+import os
+import sys
+import time
+
+import netCDF4
+
+from block_io import parse_memory
+from qout_reader import QoutReader, RIVER_MAJOR, TIME_MAJOR, RIVER_MAJOR_DIRECTORY
+
+# target size of one compressed chunk of the copy
+CHUNK_BYTES = 4 * 2 ** 20
+
+
+def _copy_metadata(source_nc, new_nc, skip=('Qout',)):
+    # every dimension, variable and attribute except the flows
+    new_nc.setncatts({name: source_nc.getncattr(name) for name in source_nc.ncattrs()})
+    for name, dimension in source_nc.dimensions.items():
+        new_nc.createDimension(name, None if dimension.isunlimited() else dimension.size)
+    for name, variable in source_nc.variables.items():
+        if name in skip:
+            continue
+        fill_value = getattr(variable, '_FillValue', None)
+        new_var = new_nc.createVariable(name, variable.dtype, variable.dimensions, fill_value=fill_value)
+        new_var.setncatts({attr: variable.getncattr(attr) for attr in variable.ncattrs() if attr != '_FillValue'})
+        new_var[:] = variable[:]
+
+
+def measure_read_throughput(path, rivers=64, flow_var='Qout'):
+    """
+    Times reading the whole time series of a typical block of rivers from the middle of a Qout
+
+    Returns:
+        float: MiB read per second
+    """
+    with QoutReader(path, flow_var) as reader:
+        start = max(reader.number_rivers // 2 - rivers // 2, 0)
+        t0 = time.perf_counter()
+        arr = reader.read(slice(start, start + rivers), order=RIVER_MAJOR)
+        elapsed = time.perf_counter() - t0
+    return arr.nbytes / 2 ** 20 / elapsed
+
+
+def rechunk_qout(path_Qout, max_memory='4GB', complevel=4, flow_var='Qout'):
+    """
+    Writes a compressed river major copy of a Qout to the river_major folder next to it.
+
+    Args:
+        path_Qout: path to the Qout netcdf
+        max_memory: memory budget of each pass, see block_io.parse_memory
+        complevel: zlib compression level of the copy
+        flow_var: name of the flow variable
+
+    Returns:
+        str: path to the copy
+    """
+    if not os.path.isfile(path_Qout):
+        raise FileNotFoundError('Qout file not found at this path')
+    copy_dir = os.path.join(os.path.dirname(path_Qout), RIVER_MAJOR_DIRECTORY)
+    os.makedirs(copy_dir, exist_ok=True)
+    copy_path = os.path.join(copy_dir, os.path.basename(path_Qout))
+    budget = parse_memory(max_memory)
+
+    source_nc = netCDF4.Dataset(path_Qout, mode='r')
+    source = QoutReader(source_nc.variables[flow_var])
+    number_times, number_rivers = source.number_times, source.number_rivers
+    itemsize = source.variable.dtype.itemsize
+
+    # whole time series per chunk, as many rivers per chunk as fit CHUNK_BYTES
+    chunk_rivers = int(min(max(CHUNK_BYTES // (number_times * itemsize), 1), number_rivers))
+    # the river block of the second pass and the copy, half the budget for the block and half for its compression
+    group = max(budget // 2 // (number_times * itemsize), 1)
+    group = int(min(max(group - group % chunk_rivers, chunk_rivers), number_rivers))
+    logging.info(f'rechunking {number_rivers} rivers x {number_times} times into chunks of {chunk_rivers} rivers, '
+                 f'{group} rivers per block')
+
+    # written to a temporary name so a copy which exists is always complete
+    tmp_path = copy_path + '.tmp'
+    new_nc = netCDF4.Dataset(tmp_path, mode='w')
+    _copy_metadata(source_nc, new_nc, skip=(flow_var,))
+    flows = new_nc.createVariable(flow_var, source.variable.dtype, ('rivid', 'time'), zlib=True, complevel=complevel,
+                                  shuffle=True, chunksizes=(chunk_rivers, number_times))
+    flows.setncatts({attr: source.variable.getncattr(attr) for attr in source.variable.ncattrs()
+                     if attr != '_FillValue'})
+
+    single_pass = source.order == RIVER_MAJOR or (not source.contiguous and source.river_chunk <= group)
+    intermediate_path = copy_path + '.intermediate'
+    if single_pass:
+        reader = source
+    else:
+        # first pass: time blocks of every river into (time block, river block) chunks
+        steps = max(budget // 2 // (number_rivers * itemsize), 1)
+        steps = int(min(max(steps - steps % source.time_chunk, source.time_chunk), number_times))
+        # hdf5 chunks must stay under 4 GiB
+        while steps * group * itemsize > 2 ** 30 and steps > source.time_chunk:
+            steps = max(steps // 2 - (steps // 2) % source.time_chunk, source.time_chunk)
+        logging.info(f'  pass 1: {steps} time steps per block into {intermediate_path}')
+        intermediate_nc = netCDF4.Dataset(intermediate_path, mode='w')
+        intermediate_nc.createDimension('time', number_times)
+        intermediate_nc.createDimension('rivid', number_rivers)
+        intermediate = intermediate_nc.createVariable(flow_var, source.variable.dtype, ('time', 'rivid'),
+                                                      chunksizes=(steps, group))
+        for start, end, arr in source.iter_time_blocks(steps, order=TIME_MAJOR):
+            intermediate[start:end, :] = arr
+        intermediate_nc.close()
+        intermediate_nc = netCDF4.Dataset(intermediate_path, mode='r')
+        reader = QoutReader(intermediate_nc.variables[flow_var])
+
+    # second (or only) pass: river blocks of the whole time series into the compressed copy
+    logging.info(f'  writing {copy_path}')
+    reader.fit_chunk_cache(rivers=group, max_bytes=budget // 4)
+    for start, end, arr in reader.iter_river_blocks(group, order=RIVER_MAJOR):
+        flows[start:end, :] = arr
+        logging.info(f'  rivers {start}:{end} of {number_rivers} -- {datetime.datetime.utcnow().strftime("%c")}')
+
+    new_nc.close()
+    source_nc.close()
+    if not single_pass:
+        reader.dataset.close()
+        os.remove(intermediate_path)
+    os.replace(tmp_path, copy_path)
+
+    before = measure_read_throughput(path_Qout, flow_var=flow_var)
+    after = measure_read_throughput(copy_path, flow_var=flow_var)
+    logging.info(f'read throughput of a 64 river block: {before:.1f} MiB/s from the Qout, {after:.1f} MiB/s from the '
+                 f'river major copy ({os.path.getsize(path_Qout) / 2 ** 30:.2f} GiB -> '
+                 f'{os.path.getsize(copy_path) / 2 ** 30:.2f} GiB)')
+    return copy_path
+
+
+if __name__ == '__main__':
+    """
+    sys.argv[0] this script e.g. rechunk_qout.py
+    sys.argv[1] path to Qout file
+    sys.argv[2] path to log file
+    sys.argv[3] (optional) memory budget, e.g. 16GB. default 4GB
+    """
+    logging.basicConfig(filename=sys.argv[2], filemode='w', level=logging.INFO, format='%(message)s')
+    logging.info('Rechunking started on ' + datetime.datetime.utcnow().strftime("%D at %R"))
+    rechunk_qout(sys.argv[1], max_memory=sys.argv[3] if len(sys.argv) > 3 else '4GB')
@@ -0,0 +1,156 @@
+"""
+rolling_extremes.py
+
+Author: Riley Hales
+License: BSD 3 Clause
+
+Creates the rolling n-day extremes product: the largest and smallest n-day mean flow of each river in each complete
+year, e.g. the annual 7 day minimum for 7Q10 low flows or the 3 day maximum for flood volumes (mean * n * 86400 m^3).
+The rolling means come from one cumulative sum of the daily mean flows along time, so they take the same time for a
+30 day window as for a 1 day one. The product is made from the DailyAggregated file of optimized_aggregate, or from
+the hourly Qout by the rolling_extremes reducer of historical_products.
+"""
+import datetime
+import functools
+import logging
+import os
+import sys
+
+import netCDF4
+import numpy as np
+
+from aggregation import read_times, year_boundaries
+from block_io import river_blocks, rivers_per_block, read_river_block, process_blocks, process_blocks_parallel
+
+WINDOWS = (1, 3, 7, 30)
+ROLLING_EXTREMES_FILE = 'rolling_extremes.nc'
+
+
+def rolling_means(daily, window):
+    """
+    Computes the mean of every window consecutive days of a (days, rivid) array. Row i is the mean of the window
+    ending on day i + window - 1.
+    """
+    totals = np.cumsum(daily, axis=0, dtype=np.float64)
+    totals = np.concatenate((np.zeros((1, daily.shape[1])), totals))
+    return (totals[window:] - totals[:-window]) / window
+
+
+def rolling_extremes_block(daily, year_starts, year_ends, windows=WINDOWS):
+    """
+    Finds the annual maximum and minimum of the rolling mean flows of each window length. A window belongs to the
+    year of its last day so the first windows of a year may start in the previous one.
+
+    Args:
+        daily: (days, rivid) daily mean flows
+        year_starts: index of the first day of each year, e.g. from aggregation.year_boundaries
+        year_ends: index after the last day of each year
+        windows: sequence of window lengths in days
+
+    Returns:
+        tuple: (rivid, year, window) maximum and minimum rolling mean flows, nan where a year has no complete window
+    """
+    number_rivers = daily.shape[1]
+    maxima = np.full((number_rivers, len(year_starts), len(windows)), np.nan, dtype=np.float32)
+    minima = np.full((number_rivers, len(year_starts), len(windows)), np.nan, dtype=np.float32)
+    for w, window in enumerate(windows):
+        means = rolling_means(daily, window)
+        for y, (start, end) in enumerate(zip(year_starts, year_ends)):
+            # the rows of the windows which end on the days of this year
+            first, stop = max(start - window + 1, 0), end - window + 1
+            if stop <= first:
+                continue
+            maxima[:, y, w] = means[first:stop].max(axis=0)
+            minima[:, y, w] = means[first:stop].min(axis=0)
+    return maxima, minima
+
+
+def create_rolling_extremes_netcdf(path, source_nc, years, windows=WINDOWS):
+    """
+    Creates the rolling extremes netcdf for the rivers of source_nc and returns it open for writing
+    """
+    new_nc = netCDF4.Dataset(path, mode='w')
+    new_nc.createDimension('rivid', size=source_nc.dimensions['rivid'].size)
+    new_nc.createDimension('year', size=len(years))
+    new_nc.createDimension('window', size=len(windows))
+    new_nc.createVariable('rivid', datatype=source_nc.variables['rivid'].dtype, dimensions=('rivid',))
+    new_nc.variables['rivid'][:] = source_nc.variables['rivid'][:]
+    new_nc.createVariable('year', datatype='i4', dimensions=('year',))
+    new_nc.variables['year'][:] = years
+    new_nc.createVariable('window', datatype='i4', dimensions=('window',))
+    new_nc.variables['window'][:] = windows
+    new_nc.variables['window'].setncattr('units', 'days')
+    for name in ('annual_max_rolling_mean', 'annual_min_rolling_mean'):
+        new_nc.createVariable(name, datatype='f4', dimensions=('rivid', 'year', 'window'))
+        new_nc.variables[name].setncattr('units', 'm3 s-1')
+    return new_nc
+
+
+def gen_rolling_extremes(path_daily, windows=WINDOWS, write_frequency=None, workers=1, max_memory='4GB'):
+    """
+    Computes the annual rolling n-day extremes from a DailyAggregated file made by optimized_aggregate.aggregate_by_day
+
+    Args:
+        path_daily: path to the daily aggregated netcdf
+        windows: sequence of window lengths in days
+        write_frequency: number of rivers per block, picked from max_memory by default
+        workers: number of worker processes
+        max_memory: memory budget, see block_io.rivers_per_block
+    """
+    if not os.path.isfile(path_daily):
+        raise FileNotFoundError('daily aggregated file not found at this path')
+    newfilepath = os.path.join(os.path.dirname(path_daily), ROLLING_EXTREMES_FILE)
+    windows = tuple(windows)
+
+    source_nc = netCDF4.Dataset(filename=path_daily, mode='r')
+    source_var = source_nc.variables['Qout']
+    years, starts, ends = year_boundaries(read_times(source_nc.variables['time']))
+    if len(years) == 0:
+        raise RuntimeError('no complete years found in the daily file')
+    logging.info(f'finding the {windows} day extremes of {len(years)} years from {years[0]} to {years[-1]}')
+    new_nc = create_rolling_extremes_netcdf(newfilepath, source_nc, years, windows)
+
+    def read_block(start, end):
+        return read_river_block(source_var, start, end, int(ends[-1]))
+
+    def write_block(results, start, end):
+        new_nc.variables['annual_max_rolling_mean'][start:end, :, :] = results[0]
+        new_nc.variables['annual_min_rolling_mean'][start:end, :, :] = results[1]
+        new_nc.sync()
+
+    if write_frequency is None:
+        # the float64 cumulative sum and rolling means are each twice the size of the float32 block
+        write_frequency = rivers_per_block(max_memory, source_var, int(ends[-1]), working_copies=4, workers=workers,
+                                           output_values=2 * len(years) * len(windows))
+    blocks = river_blocks(source_nc.dimensions['rivid'].size, write_frequency)
+    compute_block = functools.partial(_rolling_block, year_starts=starts, year_ends=ends, windows=windows)
+    if workers > 1:
+        process_blocks_parallel(path_daily, blocks, compute_block, write_block, workers, number_times=int(ends[-1]))
+    else:
+        process_blocks(blocks, read_block, compute_block, write_block)
+
+    new_nc.close()
+    source_nc.close()
+    logging.info('FINISHED ' + datetime.datetime.utcnow().strftime("%D at %R"))
+    return newfilepath
+
+
+def _rolling_block(arr, start, end, year_starts, year_ends, windows):
+    return rolling_extremes_block(arr, year_starts, year_ends, windows)
+
+
+if __name__ == '__main__':
+    """
+    sys.argv[0] this script e.g. rolling_extremes.py
+    sys.argv[1] path to DailyAggregated file
+    sys.argv[2] path to log file
+    sys.argv[3] (optional) comma separated window lengths in days. default 1,3,7,30
+    sys.argv[4] (optional) number of worker processes. default 1
+    """
+    logging.basicConfig(filename=sys.argv[2], filemode='w', level=logging.INFO, format='%(message)s')
+    logging.info('Rolling extremes started on ' + datetime.datetime.utcnow().strftime("%D at %R"))
+    gen_rolling_extremes(
+        sys.argv[1],
+        windows=tuple(int(w) for w in sys.argv[3].split(',')) if len(sys.argv) > 3 else WINDOWS,
+        workers=int(sys.argv[4]) if len(sys.argv) > 4 else 1,
+    )
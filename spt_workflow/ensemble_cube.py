@@ -0,0 +1,158 @@
+"""
+ensemble_cube.py
+
+Author: Riley Hales
+License: BSD 3 Clause
+
+Reads the Qout files of the members of an ensemble forecast as one (ensemble, time, rivid) array without loading or
+concatenating them. EnsembleCube keeps each member file open through a QoutReader and reads blocks of rivers from all
+of them at once onto the union of their time steps. Steps a member doesn't have, e.g. the hourly steps which only the
+high resolution member 52 has, are nan. Blocks are sized so one stays within a memory ceiling and the files are closed
+when the cube is.
+"""
+import glob
+import logging
+import os
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'era5'))
+from aggregation import read_times
+from block_io import parse_memory, river_blocks
+from qout_reader import QoutReader, TIME_MAJOR
+
+
+def member_number(path):
+    """
+    Returns the ensemble member number of a forecast file named like Qout_<region>_<member>.nc
+    """
+    return int(os.path.basename(path)[:-3].split('_')[-1])
+
+
+def recent_forecast_folder(rapidio_region_output):
+    """
+    Returns the folder of the most recent forecast date in the output folder of a region
+    """
+    recent_date = sorted(name for name in os.listdir(rapidio_region_output) if not name.endswith('.csv'))
+    if len(recent_date) == 0:
+        raise FileNotFoundError(f'no forecast dates found in {rapidio_region_output}')
+    return os.path.join(rapidio_region_output, recent_date[-1])
+
+
+class EnsembleCube:
+    def __init__(self, member_files, flow_var='Qout', max_memory='2GB'):
+        """
+        Opens the member files of an ensemble read only
+
+        Args:
+            member_files: paths to the Qout of each member, see member_number. They must share their rivids
+            flow_var: name of the flow variable
+            max_memory: ceiling on the size of a block of rivers read from every member, see block_io.parse_memory
+        """
+        if len(member_files) == 0:
+            raise FileNotFoundError('no ensemble member files to open')
+        self.max_memory = parse_memory(max_memory)
+        self.members = np.array([member_number(path) for path in member_files])
+        self.readers = []
+        try:
+            member_times = []
+            for path in member_files:
+                reader = QoutReader(path, flow_var)
+                self.readers.append(reader)
+                # the fill values are replaced with nan rather than read as masked arrays
+                reader.variable.set_auto_mask(False)
+                member_times.append(read_times(reader.dataset.variables['time']))
+
+            self.rivids = np.asarray(self.readers[0].dataset.variables['rivid'][:])
+            for path, reader in zip(member_files[1:], self.readers[1:]):
+                if not np.array_equal(np.asarray(reader.dataset.variables['rivid'][:]), self.rivids):
+                    raise ValueError(f'the rivids of {path} differ from those of {member_files[0]}')
+
+            # the position of each member's steps on the union of all of them
+            self.times = np.asarray(np.unique(np.concatenate(member_times)), dtype='datetime64[ns]')
+            self.time_positions = [np.searchsorted(self.times, times) for times in member_times]
+        except Exception:
+            self.close()
+            raise
+        self.number_members = len(self.readers)
+        self.number_times = len(self.times)
+        self.number_rivers = len(self.rivids)
+
+    @classmethod
+    def from_folder(cls, qout_folder, flow_var='Qout', max_memory='2GB'):
+        """
+        Opens the Qout*.nc members in a forecast folder
+        """
+        return cls(sorted(glob.glob(os.path.join(qout_folder, 'Qout*.nc'))), flow_var, max_memory)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        for reader in self.readers:
+            reader.close()
+        self.readers = []
+
+    @property
+    def shape(self):
+        return self.number_members, self.number_times, self.number_rivers
+
+    def rivers_per_block(self, bytes_per_value=4):
+        """
+        Returns the number of rivers whose block and the work done on it, bytes_per_value bytes for each of its
+        (ensemble, time) values, fit within the memory ceiling
+        """
+        return int(min(max(self.max_memory // (bytes_per_value * self.number_members * self.number_times), 1),
+                       max(self.number_rivers, 1)))
+
+    def read(self, rivers=slice(None)):
+        """
+        Reads the (ensemble, time, rivid) float32 flows of the rivers from every member, nan where a member doesn't
+        have a step
+
+        Args:
+            rivers: slice or increasing array of the positions of the rivers
+        """
+        number_rivers = len(range(*rivers.indices(self.number_rivers))) if isinstance(rivers, slice) else len(rivers)
+        if 4 * self.number_members * self.number_times * number_rivers > self.max_memory:
+            raise MemoryError(f'a block of {number_rivers} rivers exceeds the ceiling of '
+                              f'{self.max_memory / 2 ** 20:.0f} MiB, see rivers_per_block')
+        flows = np.full((self.number_members, self.number_times, number_rivers), np.nan, dtype=np.float32)
+        for member, (reader, positions) in enumerate(zip(self.readers, self.time_positions)):
+            values = reader.read(rivers, order=TIME_MAJOR)
+            fill_value = getattr(reader.variable, '_FillValue', None)
+            if fill_value is not None:
+                values = np.where(values == fill_value, np.nan, values)
+            flows[member, positions] = values
+        return flows
+
+    def iter_river_blocks(self, rivers_per_block=None, rivers=None):
+        """
+        Yields (start, end, flows) for blocks of rivers, see read. start and end count the rivers of the whole cube or,
+        when rivers is an increasing array of positions, count along that array.
+        """
+        rivers_per_block = rivers_per_block or self.rivers_per_block()
+        if rivers is None:
+            for start, end in river_blocks(self.number_rivers, rivers_per_block):
+                yield start, end, self.read(slice(start, end))
+            return
+        for start, end in river_blocks(len(rivers), rivers_per_block):
+            yield start, end, self.read(rivers[start:end])
+
+
+def open_forecast_ensemble(rapidio_region_output, max_memory='2GB'):
+    """
+    Opens the members of the most recent forecast of a region as an EnsembleCube
+
+    Returns:
+        tuple: the EnsembleCube and the path to the forecast folder
+    """
+    qout_folder = recent_forecast_folder(rapidio_region_output)
+    cube = EnsembleCube.from_folder(qout_folder, max_memory=max_memory)
+    logging.info(f'  opened {cube.number_members} members of {cube.number_rivers} rivers and '
+                 f'{cube.number_times} time steps in {qout_folder}')
+    return cube, qout_folder
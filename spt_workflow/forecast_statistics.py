@@ -0,0 +1,169 @@
+"""
+forecast_statistics.py
+
+Author: Riley Hales
+License: BSD 3 Clause
+
+Whole array statistics of the ensemble flow forecasts of a region. The members are reduced along the ensemble axis of
+(ensemble, time, rivid) blocks of rivers read from an ensemble_cube.EnsembleCube so the mean, max and quartiles of every
+river come from a few numpy calls per block instead of a pandas join per river. first_exceedances finds when every
+river first reaches each of its return period flows from one comparison of the whole array.
+"""
+import logging
+import os
+import sys
+
+import netCDF4 as nc
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'era5'))
+from output_profiles import create_flow_variable, finish_output
+
+ENSEMBLE_STATISTICS = ('mean', 'max', 'p25', 'p75')
+ENSEMBLE_STATISTICS_FILE = 'ensemble_statistics.nc'
+RETURN_PERIODS = (2, 5, 10, 25, 50, 100)
+# the float32 block, the float64 copy np.percentile sorts and a boolean comparison with a threshold
+BYTES_PER_VALUE = 4 + 8 + 1
+
+
+def ensemble_block_statistics(flows, thresholds=None, statistics=ENSEMBLE_STATISTICS):
+    """
+    Reduces a block of ensemble forecasts along the ensemble axis. A time step missing from any member, e.g. the hourly
+    steps only the high resolution member has, is nan in the statistics.
+
+    Args:
+        flows: (ensemble, time, rivid) array of flows
+        thresholds: (rivid, threshold) array of flows, e.g. the return period flows of each river, nan where unknown
+        statistics: names from ENSEMBLE_STATISTICS to compute
+
+    Returns:
+        dict: a (time, rivid) float32 array of each statistic and, when thresholds are given, members_above: the
+            (rivid, threshold) largest number of members at or above each threshold at any one time step
+    """
+    results = {}
+    if 'mean' in statistics:
+        results['mean'] = flows.mean(axis=0)
+    if 'max' in statistics:
+        results['max'] = flows.max(axis=0)
+    quartiles = [name for name in ('p25', 'p75') if name in statistics]
+    if quartiles:
+        values = np.percentile(flows, [int(name[1:]) for name in quartiles], axis=0).astype(np.float32)
+        results.update(zip(quartiles, values))
+    if thresholds is not None:
+        # one threshold at a time so the comparison is the size of the block rather than block x thresholds
+        members_above = np.zeros((flows.shape[2], thresholds.shape[1]), dtype=np.int16)
+        for column in range(thresholds.shape[1]):
+            members_above[:, column] = np.count_nonzero(flows >= thresholds[:, column], axis=0).max(axis=0)
+        results['members_above'] = members_above
+    return results
+
+
+def ensemble_statistics(cube, thresholds=None, statistics=ENSEMBLE_STATISTICS, rivers=None, write_block=None):
+    """
+    Computes the ensemble statistics of the rivers of an ensemble_cube.EnsembleCube one block of rivers at a time,
+    blocks are sized to the memory ceiling of the cube
+
+    Args:
+        cube: the EnsembleCube of the forecast
+        thresholds: (rivid, threshold) array of flows for the members_above counts, see ensemble_block_statistics
+        statistics: names from ENSEMBLE_STATISTICS to compute. the mean is always computed
+        rivers: increasing array of the positions of the rivers to compute, all of them by default
+        write_block: called with the results, start and end of each block of rivers
+
+    Returns:
+        np.array: the (time, rivid) float32 ensemble mean of the rivers
+    """
+    statistics = tuple(statistics) if 'mean' in statistics else ('mean',) + tuple(statistics)
+    number_rivers = cube.number_rivers if rivers is None else len(rivers)
+    mean = np.empty((cube.number_times, number_rivers), dtype=np.float32)
+
+    logging.info(f'  ensemble statistics of {number_rivers} rivers')
+    for start, end, flows in cube.iter_river_blocks(cube.rivers_per_block(BYTES_PER_VALUE), rivers):
+        results = ensemble_block_statistics(flows, None if thresholds is None else thresholds[start:end], statistics)
+        mean[:, start:end] = results['mean']
+        if write_block is not None:
+            write_block(results, start, end)
+    return mean
+
+
+def first_exceedances(flows, thresholds, times):
+    """
+    Finds when the flows of every river first reach each of its thresholds, e.g. its return period flows, by
+    comparing the whole (time, rivid) array with the (rivid, threshold) thresholds at once. nan flows, such as the steps
+    missing from some ensemble members, and nan thresholds never count as reached.
+
+    Args:
+        flows: (time, rivid) array of flows, e.g. the ensemble mean from ensemble_statistics
+        thresholds: (rivid, threshold) array of flows
+        times: the numpy datetime64 times of the steps
+
+    Returns:
+        dict: exceeded, the (rivid, threshold) mask of the thresholds reached, first_times, the (rivid, threshold) time
+            each was first reached or NaT, max_flow, the largest flow of each river or nan, and peak_time, the time of
+            the largest flow of each river or NaT
+    """
+    flows = np.asarray(flows)
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    times = np.asarray(times, dtype='datetime64[ns]')
+    # argmax of the boolean exceedance is the first step reached or 0 when none is, which the mask tells apart
+    exceeds = flows[:, :, np.newaxis] >= thresholds[np.newaxis, :, :]
+    exceeded = exceeds.any(axis=0)
+    first_times = np.where(exceeded, times[np.argmax(exceeds, axis=0)], np.datetime64('NaT', 'ns'))
+
+    valid = ~np.isnan(flows).all(axis=0)
+    peak_steps = np.argmax(np.where(np.isnan(flows), -np.inf, flows), axis=0)
+    max_flow = np.where(valid, flows[peak_steps, np.arange(flows.shape[1])], np.nan)
+    peak_time = np.where(valid, times[peak_steps], np.datetime64('NaT', 'ns'))
+    return {'exceeded': exceeded, 'first_times': first_times, 'max_flow': max_flow, 'peak_time': peak_time}
+
+
+def create_ensemble_statistics_netcdf(path, rivids, times, return_periods=RETURN_PERIODS, profile='default'):
+    """
+    Creates the netcdf of the (rivid, time) ensemble statistics and the (rivid, return_period) members_above counts
+    and returns it open for writing. times are the forecast times as numpy datetime64. The flows are stored with an
+    output_profiles profile.
+    """
+    new_nc = nc.Dataset(path, mode='w')
+    new_nc.createDimension('rivid', len(rivids))
+    new_nc.createDimension('time', len(times))
+    new_nc.createDimension('return_period', len(return_periods))
+    new_nc.createVariable('rivid', datatype='i4', dimensions=('rivid',))
+    new_nc.createVariable('time', datatype='i8', dimensions=('time',))
+    new_nc.createVariable('return_period', datatype='i4', dimensions=('return_period',))
+    new_nc.variables['rivid'][:] = rivids
+    new_nc.variables['time'][:] = np.asarray(times, dtype='datetime64[s]').astype(np.int64)
+    new_nc.variables['time'].setncattr('units', 'seconds since 1970-01-01 00:00:00+00:00')
+    new_nc.variables['time'].setncattr('calendar', 'gregorian')
+    new_nc.variables['return_period'][:] = return_periods
+    for name in ENSEMBLE_STATISTICS:
+        create_flow_variable(new_nc, f'Qout_{name}', ('rivid', 'time'), profile)
+    new_nc.createVariable('members_above_return_period', datatype='i2', dimensions=('rivid', 'return_period'))
+    return new_nc
+
+
+def write_ensemble_statistics(new_nc, results, start, end):
+    """
+    Writes the results of ensemble_block_statistics for rivers start:end
+    """
+    for name in ENSEMBLE_STATISTICS:
+        new_nc.variables[f'Qout_{name}'][start:end, :] = np.transpose(results[name])
+    new_nc.variables['members_above_return_period'][start:end, :] = results['members_above']
+
+
+def save_ensemble_statistics(path, cube, thresholds, return_periods=RETURN_PERIODS, profile='default'):
+    """
+    Computes every ensemble statistic and writes them to a netcdf, see create_ensemble_statistics_netcdf
+
+    Returns:
+        np.array: the (time, rivid) float32 ensemble mean of every river
+    """
+    new_nc = create_ensemble_statistics_netcdf(path + '.tmp', cube.rivids, cube.times, return_periods, profile)
+    new_nc.setncattr('number_members', cube.number_members)
+    try:
+        mean = ensemble_statistics(cube, thresholds, ENSEMBLE_STATISTICS, write_block=lambda results, start, end:
+                                   write_ensemble_statistics(new_nc, results, start, end))
+    finally:
+        new_nc.close()
+    finish_output(path + '.tmp', profile)
+    os.replace(path + '.tmp', path)
+    return mean
@@ -15,98 +15,57 @@ import datetime
 import sys
 import glob
 import netCDF4 as nc
-import xarray
 import pandas as pd
 import numpy as np
 
+from ensemble_cube import EnsembleCube
+from forecast_statistics import ensemble_statistics, first_exceedances
+from rivid_index import RividIndex, netcdf_rivid_index
 
-def get_time_of_first_exceedence(flow, means, times):
-    # replace the flows that are too small (don't exceed the return period)
-    means[means < flow] = 0
-    # convert to list
-    means = list(means)
-    # return the time at the same index as the first non np.nan flow (uses i>0 because of how nan works in logic)
-    return times[means.index(next(i for i in means if i > 0))]
+# the return periods in the summary, the file has more
+RETURN_PERIODS = (2, 10, 20)
 
 
 def make_forecasted_flow_summary(comids_orders, qout_folder, rp_file):
-    # get list of prediction files
-    prediction_files = sorted(glob.glob(os.path.join(qout_folder, 'Qout*.nc')))
-
-    # merge them into a single file joined by ensemble number
-    ensemble_index_list = []
-    qout_datasets = []
-    for forecast_nc in prediction_files:
-        ensemble_index_list.append(int(os.path.basename(forecast_nc)[:-3].split("_")[-1]))
-        qout_datasets.append(xarray.open_dataset(forecast_nc).Qout)
-    merged_ds = xarray.concat(qout_datasets, pd.Index(ensemble_index_list, name='ensemble'))
-
-    # collect the times from the forecasts
-    times = list(merged_ds.time)
-
-    # read the return period file
+    # read the return period file, the rows of each river are found through its saved rivid index
+    rp_index = netcdf_rivid_index(rp_file)
     return_period_nc = nc.Dataset(rp_file, 'r')
-    comids_rp = list(return_period_nc.variables['rivid'][:])
-    # r100_thresholds = return_period_nc.variables['return_period_100'][:]
-    # r50_thresholds = return_period_nc.variables['return_period_50'][:]
-    # r25_thresholds = return_period_nc.variables['return_period_25'][:]
-    r20_thresholds = return_period_nc.variables['return_period_20'][:]
-    r10_thresholds = return_period_nc.variables['return_period_10'][:]
-    r2_thresholds = return_period_nc.variables['return_period_2'][:]
+    thresholds = np.column_stack([
+        np.ma.filled(return_period_nc.variables[f'return_period_{rp}'][:].astype(float), np.nan)
+        for rp in RETURN_PERIODS
+    ])
     lat = return_period_nc.variables['lat'][:]
     lon = return_period_nc.variables['lon'][:]
     return_period_nc.close()
 
-    # make the pandas dataframe to store the summary info
-    largeflows = pd.DataFrame(columns=['comid', 'stream_order', 'stream_lat', 'stream_lon', 'max_flow', 'date_r2'])  # , 'date_r10', 'date_r20', 'date_r25', 'date_r50', 'date_r100'])
-
-    # for each comid in the forecast
-    for comid, stream_order in comids_orders:
-        # produce a 1D array containing the timeseries average flow from all ensembles on each forecast timestep
-        means = np.array(merged_ds.sel(rivid=comid)).mean(axis=0)
-        means = np.nan_to_num(means)
-        means[means == np.nan] = -1
-        max_flow = max(means)
-
-        # determine the index of comid in the return periods array
-        index_rp = comids_rp.index(comid)
-
-        # reset the variables
-        date_r2 = np.nan
-        date_r10 = np.nan
-        date_r20 = np.nan
-        date_r25 = np.nan
-        date_r50 = np.nan
-        date_r100 = np.nan
-
-        # then compare the timeseries to the return period thresholds
-        # if max_flow >= r100_thresholds[index_rp]:
-        #     date_r100 = get_time_of_first_exceedence(r100_thresholds[index_rp], means, times)
-        # if max_flow >= r50_thresholds[index_rp]:
-        #     date_r50 = get_time_of_first_exceedence(r50_thresholds[index_rp], means, times)
-        # if max_flow >= r25_thresholds[index_rp]:
-        #     date_r25 = get_time_of_first_exceedence(r25_thresholds[index_rp], means, times)
-        if max_flow >= r20_thresholds[index_rp]:
-            date_r20 = np.datetime_as_string(get_time_of_first_exceedence(r20_thresholds[index_rp], means, times))
-        if max_flow >= r10_thresholds[index_rp]:
-            date_r10 = np.datetime_as_string(get_time_of_first_exceedence(r10_thresholds[index_rp], means, times))
-        if max_flow >= r2_thresholds[index_rp]:
-            date_r2 = np.datetime_as_string(get_time_of_first_exceedence(r2_thresholds[index_rp], means, times))
-        else:
-            continue
-        largeflows = largeflows.append({
-            'comid': int(comid),
-            'stream_order': int(stream_order),
-            'stream_lat': lat[index_rp],
-            'stream_lon': lon[index_rp],
-            'max_flow': max_flow,
-            'date_r2': date_r2,
-            'date_r10': date_r10,
-            'date_r20': date_r20,
-            # 'date_r25': date_r25,
-            # 'date_r50': date_r50,
-            # 'date_r100': date_r100,
-        }, ignore_index=True)
+    # open the forecast members, the listed streams are read from all of them a block of streams at a time
+    with EnsembleCube.from_folder(qout_folder) as cube:
+        # the listed streams which are in both the forecasts and the return period file
+        comids, stream_orders = (np.asarray(values) for values in zip(*comids_orders))
+        listed = RividIndex(cube.rivids).contains(comids) & rp_index.contains(comids)
+        if not listed.all():
+            logging.info(f'{np.count_nonzero(~listed)} listed streams are missing from the forecasts or return periods')
+        comids, stream_orders = comids[listed], stream_orders[listed]
+        index_rp = rp_index.positions(comids)
+
+        # the ensemble mean of the listed streams, read once each in the order of the forecast rivers, and when it
+        # first reaches each return period flow
+        positions, inverse = np.unique(RividIndex(cube.rivids).positions(comids), return_inverse=True)
+        means = ensemble_statistics(cube, statistics=('mean',), rivers=positions)[:, inverse]
+        exceedances = first_exceedances(np.nan_to_num(means), thresholds[index_rp], cube.times)
+
+    # make the pandas dataframe to store the summary info, streams which reach the 2 year return period flow
+    keep = exceedances['exceeded'][:, RETURN_PERIODS.index(2)]
+    largeflows = pd.DataFrame({
+        'comid': comids[keep].astype(int),
+        'stream_order': stream_orders[keep].astype(int),
+        'stream_lat': lat[index_rp[keep]],
+        'stream_lon': lon[index_rp[keep]],
+        'max_flow': exceedances['max_flow'][keep],
+    })
+    for column, rp in enumerate(RETURN_PERIODS):
+        dates = pd.Series(np.datetime_as_string(exceedances['first_times'][keep, column]), dtype=object)
+        largeflows[f'date_r{rp}'] = dates.where(exceedances['exceeded'][keep, column])
 
     largeflows.to_csv(os.path.join(qout_folder, 'forecasted_return_periods_summary.csv'), index=False)
 
@@ -17,163 +17,143 @@ import sys
 
 import numpy as np
 import pandas as pd
-import xarray
 import netCDF4 as nc
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'era5'))
+from block_io import parse_memory
+from output_profiles import create_flow_variable, profile_packs
+from forecast_statistics import (BYTES_PER_VALUE, ENSEMBLE_STATISTICS_FILE, RETURN_PERIODS, ensemble_statistics,
+                                 first_exceedances, save_ensemble_statistics)
+from ensemble_cube import EnsembleCube, open_forecast_ensemble, recent_forecast_folder
+from region_scheduler import schedule_regions
+from rivid_index import RividIndex, netcdf_rivid_index
+
+# resident size of a region's process before it reads anything, python with numpy, pandas and netCDF4 imported
+PROCESS_OVERHEAD = 2 ** 28
+
 # todo make process_region into process_date which gets called by process_region, then you can pick whether to aggregate all days or none
 
 
-def merge_forecast_qout_files(rapidio_region_output):
-    # pick the most recent date, append to the file path
-    recent_date = sorted(os.listdir(rapidio_region_output))
-    while recent_date[-1].endswith('.csv'):
-        recent_date.remove(recent_date[-1])
-    recent_date = recent_date[-1]
-    qout_folder = os.path.join(rapidio_region_output, recent_date)
-    # list the forecast files
-    prediction_files = sorted(glob.glob(os.path.join(qout_folder, 'Qout*.nc')))
-
-    # merge them into a single file joined by ensemble number
-    ensemble_index_list = []
-    qout_datasets = []
-    for forecast_nc in prediction_files:
-        ensemble_index_list.append(int(os.path.basename(forecast_nc)[:-3].split("_")[-1]))
-        qout_datasets.append(xarray.open_dataset(forecast_nc).Qout)
-    return xarray.concat(qout_datasets, pd.Index(ensemble_index_list, name='ensemble')), qout_folder
-
-
-def check_for_return_period_flow(largeflows_df, forecasted_flows_df, stream_order, rp_data):
-    max_flow = max(forecasted_flows_df['means'])
-
-    # temporary dates
-    date_r5 = ''
-    date_r10 = ''
-    date_r25 = ''
-    date_r50 = ''
-    date_r100 = ''
-
-    # retrieve return period flow levels from dataframe
-    r2 = float(rp_data['return_period_2'].values[0])
-    r5 = float(rp_data['return_period_5'].values[0])
-    r10 = float(rp_data['return_period_10'].values[0])
-    r25 = float(rp_data['return_period_25'].values[0])
-    r50 = float(rp_data['return_period_50'].values[0])
-    r100 = float(rp_data['return_period_100'].values[0])
-
-    # then compare the timeseries to the return period thresholds
-    if max_flow >= r2:
-        date_r2 = get_time_of_first_exceedence(forecasted_flows_df, r2)
-    # if the flow is not larger than the smallest return period, return the dataframe without appending anything
-    else:
-        return largeflows_df
-
-    # check the rest of the return period flow levels
-    if max_flow >= r5:
-        date_r5 = get_time_of_first_exceedence(forecasted_flows_df, r5)
-    if max_flow >= r10:
-        date_r10 = get_time_of_first_exceedence(forecasted_flows_df, r10)
-    if max_flow >= r25:
-        date_r25 = get_time_of_first_exceedence(forecasted_flows_df, r25)
-    if max_flow >= r50:
-        date_r50 = get_time_of_first_exceedence(forecasted_flows_df, r50)
-    if max_flow >= r100:
-        date_r100 = get_time_of_first_exceedence(forecasted_flows_df, r100)
+def align_return_periods(return_period_file, comids):
+    """
+    Reads the return period flows, lat and lon of each forecast river from the return period file through its saved
+    rivid index, see rivid_index.netcdf_rivid_index. Rivers missing from the file get nan.
 
-    try:
-        lat = float(rp_data['lat'].values)
-        lon = float(rp_data['lon'].values)
-    except:
-        lat = ''
-        lon = ''
-    return largeflows_df.append({
-        'comid': rp_data.index[0],
-        'stream_order': stream_order,
-        'stream_lat': lat,
-        'stream_lon': lon,
-        'max_forecasted_flow': round(max_flow, 2),
-        'date_exceeds_return_period_2': date_r2,
-        'date_exceeds_return_period_5': date_r5,
-        'date_exceeds_return_period_10': date_r10,
-        'date_exceeds_return_period_25': date_r25,
-        'date_exceeds_return_period_50': date_r50,
-        'date_exceeds_return_period_100': date_r100,
-    }, ignore_index=True)
-
-
-def get_time_of_first_exceedence(forecasted_flows_df, flow):
-    # replace the flows that are too small (don't exceed the return period)
-    forecasted_flows_df[forecasted_flows_df.means < flow] = np.nan
-    daily_flows = forecasted_flows_df.dropna()
-    return daily_flows['times'].values[0]
-
-
-def postprocess_region(region, rapidio, historical_sim, forecast_records):
+    Returns:
+        tuple: the (rivid, return_period) flows of RETURN_PERIODS, and the lat and lon arrays or None when the file
+            doesn't have them
+    """
+    index = netcdf_rivid_index(return_period_file)
+    with nc.Dataset(return_period_file, mode='r') as return_period_nc:
+        def aligned(name):
+            return index.take(np.ma.filled(return_period_nc.variables[name][:].astype(np.float64), np.nan), comids)
+
+        thresholds = np.column_stack([aligned(f'return_period_{rp}') for rp in RETURN_PERIODS])
+        has_coordinates = 'lat' in return_period_nc.variables and 'lon' in return_period_nc.variables
+        lat, lon = (aligned('lat'), aligned('lon')) if has_coordinates else (None, None)
+    return thresholds, lat, lon
+
+
+def summarize_return_period_flows(comids, times, mean, large_streams_df, thresholds, lat=None, lon=None):
+    """
+    Builds the forecasted return periods summary of the large streams from the (time, rivid) ensemble mean of every
+    river and the (rivid, return_period) flows from align_return_periods. A stream is listed when its largest mean flow
+    reaches the 2 year return period flow, with the time the mean first reaches each return period flow or '' when it
+    never does. Streams without return period flows are left out.
+    """
+    large_streams_df = large_streams_df.drop_duplicates('COMID')
+    stream_positions = RividIndex(large_streams_df['COMID']).positions(comids)
+    large = np.flatnonzero(stream_positions >= 0)
+
+    exceedances = first_exceedances(mean[:, large], thresholds[large], times.to_numpy())
+
+    listed = exceedances['exceeded'][:, 0]
+    keep = large[listed]
+    largeflows = pd.DataFrame({
+        'comid': comids[keep],
+        'stream_order': large_streams_df['order_'].to_numpy(dtype=int)[stream_positions[keep]],
+        'stream_lat': '' if lat is None else lat[keep],
+        'stream_lon': '' if lon is None else lon[keep],
+        'max_forecasted_flow': np.round(exceedances['max_flow'][listed].astype(np.float64), 2),
+    })
+    for column, rp in enumerate(RETURN_PERIODS):
+        dates = pd.Series(exceedances['first_times'][listed, column], dtype=object)
+        largeflows[f'date_exceeds_return_period_{rp}'] = dates.where(exceedances['exceeded'][listed, column], '')
+    return largeflows
+
+
+def postprocess_region(region, rapidio, historical_sim, forecast_records, profile='default', save_statistics=False,
+                       max_memory='2GB'):
     # build the propert directory paths
     rapidio_region_input = os.path.join(rapidio, 'input', region)
     rapidio_region_output = os.path.join(rapidio, 'output', region)
 
-    # make the pandas dataframe to store the summary info
-    largeflows = pd.DataFrame(columns=[
-        'comid', 'stream_order', 'stream_lat', 'stream_lon', 'max_forecasted_flow', 'date_exceeds_return_period_2',
-        'date_exceeds_return_period_5', 'date_exceeds_return_period_10', 'date_exceeds_return_period_25',
-        'date_exceeds_return_period_50', 'date_exceeds_return_period_100'])
-
-    # merge the most recent forecast files into a single xarray dataset
-    logging.info('  merging forecasts')
-    merged_forecasts, qout_folder = merge_forecast_qout_files(rapidio_region_output)
-
-    # collect the times and comids from the forecasts
-    logging.info('  reading info from forecasts')
-    times = pd.to_datetime(pd.Series(merged_forecasts.time))
-    comids = pd.Series(merged_forecasts.rivid)
-    tomorrow = times[0] + pd.Timedelta(days=1)
-    year = times[0].strftime("%Y")
-
-    # read the return period file
-    logging.info('  reading return period file')
-    return_period_file = os.path.join(historical_sim, region, 'gumbel_return_periods.nc')
-    return_period_data = xarray.open_dataset(return_period_file).to_dataframe()
-
-    # read the list of large streams
-    logging.info('  creating dataframe of large streams')
-    stream_list = os.path.join(rapidio_region_input, 'large_str-' + region + '.csv')
-    large_streams_df = pd.read_csv(stream_list)
-    large_list = large_streams_df['COMID'].tolist()
-
-    # store the first day flows in a huge array
-    logging.info('  beginning to iterate over the comids')
-    first_day_flows = []
-
-    # now process the mean flows for each river in the region
-    for comid in comids:
-        # compute the timeseries of average flows
-        means = np.array(merged_forecasts.sel(rivid=comid)).mean(axis=0)
-        # put it in a dataframe with the times series
-        forecasted_flows = times.to_frame(name='times').join(pd.Series(means, name='means')).dropna()
-        # select flows in 1st day and save them to the forecast record
-        first_day_flows.append(list(forecasted_flows[forecasted_flows.times < tomorrow]['means']))
-
-        # if stream order is larger than 2, check if it needs to be included on the return periods summary csv
-        if comid in large_list:
-            order = int(large_streams_df[large_streams_df.COMID == comid]['order_'].values)
-            rp_data = return_period_data[return_period_data.index == comid]
-            largeflows = check_for_return_period_flow(largeflows, forecasted_flows, order, rp_data)
+    # open the members of the most recent forecast, blocks of rivers are read from every member as they're needed
+    logging.info('  opening the forecast ensemble')
+    cube, qout_folder = open_forecast_ensemble(rapidio_region_output, max_memory)
+    with cube:
+        # collect the times and comids from the forecasts
+        logging.info('  reading info from forecasts')
+        times = pd.to_datetime(pd.Series(cube.times))
+        comids = cube.rivids
+        tomorrow = times[0] + pd.Timedelta(days=1)
+        year = times[0].strftime("%Y")
+
+        # read the return period flows of each forecast river
+        logging.info('  reading return period file')
+        return_period_file = os.path.join(historical_sim, region, 'gumbel_return_periods.nc')
+        thresholds, lat, lon = align_return_periods(return_period_file, comids)
+
+        # read the list of large streams
+        logging.info('  creating dataframe of large streams')
+        stream_list = os.path.join(rapidio_region_input, 'large_str-' + region + '.csv')
+        large_streams_df = pd.read_csv(stream_list)
+
+        # the ensemble mean of every river in blocks of rivers, and the rest of the statistics when they are saved
+        logging.info('  computing the ensemble statistics')
+        if save_statistics:
+            mean = save_ensemble_statistics(os.path.join(qout_folder, ENSEMBLE_STATISTICS_FILE), cube, thresholds,
+                                            RETURN_PERIODS, profile)
+        else:
+            mean = ensemble_statistics(cube, statistics=('mean',))
+
+    # the first day of the mean flows goes to the forecast record, leaving out steps missing from some members
+    first_day = np.flatnonzero((times < tomorrow).to_numpy() & ~np.isnan(mean).all(axis=1))
+    first_day_flows = np.transpose(mean[first_day])
 
     # add the dataframe of forecasted flows to the forecast records file for this region
     logging.info('  updating the forecast records file')
     try:
-        update_forecast_records(region, forecast_records, qout_folder, year, first_day_flows, times)
+        update_forecast_records(region, forecast_records, qout_folder, year, first_day_flows, times, profile)
     except Exception as excp:
         logging.info('  unexpected error updating the forecast records')
         logging.info(excp)
 
     # now save the return periods summary csv to the right output directory
+    logging.info('  summarizing the return period flows of the large streams')
+    largeflows = summarize_return_period_flows(comids, times, mean, large_streams_df, thresholds, lat, lon)
     largeflows.to_csv(os.path.join(qout_folder, 'forecasted_return_periods_summary.csv'), index=False)
 
     return
 
 
-def update_forecast_records(region, forecast_records, qout_folder, year, first_day_flows, times):
+def estimate_region_memory(rapidio, region, max_memory='2GB'):
+    """
+    Estimates the bytes postprocess_region holds for a region: a block of the ensemble as large as max_memory allows,
+    the (time, rivid) ensemble mean and the aligned return period flows, besides the libraries themselves
+    """
+    qout_folder = recent_forecast_folder(os.path.join(rapidio, 'output', region))
+    with EnsembleCube.from_folder(qout_folder, max_memory=max_memory) as cube:
+        block = min(parse_memory(max_memory), BYTES_PER_VALUE * cube.number_members * cube.number_times *
+                    cube.number_rivers)
+        return (PROCESS_OVERHEAD + block + 2 * 4 * cube.number_times * cube.number_rivers +
+                2 * 8 * len(RETURN_PERIODS) * cube.number_rivers)
+
+
+def update_forecast_records(region, forecast_records, qout_folder, year, first_day_flows, times, profile='default'):
+    # the record grows a day at a time so its range isn't known in advance for packing
+    if profile_packs(profile):
+        raise ValueError(f'the {profile} profile packs whole files and can not be used for the forecast records')
     record_path = os.path.join(forecast_records, region)
     if not os.path.exists(record_path):
         os.mkdir(record_path)
@@ -193,7 +173,9 @@ def update_forecast_records(region, forecast_records, qout_folder, year, first_d
         record.createVariable('lat', reference.variables['lat'].dtype, dimensions=('rivid',))
         record.createVariable('lon', reference.variables['lon'].dtype, dimensions=('rivid',))
         record.createVariable('rivid', reference.variables['rivid'].dtype, dimensions=('rivid',))
-        record.createVariable('Qout', reference.variables['Qout'].dtype, dimensions=('rivid', 'time'))
+        # chunks of a month of 3 hourly steps so each day's write recompresses a month rather than the whole year
+        create_flow_variable(record, 'Qout', ('rivid', 'time'), profile, datatype=reference.variables['Qout'].dtype,
+                             chunk_shape=(reference.dimensions['rivid'].size, 8 * 31))
         # and also prepopulate the lat, lon, and rivid fields
         record.variables['rivid'][:] = reference.variables['rivid'][:]
         record.variables['lat'][:] = reference.variables['lat'][:]
@@ -211,6 +193,7 @@ def update_forecast_records(region, forecast_records, qout_folder, year, first_d
             timesteps += 1
         record.variables['time'][:] = [i * 3 for i in range(timesteps)]
         record.close()
+        reference.close()
 
     # open the record netcdf
     logging.info('  writing first day flows to forecast record netcdf')
@@ -239,12 +222,20 @@ if __name__ == '__main__':
     arg2 = path to directory where the historical data are stored. the folder that contains 1 folder for each region.
     arg3 = path to the directory where the 1day forecasts are saved. the folder that contains 1 folder for each region.
     arg4 = path to the logs directory
+    arg5 = (optional) output profile of the forecast records, see era5/output_profiles.py. default is default
+    arg6 = (optional) true to also save the ensemble_statistics.nc of each region, see forecast_statistics.py
+    arg7 = (optional) number of regions processed at once. default 1
+    arg8 = (optional) memory the regions processed at once share, e.g. 32GB. default 8GB
     """
     # accept the arguments
     rapidio = sys.argv[1]
     historical_sim = sys.argv[2]
     forecast_records = sys.argv[3]
     logs_dir = sys.argv[4]
+    profile = sys.argv[5] if len(sys.argv) > 5 else 'default'
+    save_statistics = len(sys.argv) > 6 and sys.argv[6].lower() == 'true'
+    workers = int(sys.argv[7]) if len(sys.argv) > 7 else 1
+    max_memory = sys.argv[8] if len(sys.argv) > 8 else '8GB'
 
     # list of regions to be processed based on their forecasts
     regions = os.listdir(os.path.join(rapidio, 'output'))
@@ -252,21 +243,25 @@ if __name__ == '__main__':
     # start logging
     start = datetime.datetime.now()
     log = os.path.join(logs_dir, 'postprocess_forecasts-' + start.strftime("%Y%m%d"))
-    logging.basicConfig(filename=log, filemode='w', level=logging.INFO)
+    # appended to rather than overwritten so the lines the region processes append aren't written over
+    open(log, 'w').close()
+    logging.basicConfig(filename=log, filemode='a', level=logging.INFO)
     logging.info('postprocess_flow_forecasts.py initiated ' + start.strftime("%c"))
 
+    # estimate the memory of each region so the scheduler doesn't run the largest ones together
+    estimates = {}
     for region in regions:
         try:
-            # log start messages
-            logging.info('')
-            logging.info('WORKING ON ' + region)
-            logging.info('  elapsed time: ' + str(datetime.datetime.now() - start))
-            # attempt to postprocess the region
-            postprocess_region(region, rapidio, historical_sim, forecast_records)
+            estimates[region] = estimate_region_memory(rapidio, region)
         except Exception as e:
-            logging.info(e)
-            logging.info('      region failed at ' + datetime.datetime.now().strftime("%c"))
+            logging.info(f'could not estimate the memory of {region}: {e}')
+
+    # process the regions in separate processes, a failed region is logged and reported without stopping the others
+    report = schedule_regions(postprocess_region, regions, (rapidio, historical_sim, forecast_records, profile,
+                                                            save_statistics), workers, max_memory, estimates, log,
+                              log + '.json')
 
     logging.info('')
+    logging.info(f'{report["succeeded"]} regions succeeded, {report["failed"]} failed')
     logging.info('Finished at ' + datetime.datetime.now().strftime("%c"))
     logging.info('Total elapsed time: ' + str(datetime.datetime.now() - start))
@@ -1,21 +1,31 @@
 import glob
-import xarray
 import numpy as np
 import pandas as pd
 import os
+import sys
+
+from ensemble_cube import EnsembleCube
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'era5'))
+from qout_reader import RIVER_MAJOR
 
 
 output_folder = '/Users/riley/spatialdata/rapid-io/output/'
 for region in os.listdir(output_folder):
     print(f'started {region}')
     prediction_files = sorted(glob.glob(os.path.join(output_folder, region, '20200610.0', 'Qout*.nc')))
-    # merge them into a single file joined by ensemble number
-    ensemble_index_list = []
-    qout_datasets = []
-    for forecast_nc in prediction_files:
-        ensemble_index_list.append(int(os.path.basename(forecast_nc)[:-3].split("_")[-1]))
-        qout_datasets.append(xarray.open_dataset(forecast_nc).Qout)
-    ds = xarray.concat(qout_datasets, pd.Index(ensemble_index_list, name='ensemble'))
+    # the 24th step of the union of the members' time steps, read only from the members which have that time
+    member_flows = []
+    with EnsembleCube(prediction_files) as cube:
+        for reader, positions in zip(cube.readers, cube.time_positions):
+            step = np.flatnonzero(positions == 24)
+            if len(step) == 0:
+                continue
+            flows = reader.read(times=slice(step[0], step[0] + 1), order=RIVER_MAJOR)[:, 0]
+            fill_value = getattr(reader.variable, '_FillValue', None)
+            if fill_value is not None:
+                flows = np.where(flows == fill_value, np.nan, flows)
+            member_flows.append(flows)
     qinit_path = os.path.join(output_folder, region, '20200610.0', 'Qinit_20200610t00.csv')
-    pd.DataFrame(np.nanmean(ds.data[:, :, 24], axis=0)[::-1]).to_csv(qinit_path, index=False, header=False)
+    pd.DataFrame(np.nanmean(member_flows, axis=0)[::-1]).to_csv(qinit_path, index=False, header=False)
     print(f'finished {region}')
@@ -0,0 +1,126 @@
+"""
+region_scheduler.py
+
+Author: Riley Hales
+License: BSD 3 Clause
+
+Runs a function on several regions at once with each region in its own spawned process, so a region which raises or
+even crashes its process can't stop the others. Regions are started largest first while the sum of the memory
+estimates of the running regions stays within a budget, so two of the largest regions don't run together, and a
+region larger than the whole budget runs on its own. The elapsed time and peak resident memory of each region are
+logged and written to a JSON run report.
+"""
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from multiprocessing.connection import wait
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'era5'))
+from block_io import parse_memory, peak_rss
+
+
+def _run_region(connection, function, region, args, log_path, log_level):
+    # the body of each region's process, it reports back through the pipe whether or not the function raises
+    if log_path is not None:
+        logging.basicConfig(filename=log_path, filemode='a', level=log_level, format=f'[{region}] %(message)s')
+    t0 = time.perf_counter()
+    report = {'status': 'succeeded', 'error': None}
+    try:
+        function(region, *args)
+    except Exception as e:
+        logging.info(traceback.format_exc())
+        report = {'status': 'failed', 'error': f'{type(e).__name__}: {e}'}
+    report.update(elapsed=time.perf_counter() - t0, peak_rss=peak_rss())
+    connection.send(report)
+    connection.close()
+
+
+def schedule_regions(function, regions, args=(), workers=2, max_memory='8GB', estimates=None, log_path=None,
+                     report_path=None):
+    """
+    Runs function(region, *args) for each region in a process of its own, see the module docstring
+
+    Args:
+        function: picklable function taking the region name then args
+        regions: names of the regions
+        args: the rest of the arguments of function
+        workers: most regions run at once
+        max_memory: budget the memory estimates of the running regions share, see block_io.parse_memory
+        estimates: dictionary of the bytes each region is expected to use, regions missing from it are assumed to need
+            nothing beyond the worker limit
+        log_path: log file the regions append their logging to, each line prefixed with the region
+        report_path: path of the JSON run report
+
+    Returns:
+        dict: the run report, with the status, error, elapsed seconds and peak resident bytes of each region
+    """
+    budget = parse_memory(max_memory)
+    workers = max(int(workers), 1)
+    estimates = {region: int((estimates or {}).get(region, 0)) for region in regions}
+    # largest first so the giant regions aren't left to run alone at the end
+    pending = sorted(regions, key=lambda region: estimates[region], reverse=True)
+    log_level = logging.getLogger().getEffectiveLevel()
+    context = multiprocessing.get_context('spawn')
+    started = datetime.datetime.now()
+    running = {}
+    reports = {}
+
+    while pending or running:
+        # admit the largest regions which fit beside those running, or the next one when nothing is running
+        for region in list(pending):
+            if len(running) >= workers:
+                break
+            in_use = sum(estimates[name] for name in running)
+            if running and in_use + estimates[region] > budget:
+                continue
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=_run_region, name=f'region-{region}',
+                                      args=(sender, function, region, args, log_path, log_level))
+            process.start()
+            sender.close()
+            running[region] = (process, receiver, time.perf_counter(), datetime.datetime.now())
+            pending.remove(region)
+            logging.info(f'started {region}, estimated {estimates[region] / 2 ** 30:.2f} GiB with '
+                         f'{(in_use + estimates[region]) / 2 ** 30:.2f} GiB of {budget / 2 ** 30:.2f} GiB in use')
+
+        # wait for a region to finish
+        wait([process.sentinel for process, _, _, _ in running.values()])
+        for region, (process, receiver, t0, region_started) in list(running.items()):
+            if process.is_alive():
+                continue
+            try:
+                report = receiver.recv() if receiver.poll() else None
+            except EOFError:
+                report = None
+            process.join()
+            receiver.close()
+            if report is None:
+                # the process died without reporting, e.g. killed for running out of memory
+                report = {'status': 'crashed', 'error': f'exit code {process.exitcode}',
+                          'elapsed': time.perf_counter() - t0, 'peak_rss': None}
+            report.update(region=region, estimate=estimates[region], started=region_started.isoformat(),
+                          finished=datetime.datetime.now().isoformat())
+            reports[region] = report
+            del running[region]
+            peak = 'unknown' if report['peak_rss'] is None else f'{report["peak_rss"] / 2 ** 30:.2f} GiB'
+            logging.info(f'{region} {report["status"]} in {report["elapsed"]:.1f}s with peak rss {peak}'
+                         + ('' if report['error'] is None else f': {report["error"]}'))
+
+    finished = datetime.datetime.now()
+    run_report = {
+        'started': started.isoformat(), 'finished': finished.isoformat(),
+        'elapsed': (finished - started).total_seconds(), 'workers': workers, 'max_memory': budget,
+        'succeeded': sum(report['status'] == 'succeeded' for report in reports.values()),
+        'failed': sum(report['status'] != 'succeeded' for report in reports.values()),
+        'regions': [reports[region] for region in regions],
+    }
+    if report_path is not None:
+        with open(report_path + '.tmp', 'w') as f:
+            json.dump(run_report, f, indent=2)
+        os.replace(report_path + '.tmp', report_path)
+    return run_report
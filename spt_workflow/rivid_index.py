@@ -0,0 +1,96 @@
+"""
+rivid_index.py
+
+Author: Riley Hales
+License: BSD 3 Clause
+
+Finds the positions of rivids in the rivid array of a file, e.g. the rows of the return period file which belong to
+each river of a forecast, with a binary search of the sorted rivids instead of a scan of the array per river. The index
+of a return period file is saved next to it and rebuilt whenever the file changes.
+"""
+import logging
+import os
+
+import netCDF4 as nc
+import numpy as np
+
+RIVID_INDEX_SUFFIX = '.rivid_index.npz'
+
+
+class RividIndex:
+    def __init__(self, rivids, sorter=None):
+        """
+        Positions of rivids in an array of rivids
+
+        Args:
+            rivids: the rivids in the order of the file or table they index
+            sorter: the stable argsort of rivids, computed when not given
+        """
+        self.rivids = np.asarray(rivids, dtype=np.int64)
+        self.sorter = np.argsort(self.rivids, kind='stable') if sorter is None else np.asarray(sorter, dtype=np.int64)
+        self.sorted_rivids = self.rivids[self.sorter]
+
+    def __len__(self):
+        return len(self.rivids)
+
+    def positions(self, rivids):
+        """
+        Returns the position of each of the rivids in the indexed array, the first when it repeats, or -1 when it
+        isn't there
+        """
+        rivids = np.asarray(rivids, dtype=np.int64)
+        if len(self.rivids) == 0:
+            return np.full(rivids.shape, -1, dtype=np.int64)
+        found = np.minimum(np.searchsorted(self.sorted_rivids, rivids), len(self.rivids) - 1)
+        return np.where(self.sorted_rivids[found] == rivids, self.sorter[found], -1)
+
+    def contains(self, rivids):
+        """
+        Returns a boolean array of which of the rivids are in the indexed array
+        """
+        return self.positions(rivids) >= 0
+
+    def take(self, values, rivids, fill_value=np.nan):
+        """
+        Returns the rows of values, an array in the order of the indexed rivids, for each of the rivids with fill_value
+        for those which aren't indexed
+        """
+        values = np.asarray(values)
+        positions = self.positions(rivids)
+        dtype = np.result_type(values.dtype, np.min_scalar_type(fill_value))
+        taken = np.asarray(values, dtype=dtype)[np.maximum(positions, 0)]
+        taken[positions < 0] = fill_value
+        return taken
+
+
+def _source_stamp(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def netcdf_rivid_index(path, rivid_var='rivid'):
+    """
+    Returns the RividIndex of the rivid variable of a netcdf, e.g. the return period file. The index is loaded from
+    the .rivid_index.npz file next to it when that was made from the current file, otherwise it is built and saved.
+    """
+    index_path = path + RIVID_INDEX_SUFFIX
+    stamp = _source_stamp(path)
+    if os.path.isfile(index_path):
+        try:
+            with np.load(index_path) as saved:
+                if tuple(saved['source_stamp']) == stamp:
+                    return RividIndex(saved['rivids'], saved['sorter'])
+        except (OSError, KeyError, ValueError):
+            pass
+
+    with nc.Dataset(path, mode='r') as dataset:
+        index = RividIndex(np.asarray(dataset.variables[rivid_var][:]))
+    try:
+        with open(index_path + '.tmp', 'wb') as f:
+            np.savez(f, rivids=index.rivids, sorter=index.sorter, source_stamp=np.asarray(stamp, dtype=np.int64))
+        os.replace(index_path + '.tmp', index_path)
+        logging.info(f'  saved the rivid index of {path}')
+    except OSError as e:
+        # a read only historical directory just means the index is built again next time
+        logging.info(f'  could not save the rivid index of {path}: {e}')
+    return index